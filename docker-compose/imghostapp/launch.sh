@@ -40,11 +40,30 @@ then
     export POSTGRES_DB="imagestore"
 fi
 
+if [ -z "$SERVER_PROFILE" ]
+then
+    echo "SERVER_PROFILE is not set. Using 'wsgi' as default value."
+    export SERVER_PROFILE="wsgi"
+fi
+
 if [ -z "$GUNICORN_CMD_ARGS" ]
 then
     echo "GUNICORN_CMD_ARGS is not set. Using default settings."
-    export GUNICORN_CMD_ARGS="--workers 3 --bind 0.0.0.0:8080 --timeout 300"
+    if [ "$SERVER_PROFILE" = "asgi" ]
+    then
+        # a worker per core, each keeps many slow connections open
+        export GUNICORN_CMD_ARGS="--workers $(nproc) --bind 0.0.0.0:8080 --timeout 300 --keep-alive 5"
+    else
+        export GUNICORN_CMD_ARGS="--workers 3 --bind 0.0.0.0:8080 --timeout 300"
+    fi
+fi
+
+if [ -z "$METRICS_DIR" ]
+then
+    export METRICS_DIR="/tmp/imagestore-metrics"
 fi
+# counters restart with the server, files of the previous run are stale
+rm -rf "$METRICS_DIR"
 
 # set environment
 make static
@@ -52,4 +71,10 @@ make migrate
 python3 manage.py createuser
 
 # launch application
-gunicorn imagestore.wsgi:application
+if [ "$SERVER_PROFILE" = "asgi" ]
+then
+    export ASYNC_VIEWS="${ASYNC_VIEWS:-True}"
+    gunicorn --worker-class uvicorn.workers.UvicornWorker imagestore.asgi:application
+else
+    gunicorn imagestore.wsgi:application
+fi
@@ -1,5 +1,7 @@
 from django.contrib import admin
-from imagehostingapp.models import UploadedImages, ImageThumbnailSize, AccountTiers, Subscription
+from imagehostingapp.models import (
+    UploadedImages, ImageBlob, ImageThumbnailSize, AccountTiers, Subscription, UploadSession
+)
 # Register your models here.
 
 
@@ -8,12 +10,22 @@ class UploadedImagesAdmin(admin.ModelAdmin):
     search_fields = ('image_path', )
     exclude = ('image_name', )
     readonly_fields = ('image_uri', 'image_created_at',
-                       'image_temp_uri', 'image_uri_expiry_sec')
+                       'image_temp_uri', 'image_uri_expiry_sec',
+                       'image_temp_token', 'image_temp_expires_at',
+                       'image_width', 'image_height', 'image_format',
+                       'image_size', 'image_sha256', 'image_blob')
+
+
+@admin.register(ImageBlob)
+class ImageBlobAdmin(admin.ModelAdmin):
+    search_fields = ('sha256', )
+    readonly_fields = ('sha256', 'blob_path', 'blob_size', 'ref_count', 'created_at')
 
 
 @admin.register(ImageThumbnailSize)
 class ImageThumbnailSize(admin.ModelAdmin):
     search_fields = ('thumbnail_size_px', )
+    list_display = ('__str__', 'encoder_profile')
 
 
 @admin.register(AccountTiers)
@@ -24,3 +36,9 @@ class AccountTiers(admin.ModelAdmin):
 @admin.register(Subscription)
 class Subscription(admin.ModelAdmin):
     search_fields = ('user', )
+
+
+@admin.register(UploadSession)
+class UploadSession(admin.ModelAdmin):
+    search_fields = ('file_name', )
+    readonly_fields = ('session_id', 'created_at', 'updated_at')
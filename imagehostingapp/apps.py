@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class ImageHostingAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'imagehostingapp'
+
+    def ready(self):
+        # connect signal receivers
+        from imagehostingapp import signals  # noqa: F401
@@ -0,0 +1,228 @@
+"""
+Async views, routed instead of the DRF ones when ASYNC_VIEWS is set
+(ASGI deployment, uvicorn workers).
+
+Django 4.0 runs every sync view of an ASGI worker on one shared thread, so
+these views keep the slow parts off it: authentication and metadata lookups
+(ORM and cache, no async ORM yet) take a single thread-sensitive hop, while
+waiting on the thumbnail render pool and opening files run in the thread
+pool. The response body is then sent by imagestore.asgi, which awaits the
+client between chunks instead of holding a worker per slow reader.
+"""
+import logging
+
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
+
+from rest_framework import exceptions, status
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from imagehostingapp import entitlements, metadata_cache, serving, thumbnails
+from imagehostingapp.models import UploadedImages
+from imagehostingapp.pagination import ImageKeysetPagination
+from imagehostingapp.serializers import ListImagesSerializer
+from imagehostingapp.views import ListUploadImages
+
+
+def _authenticate(request):
+    """
+    Authenticate like the DRF views do, returns (api_request, error_response).
+    """
+    api_request = Request(request, authenticators=[
+        authentication_class()
+        for authentication_class in api_settings.DEFAULT_AUTHENTICATION_CLASSES
+    ])
+    try:
+        if api_request.user.is_authenticated:
+            return api_request, None
+        error = exceptions.NotAuthenticated()
+    except exceptions.APIException as exc:
+        error = exc
+    return api_request, JsonResponse({"detail": str(error.detail)},
+                                     status=status.HTTP_403_FORBIDDEN)
+
+
+def _error_response(message, status_code):
+    return JsonResponse({"error": message}, status=status_code)
+
+
+def _subscription_error(user_entitlements):
+    # Verify subscription status of auth user for retrieving original images
+    if not user_entitlements:
+        return _error_response("User is not subscribed to any plan.",
+                               status.HTTP_400_BAD_REQUEST)
+    if not user_entitlements.is_original_image_url_present:
+        return _error_response(
+            f"Downloading original image is not available in the "
+            f"{user_entitlements.tier_name} tier. Please Upgrade.",
+            status.HTTP_400_BAD_REQUEST
+        )
+
+
+def _get_user_image(request, image_id):
+    """
+    Returns (image_query_object, user_entitlements, error_response).
+    """
+    api_request, error_response = _authenticate(request)
+    if error_response:
+        return None, None, error_response
+    # Verify if the image UUID belongs to auth user
+    image_query_object = metadata_cache.get_user_image(api_request.user, image_id)
+    if not image_query_object:
+        return None, None, _error_response("Image does not belong to the user.",
+                                           status.HTTP_403_FORBIDDEN)
+    return image_query_object, entitlements.get_entitlements(api_request.user), None
+
+
+def _get_temp_image(request, image_temp_id):
+    """
+    Returns (image_query_object, user_entitlements, error_response).
+    """
+    api_request, error_response = _authenticate(request)
+    if error_response:
+        return None, None, error_response
+    # Verify the temp link belongs to auth user and is still valid, single index probe
+    temp_images = UploadedImages.objects.filter(
+        image_temp_token=image_temp_id, image_author=api_request.user
+    )
+    image_query_object = temp_images.filter(image_temp_expires_at__gt=timezone.now()).first()
+    if image_query_object:
+        return image_query_object, entitlements.get_entitlements(api_request.user), None
+    # misses only, tell an expired link apart
+    if temp_images.exists():
+        return None, None, _error_response("The temporary URL has been expired.",
+                                           status.HTTP_404_NOT_FOUND)
+    return None, None, _error_response("Image does not exist.",
+                                       status.HTTP_400_BAD_REQUEST)
+
+
+def _retrieve_image_thumbnail(request, image_query_obj, new_height, encoder_profiles):
+    output_format = thumbnails.negotiate_output_format(request.META.get('HTTP_ACCEPT', ''))
+    try:
+        thumbnail_path = thumbnails.get_or_create_thumbnail(
+            image_query_obj, new_height, encoder_profiles, output_format
+        )
+    except thumbnails.ThumbnailRenderUnavailable as exc:
+        response = _error_response(f"{exc} Please retry.", status.HTTP_503_SERVICE_UNAVAILABLE)
+        response['Retry-After'] = str(exc.retry_after)
+        return response
+    response = serving.serve_file(
+        request, thumbnail_path,
+        thumbnails.get_thumbnail_file_name(image_query_obj, new_height, output_format),
+        image_query_obj.image_created_at
+    )
+    # the encoding depends on Accept
+    patch_vary_headers(response, ('Accept',))
+    return response
+
+
+def _list_images(request):
+    api_request, error_response = _authenticate(request)
+    if error_response:
+        return error_response
+    queryset = UploadedImages.objects.filter(image_author=api_request.user).only(
+        'id', 'image_name', 'image_desc', 'image_created_at'
+    )
+    paginator = ImageKeysetPagination()
+    try:
+        page = paginator.paginate_queryset(queryset, api_request)
+    except exceptions.NotFound as exc:
+        return JsonResponse({"detail": str(exc.detail)}, status=status.HTTP_404_NOT_FOUND)
+    serializer = ListImagesSerializer(page, many=True)
+    return JsonResponse(paginator.get_paginated_response(serializer.data).data)
+
+
+# files and thumbnails do not touch the database, they may run in parallel
+_serve_image = sync_to_async(serving.serve_image, thread_sensitive=False)
+_serve_thumbnail = sync_to_async(_retrieve_image_thumbnail, thread_sensitive=False)
+
+_upload_image = ListUploadImages.as_view({'post': 'create'})
+
+
+async def list_upload_images(request):
+    """
+    List uploaded images, a page at a time. Uploads are handed to the DRF view.
+    """
+    if request.method != 'GET':
+        return await sync_to_async(_upload_image)(request)
+    logging.log(
+        level=logging.DEBUG,
+        msg=f"Client with IP {request.client_ip} accessing the async List Image API."
+    )
+    return await sync_to_async(_list_images)(request)
+
+
+# DRF views are exempt too, and authenticate sessions with CSRF checks
+list_upload_images.csrf_exempt = True
+
+
+async def download_image(request, image_id):
+    """
+    Download the original image
+    """
+    logging.log(
+        level=logging.DEBUG,
+        msg=f"Client with IP {request.client_ip} accessing the async Download Original Image API."
+    )
+    image_query_object, user_entitlements, error_response = \
+        await sync_to_async(_get_user_image)(request, image_id)
+    if error_response:
+        return error_response
+
+    error_response = _subscription_error(user_entitlements)
+    if error_response:
+        return error_response
+
+    return await _serve_image(request, image_query_object)
+
+
+async def download_image_thumbnail(request, image_id, thumbnail_size_px):
+    """
+    Download the image thumbnail
+    """
+    logging.log(
+        level=logging.DEBUG,
+        msg=f"Client with IP {request.client_ip} accessing the async Download Image Thumbnail API."
+    )
+    image_query_object, user_entitlements, error_response = \
+        await sync_to_async(_get_user_image)(request, image_id)
+    if error_response:
+        return error_response
+
+    # Verify subscription status of auth user for retrieving image thumbnails
+    if not user_entitlements:
+        return _error_response("User is not subscribed to any plan.",
+                               status.HTTP_400_BAD_REQUEST)
+    if thumbnail_size_px not in user_entitlements.thumbnail_sizes:
+        return _error_response(
+            f"Downloading image thumbnail of size {thumbnail_size_px} is not available in the "
+            f"{user_entitlements.tier_name} tier.",
+            status.HTTP_400_BAD_REQUEST
+        )
+
+    return await _serve_thumbnail(
+        request, image_query_object, thumbnail_size_px, user_entitlements.encoder_profiles
+    )
+
+
+async def download_temp_image(request, image_temp_id):
+    """
+    Download the image through temp URL
+    """
+    logging.log(
+        level=logging.DEBUG,
+        msg=f"Client with IP {request.client_ip} accessing the async Download Image Temp URL."
+    )
+    image_query_object, user_entitlements, error_response = \
+        await sync_to_async(_get_temp_image)(request, image_temp_id)
+    if error_response:
+        return error_response
+
+    error_response = _subscription_error(user_entitlements)
+    if error_response:
+        return error_response
+
+    return await _serve_image(request, image_query_object)
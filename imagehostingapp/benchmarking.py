@@ -0,0 +1,221 @@
+"""
+Helpers for the benchmark management commands.
+
+Every measurement runs in a freshly spawned process, so the peak RSS it
+reports belongs to that one workload and not to whatever the parent (or an
+earlier run) has allocated. Functions here stay free of Django, a spawned
+child imports only this module.
+"""
+import io
+import os
+import time
+import resource
+import tempfile
+import statistics
+import multiprocessing
+
+from PIL import Image
+
+from imagehostingapp import imaging
+
+
+# benchmark source when no image is given, a 24 MP camera sized JPEG
+SAMPLE_IMAGE_SIZE = (6000, 4000)
+
+
+def render_thumbnail_full_decode(img, height):
+    """
+    Rendering path before the resize engine: full resolution decode,
+    then LANCZOS down to the height.
+    """
+    current_width, _ = img.size
+    img.thumbnail((current_width, height), Image.LANCZOS)
+    return img
+
+
+RESIZE_METHODS = {
+    'full-decode': render_thumbnail_full_decode,
+    'engine': imaging.render_thumbnail,
+}
+
+
+def create_sample_image(image_path, size=SAMPLE_IMAGE_SIZE, image_format='JPEG'):
+    """
+    Write a noisy photo-like image, flat images decode unrealistically fast.
+    """
+    bands = [
+        Image.linear_gradient('L').resize(size),
+        Image.effect_noise(size, 12),
+        Image.radial_gradient('L').resize(size),
+    ]
+    Image.merge('RGB', bands).save(image_path, format=image_format, quality=90)
+    return image_path
+
+
+def create_sample_screenshot(image_path, size=(1600, 1000)):
+    """
+    Write a PNG with flat areas and hard edges, like UI screenshots and
+    diagrams, the PNG uploads that palette quantization is meant for.
+    """
+    img = Image.new('RGB', size, (246, 246, 246))
+    width, height = size
+    for row, top in enumerate(range(40, height, 60)):
+        band = Image.linear_gradient('L').resize((width - 80, 36)).convert('RGB')
+        img.paste(band if row % 3 == 0 else (60 + row * 7 % 160, 110, 200), (40, top, width - 40, top + 36))
+    img.save(image_path, format='PNG')
+    return image_path
+
+
+# source kinds of the thumbnail pipeline benchmark: (file format, mode)
+SOURCE_KINDS = {
+    'JPEG': ('JPEG', 'RGB'),
+    'PNG': ('PNG', 'RGB'),
+    'PNG-P': ('PNG', 'P'),
+    'PNG-RGBA': ('PNG', 'RGBA'),
+}
+
+
+def create_sample_source(image_path, size, source_kind):
+    """
+    Write a noisy photo-like image of one of SOURCE_KINDS.
+    """
+    img_format, mode = SOURCE_KINDS[source_kind]
+    if img_format == 'JPEG':
+        return create_sample_image(image_path, size, img_format)
+    with Image.open(create_sample_image(image_path, size, 'PNG')) as img_file:
+        img = img_file.convert('RGB')
+    if mode == 'P':
+        img = img.quantize(256)
+    elif mode == 'RGBA':
+        img.putalpha(Image.radial_gradient('L').resize(size))
+    img.save(image_path, format=img_format)
+    return image_path
+
+
+def get_peak_rss_bytes():
+    # Linux keeps ru_maxrss across exec, so a spawned child would report the
+    # parent's peak. VmHWM belongs to this process image only.
+    try:
+        with open('/proc/self/status') as proc_status:
+            for line in proc_status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak_rss if os.uname().sysname == 'Darwin' else peak_rss * 1024
+
+
+def _time_resize(method, image_path, height, repeat):
+    render = RESIZE_METHODS[method]
+    timings = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        with Image.open(image_path) as img_file:
+            render(img_file, height).tobytes()
+        timings.append(time.perf_counter() - started_at)
+    return timings, get_peak_rss_bytes()
+
+
+def run_isolated(func, *args):
+    """
+    Run func(*args) in a new spawned process and return its result.
+    """
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(func, args)
+
+
+def benchmark_resize(method, image_path, height, repeat=5):
+    """
+    Returns dict of timings (seconds) and peak RSS of the worker process.
+    """
+    timings, peak_rss = run_isolated(_time_resize, method, image_path, height, repeat)
+    return {
+        'method': method,
+        'height': height,
+        'median_sec': statistics.median(timings),
+        'min_sec': min(timings),
+        'peak_rss_bytes': peak_rss,
+    }
+
+
+def benchmark_encoders(image_path, height, img_format, encoder_profiles, repeat=5):
+    """
+    Returns [dict of encoded bytes and timings (seconds)] per encoder
+    profile for one thumbnail, rendered once. Run in this process, the
+    encoders do not allocate enough for peak RSS to tell them apart.
+    """
+    with Image.open(image_path) as img_file:
+        thumbnail = imaging.render_thumbnail(img_file, height)
+        thumbnail.load()
+    results = []
+    for encoder_profile in encoder_profiles:
+        timings = []
+        for _ in range(repeat):
+            output_file = io.BytesIO()
+            started_at = time.perf_counter()
+            imaging.encode_thumbnail(thumbnail, output_file, img_format, encoder_profile)
+            timings.append(time.perf_counter() - started_at)
+        results.append({
+            'encoder_profile': encoder_profile,
+            'format': img_format,
+            'height': height,
+            'bytes': output_file.tell(),
+            'median_sec': statistics.median(timings),
+        })
+    return results
+
+
+PIPELINE_STAGES = ('decode', 'resize', 'encode', 'write')
+
+
+def _time_pipeline(image_path, height, encoder_profile, repeat):
+    # the stages of imaging.create_thumbnails(), timed apart
+    stage_timings = {stage: [] for stage in PIPELINE_STAGES}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        thumbnail_path = os.path.join(temp_dir, 'thumbnail')
+        for _ in range(repeat):
+            started_at = time.perf_counter_ns()
+            with Image.open(image_path) as img_file:
+                img_format = img_file.format
+                imaging.draft_for_height(img_file, height)
+                img_file.load()
+                decoded_at = time.perf_counter_ns()
+                thumbnail = imaging.render_thumbnail(img_file, height)
+                resized_at = time.perf_counter_ns()
+            output_file = io.BytesIO()
+            imaging.encode_thumbnail(thumbnail, output_file, img_format, encoder_profile)
+            encoded_at = time.perf_counter_ns()
+            with open(thumbnail_path + '.tmp', 'wb') as thumbnail_file:
+                thumbnail_file.write(output_file.getbuffer())
+            os.replace(thumbnail_path + '.tmp', thumbnail_path)
+            written_at = time.perf_counter_ns()
+            for stage, stage_ns in zip(PIPELINE_STAGES, (
+                    decoded_at - started_at, resized_at - decoded_at,
+                    encoded_at - resized_at, written_at - encoded_at)):
+                stage_timings[stage].append(stage_ns)
+    return stage_timings, get_peak_rss_bytes()
+
+
+def benchmark_pipeline(image_path, height, encoder_profile, repeat=5):
+    """
+    Returns dict of median ns per source pixel by stage and in total, and
+    peak RSS of the worker process. Pillow allocates image memory outside
+    the Python allocator, peak RSS is what captures it.
+    """
+    with Image.open(image_path) as img_file:
+        source_pixels = img_file.size[0] * img_file.size[1]
+    stage_timings, peak_rss = run_isolated(_time_pipeline, image_path, height, encoder_profile, repeat)
+    ns_per_pixel = {
+        stage: statistics.median(timings) / source_pixels
+        for stage, timings in stage_timings.items()
+    }
+    total_timings = [sum(stage_ns) for stage_ns in zip(*stage_timings.values())]
+    ns_per_pixel['total'] = statistics.median(total_timings) / source_pixels
+    return {
+        'height': height,
+        'encoder_profile': encoder_profile,
+        'ns_per_pixel': ns_per_pixel,
+        'peak_rss_bytes': peak_rss,
+    }
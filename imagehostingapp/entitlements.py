@@ -0,0 +1,114 @@
+"""
+Cached subscription entitlements of a user.
+
+Upload and download paths only need to know what the user's tier allows:
+tier name, thumbnail sizes and their encoder profiles, original image URL and expiring links. That is
+read once per user and kept in the Django cache, fronted by a short lived
+in-process layer, so the hot path makes no tier queries in steady state.
+
+Entries are invalidated by signals on Subscription, AccountTiers and
+ImageThumbnailSize changes. Other worker processes may keep serving their
+in-process copy for up to ENTITLEMENTS_LOCAL_TIMEOUT seconds.
+"""
+import time
+from collections import namedtuple
+from threading import Lock
+
+from django.conf import settings
+from django.core.cache import cache
+
+from imagehostingapp.models import Subscription
+
+
+CACHE_KEY_PREFIX = "entitlements:v2"
+
+# cached for users without a subscription
+NOT_SUBSCRIBED = "not-subscribed"
+
+# in-process layer is cleared once it holds this many users
+LOCAL_MAX_ENTRIES = 10000
+
+
+Entitlements = namedtuple('Entitlements', (
+    'tier_name',
+    'thumbnail_sizes',
+    # {thumbnail_size_px: encoder profile}
+    'encoder_profiles',
+    'is_original_image_url_present',
+    'is_expiring_links_available',
+))
+
+_local_entitlements = {}
+_local_lock = Lock()
+
+
+def _cache_key(user_id):
+    return "{}:{}".format(CACHE_KEY_PREFIX, user_id)
+
+
+def _load_entitlements(user_id):
+    user_subscription = Subscription.objects.filter(
+        user_id=user_id
+    ).select_related('tier').first()
+    if not user_subscription:
+        return NOT_SUBSCRIBED
+    tier = user_subscription.tier
+    thumbnail_sizes = tier.thumbnail_sizes.order_by(
+        'thumbnail_size_px'
+    ).values_list('thumbnail_size_px', 'encoder_profile')
+    return Entitlements(
+        tier_name=tier.account_tier_name,
+        thumbnail_sizes=tuple(thumbnail_size_px for thumbnail_size_px, _ in thumbnail_sizes),
+        encoder_profiles=dict(thumbnail_sizes),
+        is_original_image_url_present=tier.is_original_image_url_present,
+        is_expiring_links_available=tier.is_expiring_links_available,
+    )
+
+
+def get_entitlements(user):
+    """
+    Return Entitlements of the user's tier, or None when not subscribed.
+    """
+    user_id = user.pk if hasattr(user, 'pk') else user
+    now = time.monotonic()
+    local_entry = _local_entitlements.get(user_id)
+    if local_entry and local_entry[0] > now:
+        entitlements = local_entry[1]
+    else:
+        cache_key = _cache_key(user_id)
+        entitlements = cache.get(cache_key)
+        if entitlements is None:
+            entitlements = _load_entitlements(user_id)
+            cache.set(cache_key, entitlements, settings.ENTITLEMENTS_CACHE_TIMEOUT)
+        with _local_lock:
+            if len(_local_entitlements) >= LOCAL_MAX_ENTRIES:
+                _local_entitlements.clear()
+            _local_entitlements[user_id] = (
+                now + settings.ENTITLEMENTS_LOCAL_TIMEOUT, entitlements
+            )
+    if entitlements == NOT_SUBSCRIBED:
+        return None
+    return entitlements
+
+
+def invalidate_users(user_ids):
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    with _local_lock:
+        for user_id in user_ids:
+            _local_entitlements.pop(user_id, None)
+    cache.delete_many([_cache_key(user_id) for user_id in user_ids])
+
+
+def invalidate_local():
+    with _local_lock:
+        _local_entitlements.clear()
+
+
+def invalidate_tiers(tier_ids):
+    invalidate_users(
+        Subscription.objects.filter(
+            tier_id__in=list(tier_ids)
+        ).values_list('user_id', flat=True)
+    )
@@ -0,0 +1,240 @@
+"""
+Thumbnail resize engine, free of Django so benchmarks can run it alone.
+
+A thumbnail is a large reduction, so decoding the source at full
+resolution is mostly wasted work:
+    JPEG:    Image.draft() asks the decoder for a DCT-domain downscale
+             (1/2, 1/4 or 1/8) that is still at least reducing_gap times
+             the target size, so the full image is never in memory.
+    others:  resize(reducing_gap=...) first shrinks by an integer factor
+             with reduce() (box averaging), then resamples the remainder.
+The resampling filter is picked by size class of the target height.
+
+Several sizes of one image are rendered as a cascade from a single decode,
+largest first, each size resized from the one before it.
+
+Thumbnails are encoded in the source format, or in one of VARIANT_FORMATS
+(AVIF, WebP) for clients that accept it, when the Pillow build can write it.
+Encoder settings come from the ENCODER_PROFILES entry picked per thumbnail
+size, "./manage.py benchencoders" compares them.
+
+render_job() is what the thumbnail process pool runs, so this module must
+stay importable in a bare spawned interpreter.
+"""
+import os
+import time
+import signal
+import hashlib
+import threading
+from functools import lru_cache
+from collections import namedtuple
+
+from PIL import Image
+
+try:
+    # AVIF encoder for Pillow builds without one
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pass
+
+
+READ_BLOCK_SIZE = 64 * 1024
+
+ImageFileMetadata = namedtuple('ImageFileMetadata', (
+    'format', 'width', 'height', 'size', 'sha256',
+))
+
+# decode and reduce() down to no less than this many times the target size
+REDUCING_GAP = 2.0
+
+# (largest target height, resampling filter), smallest first. Small
+# thumbnails are cheap whatever the filter, so they get the sharpest one.
+# Large previews are dominated by output pixels, bicubic costs less there
+# and looks the same after reduction.
+SIZE_CLASSES = (
+    (400, Image.LANCZOS),
+    (None, Image.BICUBIC),
+)
+
+
+# compact encodings offered besides the source format, most compact first
+VARIANT_FORMATS = ('AVIF', 'WEBP')
+
+# save() options by format, and "palette_max_height": PNG thumbnails up to
+# that height are quantized to 256 colours
+ENCODER_PROFILES = {
+    # Pillow defaults, what thumbnails were saved with before profiles
+    'pillow-default': {},
+    'balanced': {
+        'JPEG': {'quality': 75, 'progressive': True, 'optimize': True, 'subsampling': '4:2:0'},
+        'PNG': {'optimize': True},
+        'WEBP': {'quality': 80, 'method': 4},
+        'AVIF': {'quality': 60, 'speed': 6},
+    },
+    'compact': {
+        'JPEG': {'quality': 70, 'progressive': True, 'optimize': True, 'subsampling': '4:2:0'},
+        'PNG': {'optimize': True},
+        'WEBP': {'quality': 70, 'method': 6},
+        'AVIF': {'quality': 50, 'speed': 4},
+        'palette_max_height': 400,
+    },
+    'high': {
+        'JPEG': {'quality': 90, 'progressive': True, 'optimize': True, 'subsampling': '4:4:4'},
+        'PNG': {'compress_level': 6},
+        'WEBP': {'quality': 90, 'method': 4},
+        'AVIF': {'quality': 75, 'speed': 6},
+    },
+}
+DEFAULT_ENCODER_PROFILE = 'balanced'
+
+
+@lru_cache(maxsize=None)
+def is_format_supported(img_format):
+    Image.init()
+    return img_format in Image.SAVE
+
+
+def get_resampling_filter(height):
+    for max_height, resample in SIZE_CLASSES:
+        if max_height is None or height <= max_height:
+            return resample
+
+
+def get_thumbnail_size(source_size, height):
+    """
+    Size of a thumbnail of given height, aspect ratio kept, never enlarged.
+    """
+    source_width, source_height = source_size
+    if height >= source_height:
+        return source_width, source_height
+    width = max(1, round(source_width * height / source_height))
+    return width, height
+
+
+def render_thumbnail(img, height):
+    """
+    Return a new image of the given height from an opened (not yet
+    loaded) image. The source image may be switched to draft mode.
+    """
+    return render_thumbnails(img, [height])[height]
+
+
+def draft_for_height(img, height):
+    """
+    Have a JPEG decoded at the smallest DCT scale still large enough for a
+    thumbnail of the height. No effect on other formats or loaded images.
+    """
+    if img.format == 'JPEG':
+        largest_size = get_thumbnail_size(img.size, height)
+        img.draft(None, (int(largest_size[0] * REDUCING_GAP), int(largest_size[1] * REDUCING_GAP)))
+
+
+def render_thumbnails(img, heights):
+    """
+    Return {height: image} for every height, decoding the opened image
+    once. Draft mode is sized for the largest thumbnail.
+    """
+    heights = sorted(set(heights), reverse=True)
+    if not heights:
+        return {}
+    # sizes follow the source aspect ratio, not the rounded previous size
+    source_size = img.size
+    draft_for_height(img, heights[0])
+    thumbnails = {}
+    previous = img
+    for height in heights:
+        target_size = get_thumbnail_size(source_size, height)
+        if previous.size == target_size:
+            thumbnails[height] = previous if previous is not img else img.copy()
+        else:
+            thumbnails[height] = previous.resize(
+                target_size, get_resampling_filter(target_size[1]), reducing_gap=REDUCING_GAP
+            )
+        previous = thumbnails[height]
+    return thumbnails
+
+
+def _convert_for_format(thumbnail, img_format):
+    # WebP and AVIF take RGB or RGBA only
+    if img_format not in VARIANT_FORMATS or thumbnail.mode in ('RGB', 'RGBA'):
+        return thumbnail
+    has_alpha = thumbnail.mode in ('LA', 'PA', 'La') or 'transparency' in thumbnail.info
+    return thumbnail.convert('RGBA' if has_alpha else 'RGB')
+
+
+def encode_thumbnail(thumbnail, output_file, img_format, encoder_profile=DEFAULT_ENCODER_PROFILE):
+    """
+    Write the thumbnail to a path or file object with the profile's
+    settings for the format.
+    """
+    profile = ENCODER_PROFILES[encoder_profile]
+    thumbnail = _convert_for_format(thumbnail, img_format)
+    if img_format == 'PNG' and thumbnail.mode in ('RGB', 'RGBA') and \
+            thumbnail.size[1] <= profile.get('palette_max_height', 0):
+        thumbnail = thumbnail.quantize(256, method=Image.Quantize.FASTOCTREE)
+    thumbnail.save(output_file, format=img_format, **profile.get(img_format, {}))
+
+
+def _save_thumbnail(thumbnail, thumbnail_path, img_format, encoder_profile):
+    os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
+    temp_path = "{}.{}-{}.tmp".format(thumbnail_path, os.getpid(), threading.get_ident())
+    encode_thumbnail(thumbnail, temp_path, img_format, encoder_profile)
+    os.replace(temp_path, thumbnail_path)
+
+
+def create_thumbnails(source_path, thumbnail_paths, output_format=None, encoder_profiles=None):
+    """
+    Render thumbnails {height: thumbnail_path} from a single decode of the
+    source, largest first, and store each atomically, so a partially
+    written file is never served. Encoded as output_format, or the
+    source format when None, with {height: encoder profile}.
+    """
+    encoder_profiles = encoder_profiles or {}
+    with Image.open(source_path) as img_file:
+        img_format = output_format or img_file.format
+        rendered_thumbnails = render_thumbnails(img_file, thumbnail_paths)
+        for height, thumbnail in rendered_thumbnails.items():
+            _save_thumbnail(
+                thumbnail, thumbnail_paths[height], img_format,
+                encoder_profiles.get(height, DEFAULT_ENCODER_PROFILE)
+            )
+    return thumbnail_paths
+
+
+def _raise_render_timeout(signum, frame):
+    raise TimeoutError("Thumbnail rendering timed out.")
+
+
+def render_job(source_path, thumbnail_paths, timeout_sec, output_format=None, encoder_profiles=None):
+    """
+    create_thumbnails() in a pool worker, aborted after timeout_sec so a
+    pathological image frees its worker for the next job. Returns the
+    render time in seconds.
+    """
+    previous_handler = signal.signal(signal.SIGALRM, _raise_render_timeout)
+    signal.alarm(timeout_sec)
+    try:
+        started_at = time.perf_counter()
+        create_thumbnails(source_path, thumbnail_paths, output_format, encoder_profiles)
+        return time.perf_counter() - started_at
+    finally:
+        signal.alarm(0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+
+def read_file_metadata(image_file):
+    """
+    Format, dimensions, byte size and SHA-256 of an open image file. The
+    bytes are read once for the checksum, Pillow only parses the header.
+    """
+    sha256 = hashlib.sha256()
+    size = 0
+    image_file.seek(0)
+    for block in iter(lambda: image_file.read(READ_BLOCK_SIZE), b''):
+        sha256.update(block)
+        size += len(block)
+    image_file.seek(0)
+    with Image.open(image_file) as img:
+        img_format, (width, height) = img.format, img.size
+    image_file.seek(0)
+    return ImageFileMetadata(img_format or '', width, height, size, sha256.hexdigest())
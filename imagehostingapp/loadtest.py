@@ -0,0 +1,276 @@
+"""
+End-to-end load test of the image API, run by "./manage.py loadtest".
+
+Synthetic users are subscribed to every account tier and upload synthetic
+PNG and JPEG images of several resolutions, then each workload (upload,
+list, original download, thumbnail, temp link) is driven by concurrent
+threads through the full Django handler with the test client, so latency
+covers middleware, DRF, the db, the caches and storage, but not a web
+server or the network. Every request records its status, latency and db
+query count. The report is JSON, compare it across releases with
+compare_reports().
+"""
+import io
+import os
+import time
+import random
+import datetime
+import threading
+import statistics
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+from faker import Faker
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client
+from django.urls import reverse
+
+from imagehostingapp import benchmarking, thumbnails
+from imagehostingapp.models import AccountTiers, Subscription, UploadedImages
+
+
+WORKLOADS = ('upload', 'list', 'original', 'thumbnail', 'temp-link')
+
+# (width, height) of the synthetic images, each as JPEG and PNG
+SAMPLE_RESOLUTIONS = ((640, 480), (1920, 1080), (4000, 3000))
+
+# longest allowed, temp links stay valid for the whole run
+TEMP_LINK_EXPIRY_SEC = 30000
+
+
+def create_sample_files(resolutions=SAMPLE_RESOLUTIONS):
+    """
+    [(file_name, content, content_type)], a photo-like JPEG and a
+    screenshot-like PNG per resolution.
+    """
+    sample_files = []
+    for width, height in resolutions:
+        jpeg_file, png_file = io.BytesIO(), io.BytesIO()
+        benchmarking.create_sample_image(jpeg_file, (width, height), 'JPEG')
+        benchmarking.create_sample_screenshot(png_file, (width, height))
+        sample_files.append(("sample_{}x{}.jpg".format(width, height), jpeg_file.getvalue(), 'image/jpeg'))
+        sample_files.append(("sample_{}x{}.png".format(width, height), png_file.getvalue(), 'image/png'))
+    return sample_files
+
+
+def create_users(users_per_tier, seed=0):
+    """
+    [user] subscribed to every account tier in turn.
+    """
+    fake = Faker()
+    fake.seed_instance(seed)
+    users = []
+    for account_tier in AccountTiers.objects.order_by('id'):
+        for _ in range(users_per_tier):
+            user = User.objects.create_user(fake.unique.user_name(), fake.email())
+            Subscription.objects.create(user=user, tier=account_tier)
+            users.append(user)
+    return users
+
+
+def get_rss_bytes(pid='self'):
+    try:
+        with open('/proc/{}/status'.format(pid)) as proc_status:
+            for line in proc_status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def get_render_workers_rss_bytes():
+    # thumbnail render pool processes are children of this one
+    return sum(get_rss_bytes(process.pid) for process in multiprocessing.active_children())
+
+
+def percentile(sorted_values, fraction):
+    # nearest rank
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))]
+
+
+class LoadTest(object):
+
+    def __init__(self, users, sample_files, concurrency=8, seed=0):
+        self.users = users
+        self.sample_files = sample_files
+        self.concurrency = concurrency
+        self.seed = seed
+        self.upload_url = reverse('list_upload_image-list')
+        # {user id: {'original': [url], 'thumbnail': [url], 'temp-link': [url]}}
+        self.user_urls = {user.id: {'original': [], 'thumbnail': [], 'temp-link': []} for user in users}
+        self._user_urls_lock = threading.Lock()
+        self._local = threading.local()
+
+    def _count_queries(self, execute, sql, params, many, context):
+        self._local.query_count += 1
+        return execute(sql, params, many, context)
+
+    def _get_client(self, user):
+        clients = self._local.__dict__.setdefault('clients', {})
+        if user.id not in clients:
+            clients[user.id] = Client()
+            clients[user.id].force_login(user)
+        return clients[user.id]
+
+    def _upload(self, client, user, rng):
+        file_name, content, content_type = rng.choice(self.sample_files)
+        # unique bytes after the end of the image, or every upload but the
+        # first is deduplicated to one blob and its thumbnails
+        content += os.urandom(16)
+        file = io.BytesIO(content)
+        file.name = file_name
+        file.content_type = content_type
+        response = client.post(self.upload_url, data={
+            'image_desc': 'load test image',
+            'image_path': file,
+            'image_uri_expiry_sec': TEMP_LINK_EXPIRY_SEC,
+        })
+        if response.status_code == 201:
+            response_json = response.json()
+            with self._user_urls_lock:
+                user_urls = self.user_urls[user.id]
+                for key, url in response_json.items():
+                    if key.startswith('image_url_thumbnail_'):
+                        user_urls['thumbnail'].append(url)
+                if 'image_url' in response_json:
+                    user_urls['original'].append(response_json['image_url'])
+                if 'image_temp_url' in response_json:
+                    user_urls['temp-link'].append(response_json['image_temp_url'])
+        return response
+
+    def _request(self, workload, rng):
+        if workload == 'upload':
+            user = rng.choice(self.users)
+            return self._upload(self._get_client(user), user, rng)
+        if workload == 'list':
+            return self._get_client(rng.choice(self.users)).get(self.upload_url)
+        # only users whose tier has the URL take part
+        users = [user for user in self.users if self.user_urls[user.id][workload]]
+        if not users:
+            return None
+        user = rng.choice(users)
+        response = self._get_client(user).get(rng.choice(self.user_urls[user.id][workload]))
+        if response.streaming:
+            # the whole file is sent, as to a client
+            for _ in response.streaming_content:
+                pass
+            response.close()
+        return response
+
+    def _run_worker(self, workload, request_count, worker_index):
+        rng = random.Random("{}-{}-{}".format(self.seed, workload, worker_index))
+        self._local.query_count = 0
+        samples = []
+        try:
+            # sessions are created before the clock starts
+            for user in self.users:
+                self._get_client(user)
+            with connection.execute_wrapper(self._count_queries):
+                for _ in range(request_count):
+                    self._local.query_count = 0
+                    started_at = time.perf_counter()
+                    response = self._request(workload, rng)
+                    if response is None:
+                        break
+                    samples.append((
+                        time.perf_counter() - started_at, response.status_code, self._local.query_count
+                    ))
+        finally:
+            # test database teardown waits for every connection
+            connection.close()
+        return samples
+
+    def seed_images(self, images_per_user):
+        """
+        Upload images_per_user images per user and render their tier
+        thumbnails, so download workloads have URLs and warm thumbnails.
+        """
+        rng = random.Random(self.seed)
+        for user in self.users:
+            client = self._get_client(user)
+            for _ in range(images_per_user):
+                self._upload(client, user, rng)
+        # pregenerated on upload, whatever is left is rendered here
+        thumbnails.wait_for_renders()
+        for uploaded_image in UploadedImages.objects.filter(image_author__in=self.users):
+            thumbnails.backfill_thumbnails(uploaded_image)
+
+    def run_workload(self, workload, request_count):
+        """
+        Dict of throughput, latency percentiles (ms), db queries per request
+        and RSS after request_count requests spread over the threads.
+        """
+        worker_requests = [
+            request_count // self.concurrency + (worker_index < request_count % self.concurrency)
+            for worker_index in range(self.concurrency)
+        ]
+        started_at = time.perf_counter()
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            worker_samples = list(executor.map(
+                self._run_worker, [workload] * self.concurrency,
+                worker_requests, range(self.concurrency)
+            ))
+        elapsed_sec = time.perf_counter() - started_at
+        samples = [sample for samples in worker_samples for sample in samples]
+        latencies = sorted(latency * 1000 for latency, _, _ in samples)
+        query_counts = [query_count for _, _, query_count in samples]
+        status_counts = {}
+        for _, status_code, _ in samples:
+            status_counts[str(status_code)] = status_counts.get(str(status_code), 0) + 1
+        return {
+            'requests': len(samples),
+            'errors': sum(1 for _, status_code, _ in samples if status_code >= 400),
+            'status_counts': status_counts,
+            'elapsed_sec': round(elapsed_sec, 3),
+            'throughput_rps': round(len(samples) / elapsed_sec, 2) if samples else 0.0,
+            'latency_ms': {
+                'p50': round(percentile(latencies, 0.50), 2),
+                'p95': round(percentile(latencies, 0.95), 2),
+                'p99': round(percentile(latencies, 0.99), 2),
+                'max': round(latencies[-1], 2) if latencies else 0.0,
+            },
+            'db_queries_per_request': {
+                'mean': round(statistics.mean(query_counts), 2) if query_counts else 0.0,
+                'max': max(query_counts, default=0),
+            },
+            'rss_bytes': get_rss_bytes(),
+            'render_workers_rss_bytes': get_render_workers_rss_bytes(),
+        }
+
+    def run(self, workloads, request_count):
+        report = {
+            'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'concurrency': self.concurrency,
+            'users': len(self.users),
+            'seed': self.seed,
+            'workloads': {},
+        }
+        for workload in workloads:
+            report['workloads'][workload] = self.run_workload(workload, request_count)
+            # thumbnails pregenerated for uploads would load the next workload
+            thumbnails.wait_for_renders()
+        report['peak_rss_bytes'] = benchmarking.get_peak_rss_bytes()
+        return report
+
+
+def compare_reports(report, baseline):
+    """
+    [(workload, throughput change, p95 latency change)], changes as
+    fractions of the baseline, for workloads in both reports.
+    """
+    comparison = []
+    for workload, result in report['workloads'].items():
+        baseline_result = baseline.get('workloads', {}).get(workload)
+        if not baseline_result or not baseline_result['throughput_rps'] or \
+                not baseline_result['latency_ms']['p95']:
+            continue
+        comparison.append((
+            workload,
+            result['throughput_rps'] / baseline_result['throughput_rps'] - 1,
+            result['latency_ms']['p95'] / baseline_result['latency_ms']['p95'] - 1,
+        ))
+    return comparison
@@ -0,0 +1,83 @@
+import time
+import logging
+
+from django.db import transaction
+from django.db.models import F
+from django.core.management.base import BaseCommand
+
+from imagehostingapp import metadata_cache
+from imagehostingapp.models import ImageBlob, UploadedImages
+
+
+class Command(BaseCommand):
+
+    help = 'Moves images uploaded before deduplication onto content-addressed blobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Rows read per query.'
+        )
+        parser.add_argument(
+            '--grace-sec', type=float, default=10,
+            help='Duplicate files are removed this long after their rows point at the blob, '
+                 'so downloads in flight can finish.'
+        )
+
+    def handle(self, *args, **options):
+        # checksums come from "./manage.py backfillimagemetadata", run it first
+        pending_images = UploadedImages.objects.filter(
+            image_blob__isnull=True
+        ).exclude(image_sha256='').order_by('id').values_list(
+            'id', 'image_id', 'image_author_id', 'image_path', 'image_size', 'image_sha256'
+        )
+        storage = UploadedImages._meta.get_field('image_path').storage
+        last_id = linked_count = removed_count = 0
+        while True:
+            batch = list(pending_images.filter(id__gt=last_id)[:options['batch_size']])
+            if not batch:
+                break
+            duplicate_paths = []
+            for image_pk, image_id, image_author_id, image_path, image_size, image_sha256 in batch:
+                last_id = image_pk
+                with transaction.atomic():
+                    image_blob = ImageBlob.objects.select_for_update().filter(
+                        sha256=image_sha256
+                    ).first()
+                    if image_blob is None:
+                        # first copy of the bytes becomes the blob where it is
+                        image_blob = ImageBlob.objects.create(
+                            sha256=image_sha256, blob_path=image_path,
+                            blob_size=image_size, ref_count=1
+                        )
+                    else:
+                        ImageBlob.objects.filter(pk=image_blob.pk).update(
+                            ref_count=F('ref_count') + 1
+                        )
+                    UploadedImages.objects.filter(pk=image_pk).update(
+                        image_blob=image_blob, image_path=image_blob.blob_path.name
+                    )
+                # update() sends no signals
+                metadata_cache.invalidate_user_image(image_author_id, image_id)
+                linked_count += 1
+                if image_path != image_blob.blob_path.name:
+                    duplicate_paths.append(image_path)
+            removed_count += self.remove_after_grace(storage, duplicate_paths, options['grace_sec'])
+        print('Linked %s images to blobs, removed %s duplicate files' % (linked_count, removed_count))
+
+    @staticmethod
+    def remove_after_grace(storage, duplicate_paths, grace_sec):
+        if duplicate_paths:
+            time.sleep(grace_sec)
+        removed_count = 0
+        for duplicate_path in duplicate_paths:
+            try:
+                storage.delete(duplicate_path)
+            except OSError as exc:
+                logging.log(
+                    level=logging.ERROR,
+                    msg=f"Duplicate image file {duplicate_path} not removed. error: {exc}"
+                )
+                continue
+            removed_count += 1
+        return removed_count
@@ -0,0 +1,52 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from imagehostingapp import imaging, metadata_cache
+from imagehostingapp.models import UploadedImages
+
+
+class Command(BaseCommand):
+
+    help = 'Fills in dimensions, format, byte size and checksum of images uploaded before they were stored'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Rows read per query.'
+        )
+
+    def handle(self, *args, **options):
+        # plain values, rows are only updated
+        pending_images = UploadedImages.objects.filter(image_sha256='').order_by('id').values_list(
+            'id', 'image_id', 'image_author_id', 'image_path'
+        )
+        storage = UploadedImages._meta.get_field('image_path').storage
+        last_id = updated_count = failed_count = 0
+        while True:
+            batch = list(pending_images.filter(id__gt=last_id)[:options['batch_size']])
+            if not batch:
+                break
+            for image_pk, image_id, image_author_id, image_path in batch:
+                last_id = image_pk
+                try:
+                    with storage.open(image_path, 'rb') as image_file:
+                        image_metadata = imaging.read_file_metadata(image_file)
+                except OSError as exc:
+                    logging.log(
+                        level=logging.ERROR,
+                        msg=f"Image metadata backfill failed for {image_path}. error: {exc}"
+                    )
+                    failed_count += 1
+                    continue
+                UploadedImages.objects.filter(pk=image_pk).update(
+                    image_format=image_metadata.format,
+                    image_width=image_metadata.width,
+                    image_height=image_metadata.height,
+                    image_size=image_metadata.size,
+                    image_sha256=image_metadata.sha256,
+                )
+                # update() sends no signals
+                metadata_cache.invalidate_user_image(image_author_id, image_id)
+                updated_count += 1
+        print('Updated %s images, %s failed' % (updated_count, failed_count))
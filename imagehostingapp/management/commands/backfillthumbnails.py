@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from imagehostingapp import thumbnails
+from imagehostingapp.models import UploadedImages
+
+
+class Command(BaseCommand):
+
+    help = 'Renders the missing tier thumbnails of uploaded images, one decode per image'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user', default=None,
+            help='Only images uploaded by this username.'
+        )
+
+    def handle(self, *args, **options):
+        uploaded_images = UploadedImages.objects.only(
+            'id', 'image_id', 'image_author_id', 'image_path', 'image_sha256'
+        ).order_by('id')
+        if options['user']:
+            uploaded_images = uploaded_images.filter(image_author__username=options['user'])
+        images_count = thumbnails_count = 0
+        for uploaded_image in uploaded_images.iterator():
+            thumbnails_count += thumbnails.backfill_thumbnails(uploaded_image)
+            images_count += 1
+        print('Rendered %s thumbnails for %s images' % (thumbnails_count, images_count))
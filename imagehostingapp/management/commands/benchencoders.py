@@ -0,0 +1,63 @@
+import os
+import tempfile
+
+from django.core.management.base import BaseCommand
+
+from imagehostingapp import imaging
+from imagehostingapp.benchmarking import benchmark_encoders, create_sample_image, create_sample_screenshot
+
+
+class Command(BaseCommand):
+
+    help = 'Compares thumbnail encoder profiles by bytes saved and encode time'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--image', action='append', default=[],
+            help='Source image, may be repeated. Defaults to a generated photo JPEG and screenshot PNG.'
+        )
+        parser.add_argument(
+            '--height', type=int, action='append', default=[],
+            help='Thumbnail height, may be repeated. Defaults to 200, 400 and 1000.'
+        )
+        parser.add_argument(
+            '--format', action='append', default=[],
+            help='Output format, may be repeated. Defaults to the source format.'
+        )
+        parser.add_argument(
+            '--repeat', type=int, default=5,
+            help='Encodes per measurement, the median is reported.'
+        )
+
+    def handle(self, *args, **options):
+        heights = options['height'] or [200, 400, 1000]
+        encoder_profiles = list(imaging.ENCODER_PROFILES)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            image_paths = options['image'] or [
+                create_sample_image(os.path.join(temp_dir, 'sample_photo.jpg'), size=(3000, 2000)),
+                create_sample_screenshot(os.path.join(temp_dir, 'sample_screenshot.png')),
+            ]
+            print('%-24s %-6s %7s %-15s %10s %9s %10s' % (
+                'image', 'format', 'height', 'profile', 'bytes', 'saved', 'median ms'
+            ))
+            for image_path in image_paths:
+                img_formats = options['format'] or [
+                    'JPEG' if image_path.lower().endswith(('.jpg', '.jpeg')) else 'PNG'
+                ]
+                for img_format in img_formats:
+                    if not imaging.is_format_supported(img_format):
+                        print('%s is not supported by this Pillow build, skipped' % img_format)
+                        continue
+                    for height in heights:
+                        results = benchmark_encoders(
+                            image_path, height, img_format, encoder_profiles, options['repeat']
+                        )
+                        # savings against what thumbnails were encoded with before profiles
+                        baseline_bytes = results[0]['bytes']
+                        for result in results:
+                            print('%-24s %-6s %7d %-15s %10d %8.1f%% %10.1f' % (
+                                os.path.basename(image_path)[:24], img_format, height,
+                                result['encoder_profile'], result['bytes'],
+                                100 * (1 - result['bytes'] / baseline_bytes),
+                                result['median_sec'] * 1000
+                            ))
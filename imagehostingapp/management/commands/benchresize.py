@@ -0,0 +1,45 @@
+import os
+import tempfile
+
+from django.core.management.base import BaseCommand
+
+from imagehostingapp.benchmarking import (
+    RESIZE_METHODS, benchmark_resize, create_sample_image, get_peak_rss_bytes, run_isolated
+)
+
+
+class Command(BaseCommand):
+
+    help = 'Compares thumbnail resize paths by time and peak RSS'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--image', action='append', default=[],
+            help='Source image, may be repeated. Defaults to a generated 24 MP JPEG.'
+        )
+        parser.add_argument(
+            '--height', type=int, action='append', default=[],
+            help='Thumbnail height, may be repeated. Defaults to 200, 400 and 1000.'
+        )
+        parser.add_argument(
+            '--repeat', type=int, default=5,
+            help='Renders per measurement, the median is reported.'
+        )
+
+    def handle(self, *args, **options):
+        heights = options['height'] or [200, 400, 1000]
+        with tempfile.TemporaryDirectory() as temp_dir:
+            image_paths = options['image'] or [
+                create_sample_image(os.path.join(temp_dir, 'sample_24mp.jpg'))
+            ]
+            idle_rss = run_isolated(get_peak_rss_bytes)
+            print('Idle worker peak RSS %.1f MB' % (idle_rss / 2 ** 20))
+            print('%-24s %-12s %7s %12s %14s' % ('image', 'method', 'height', 'median ms', 'peak RSS MB'))
+            for image_path in image_paths:
+                for height in heights:
+                    for method in RESIZE_METHODS:
+                        result = benchmark_resize(method, image_path, height, options['repeat'])
+                        print('%-24s %-12s %7d %12.1f %14.1f' % (
+                            os.path.basename(image_path)[:24], method, height,
+                            result['median_sec'] * 1000, result['peak_rss_bytes'] / 2 ** 20
+                        ))
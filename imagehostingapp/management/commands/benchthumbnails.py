@@ -0,0 +1,146 @@
+import os
+import json
+import platform
+import tempfile
+
+import PIL
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from imagehostingapp import imaging
+from imagehostingapp.benchmarking import SOURCE_KINDS, benchmark_pipeline, create_sample_source
+from imagehostingapp.models import ImageThumbnailSize
+
+
+DEFAULT_BASELINE_PATH = os.path.join(settings.BASE_DIR, 'benchmarks', 'thumbnails.json')
+
+DEFAULT_SOURCE_SIZES = ['1024x768', '4000x3000']
+
+
+def parse_size(size):
+    width, _, height = size.partition('x')
+    if not width.isdigit() or not height.isdigit():
+        raise CommandError(f"Invalid source size {size!r}, expected WIDTHxHEIGHT.")
+    return int(width), int(height)
+
+
+class Command(BaseCommand):
+
+    help = 'Benchmarks thumbnail decode, resize, encode and write, and fails on regressions against a baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--source-size', action='append', default=[],
+            help='Source image WIDTHxHEIGHT, may be repeated. Defaults to 1024x768 and 4000x3000.'
+        )
+        parser.add_argument(
+            '--source-kind', action='append', choices=list(SOURCE_KINDS), default=[],
+            help='Source format and mode, may be repeated. Defaults to all of them.'
+        )
+        parser.add_argument(
+            '--height', type=int, action='append', default=[],
+            help='Thumbnail height, may be repeated. Defaults to every configured thumbnail size.'
+        )
+        parser.add_argument(
+            '--repeat', type=int, default=5,
+            help='Renders per measurement, the median is reported.'
+        )
+        parser.add_argument(
+            '--baseline', default=DEFAULT_BASELINE_PATH,
+            help='Baseline JSON to compare against.'
+        )
+        parser.add_argument(
+            '--tolerance', type=float, default=0.25,
+            help='Allowed slowdown or peak RSS growth over the baseline, as a fraction.'
+        )
+        parser.add_argument(
+            '--update-baseline', action='store_true',
+            help='Write the results as the new baseline instead of comparing.'
+        )
+
+    def get_thumbnail_sizes(self, options):
+        if options['height']:
+            return [(height, imaging.DEFAULT_ENCODER_PROFILE) for height in options['height']]
+        return list(ImageThumbnailSize.objects.order_by(
+            'thumbnail_size_px', 'encoder_profile'
+        ).values_list('thumbnail_size_px', 'encoder_profile').distinct())
+
+    def handle(self, *args, **options):
+        source_sizes = [parse_size(size) for size in options['source_size'] or DEFAULT_SOURCE_SIZES]
+        thumbnail_sizes = self.get_thumbnail_sizes(options)
+        if not thumbnail_sizes:
+            raise CommandError("No thumbnail sizes configured, pass --height.")
+        results = {}
+        print('%-36s %8s %8s %8s %8s %8s %10s' % (
+            'case', 'decode', 'resize', 'encode', 'write', 'total', 'peak MB'
+        ))
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for source_kind in options['source_kind'] or list(SOURCE_KINDS):
+                for width, height in source_sizes:
+                    extension = '.jpg' if SOURCE_KINDS[source_kind][0] == 'JPEG' else '.png'
+                    image_path = create_sample_source(
+                        os.path.join(temp_dir, '{}-{}x{}{}'.format(source_kind, width, height, extension)),
+                        (width, height), source_kind
+                    )
+                    for thumbnail_size_px, encoder_profile in thumbnail_sizes:
+                        case = '{}-{}x{}-{}px-{}'.format(
+                            source_kind, width, height, thumbnail_size_px, encoder_profile
+                        )
+                        result = benchmark_pipeline(
+                            image_path, thumbnail_size_px, encoder_profile, options['repeat']
+                        )
+                        results[case] = {
+                            'ns_per_pixel': {
+                                stage: round(ns_per_pixel, 3)
+                                for stage, ns_per_pixel in result['ns_per_pixel'].items()
+                            },
+                            'peak_rss_bytes': result['peak_rss_bytes'],
+                        }
+                        ns_per_pixel = result['ns_per_pixel']
+                        print('%-36s %8.2f %8.2f %8.2f %8.2f %8.2f %10.1f' % (
+                            case, ns_per_pixel['decode'], ns_per_pixel['resize'],
+                            ns_per_pixel['encode'], ns_per_pixel['write'], ns_per_pixel['total'],
+                            result['peak_rss_bytes'] / 2 ** 20
+                        ))
+        print('ns per source pixel, medians of %s renders' % options['repeat'])
+
+        if options['update_baseline']:
+            os.makedirs(os.path.dirname(options['baseline']), exist_ok=True)
+            with open(options['baseline'], 'w') as baseline_file:
+                json.dump({
+                    # timings only compare on the machine that recorded them
+                    'machine': platform.machine(),
+                    'python': platform.python_version(),
+                    'pillow': PIL.__version__,
+                    'repeat': options['repeat'],
+                    'cases': results,
+                }, baseline_file, indent=2, sort_keys=True)
+                baseline_file.write('\n')
+            print('Baseline written to %s' % options['baseline'])
+            return
+        if not os.path.exists(options['baseline']):
+            print('No baseline at %s, nothing compared' % options['baseline'])
+            return
+        with open(options['baseline']) as baseline_file:
+            baseline = json.load(baseline_file)
+        self.check_regressions(results, baseline, options['tolerance'])
+
+    def check_regressions(self, results, baseline, tolerance):
+        print('Compared with the baseline of Pillow %s, Python %s' % (baseline['pillow'], baseline['python']))
+        regressions = []
+        for case, result in results.items():
+            baseline_result = baseline['cases'].get(case)
+            if not baseline_result:
+                print('%-36s not in the baseline' % case)
+                continue
+            for metric, value, baseline_value in (
+                    ('ns/pixel', result['ns_per_pixel']['total'], baseline_result['ns_per_pixel']['total']),
+                    ('peak RSS', result['peak_rss_bytes'], baseline_result['peak_rss_bytes'])):
+                if baseline_value and value > baseline_value * (1 + tolerance):
+                    regressions.append(case)
+                    print('%-36s %s regressed %+.1f%%' % (case, metric, (value / baseline_value - 1) * 100))
+        if regressions:
+            raise CommandError('%s of %s cases regressed by more than %.0f%%' % (
+                len(set(regressions)), len(results), tolerance * 100
+            ))
+        print('No regressions over %.0f%% in %s cases' % (tolerance * 100, len(results)))
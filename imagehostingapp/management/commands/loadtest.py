@@ -0,0 +1,105 @@
+import json
+import os
+import sys
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test.utils import (
+    override_settings, setup_databases, setup_test_environment, teardown_databases,
+    teardown_test_environment
+)
+
+from imagehostingapp import entitlements, thumbnails
+from imagehostingapp.loadtest import WORKLOADS, LoadTest, compare_reports, create_sample_files, create_users
+
+
+class Command(BaseCommand):
+
+    help = 'Load tests the image API in this process, against a test database and a temporary media root'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workload', action='append', choices=WORKLOADS, default=[],
+            help='Workload to run, may be repeated. Defaults to all of them.'
+        )
+        parser.add_argument(
+            '--requests', type=int, default=200,
+            help='Requests per workload.'
+        )
+        parser.add_argument(
+            '--concurrency', type=int, default=8,
+            help='Threads sending requests at once.'
+        )
+        parser.add_argument(
+            '--users-per-tier', type=int, default=4,
+            help='Synthetic users subscribed to each account tier.'
+        )
+        parser.add_argument(
+            '--images-per-user', type=int, default=3,
+            help='Images uploaded per user before the workloads run.'
+        )
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help='Seeds users, images and request order, for comparable runs.'
+        )
+        parser.add_argument(
+            '--output', default='',
+            help='Write the JSON report to this file instead of stdout.'
+        )
+        parser.add_argument(
+            '--baseline', default='',
+            help='JSON report of an earlier run, throughput and p95 changes are printed.'
+        )
+        parser.add_argument(
+            '--keepdb', action='store_true',
+            help='Keep the test database between runs.'
+        )
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False, keepdb=options['keepdb'])
+        try:
+            with tempfile.TemporaryDirectory() as media_root:
+                report = self.run_load_test(media_root, options)
+        finally:
+            teardown_databases(old_config, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+        report_json = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as report_file:
+                report_file.write(report_json + '\n')
+        else:
+            print(report_json)
+        if options['baseline']:
+            with open(options['baseline']) as baseline_file:
+                baseline = json.load(baseline_file)
+            # the report may be on stdout
+            for workload, throughput_change, p95_change in compare_reports(report, baseline):
+                sys.stderr.write('%-10s throughput %+6.1f%%  p95 latency %+6.1f%%\n' % (
+                    workload, throughput_change * 100, p95_change * 100
+                ))
+
+    def run_load_test(self, media_root, options):
+        # test users get ids of real ones, their cache entries must not mix
+        caches = {
+            alias: dict(config, KEY_PREFIX='loadtest' + config.get('KEY_PREFIX', ''))
+            for alias, config in settings.CACHES.items()
+        }
+        with override_settings(
+            DEBUG=False, CACHES=caches, MEDIA_ROOT=media_root, MEDIA_VOLUMES=[],
+            UPLOAD_STAGING_ROOT=os.path.join(media_root, 'staging'),
+            THUMBNAIL_STORE_ROOT=os.path.join(media_root, 'thumbnails'),
+        ):
+            entitlements.invalidate_local()
+            try:
+                load_test = LoadTest(
+                    create_users(options['users_per_tier'], options['seed']),
+                    create_sample_files(), options['concurrency'], options['seed']
+                )
+                load_test.seed_images(options['images_per_user'])
+                return load_test.run(options['workload'] or WORKLOADS, options['requests'])
+            finally:
+                # renders still queued read from the media root removed next
+                thumbnails.wait_for_renders()
+                entitlements.invalidate_local()
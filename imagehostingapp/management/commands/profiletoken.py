@@ -0,0 +1,15 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from imagestore import profiling
+
+
+class Command(BaseCommand):
+
+    help = 'Creates a token for the X-Imagestore-Profile header, profiling the requests carrying it'
+
+    def handle(self, *args, **options):
+        print(profiling.create_token())
+        print('Valid for %s seconds, e.g. curl -H "X-Imagestore-Profile: <token>" ...' % (
+            settings.PROFILING_TOKEN_MAX_AGE_SEC
+        ))
@@ -0,0 +1,96 @@
+import os
+import time
+import shutil
+import logging
+
+from django.core.management.base import BaseCommand
+
+from imagehostingapp.models import UploadedImages
+
+
+# partially copied files, left by an interrupted run
+TEMP_SUFFIX = '.rebalance.tmp'
+
+
+class Command(BaseCommand):
+
+    help = 'Moves image files to the volume owning them, after MEDIA_VOLUMES changed'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only count the files and bytes that would move.'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Files moved before their old copies are removed.'
+        )
+        parser.add_argument(
+            '--grace-sec', type=float, default=10,
+            help='Old copies are removed this long after the new ones are in place, '
+                 'so downloads in flight can finish.'
+        )
+
+    def handle(self, *args, **options):
+        storage = UploadedImages._meta.get_field('image_path').storage
+        moved_count = moved_bytes = kept_count = 0
+        moved_paths = []
+        # copies made by this run, found again when walking their volume
+        copied_paths = set()
+        for volume, volume_root in storage.volumes.items():
+            for folder, _, file_names in os.walk(os.path.join(volume_root, 'user_images')):
+                for file_name in file_names:
+                    source_path = os.path.join(folder, file_name)
+                    if file_name.endswith(TEMP_SUFFIX):
+                        os.remove(source_path)
+                        continue
+                    if source_path in copied_paths:
+                        continue
+                    name = os.path.relpath(source_path, volume_root).replace(os.sep, '/')
+                    owner = storage.get_volume(name)
+                    if owner == volume:
+                        kept_count += 1
+                        continue
+                    moved_count += 1
+                    moved_bytes += os.path.getsize(source_path)
+                    if options['dry_run']:
+                        continue
+                    target_path = storage.get_volume_path(owner, name)
+                    try:
+                        self.copy_file(source_path, target_path)
+                    except OSError as exc:
+                        logging.log(
+                            level=logging.ERROR,
+                            msg=f"Could not move {name} to volume {owner}. error: {exc}"
+                        )
+                        continue
+                    copied_paths.add(target_path)
+                    moved_paths.append(source_path)
+                    if len(moved_paths) >= options['batch_size']:
+                        self.remove_after_grace(moved_paths, options['grace_sec'])
+                        moved_paths = []
+        self.remove_after_grace(moved_paths, options['grace_sec'])
+        print('%s %s files (%.1f MB), %s already in place' % (
+            'Would move' if options['dry_run'] else 'Moved',
+            moved_count, moved_bytes / 2 ** 20, kept_count
+        ))
+
+    @staticmethod
+    def copy_file(source_path, target_path):
+        # the owner is looked at first, the new copy only shows up complete
+        if os.path.exists(target_path):
+            return
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        temp_path = target_path + TEMP_SUFFIX
+        shutil.copy2(source_path, temp_path)
+        os.replace(temp_path, target_path)
+
+    @staticmethod
+    def remove_after_grace(moved_paths, grace_sec):
+        if moved_paths:
+            time.sleep(grace_sec)
+        for moved_path in moved_paths:
+            try:
+                os.remove(moved_path)
+            except FileNotFoundError:
+                pass
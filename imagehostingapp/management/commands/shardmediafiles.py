@@ -0,0 +1,193 @@
+import os
+import time
+import errno
+import shutil
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.core.management.base import BaseCommand
+
+from imagehostingapp import metadata_cache, sharding
+from imagehostingapp.models import ImageBlob, UploadedImages, get_blob_path
+from imagehostingapp.thumbnail_store import get_thumbnail_store
+
+
+def link_file(source_path, target_path):
+    """
+    Hard link source at target, so both names serve it until the old one
+    is removed. False when target is taken by another file.
+    """
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    try:
+        os.link(source_path, target_path)
+    except FileExistsError:
+        # linked by an interrupted run
+        return os.path.samefile(source_path, target_path)
+    except OSError as exc:
+        # the new name belongs to another media volume
+        if exc.errno != errno.EXDEV:
+            raise
+        temp_path = target_path + '.shard.tmp'
+        shutil.copy2(source_path, temp_path)
+        os.replace(temp_path, target_path)
+    return True
+
+
+class Command(BaseCommand):
+
+    help = 'Moves images and thumbnails into hash-prefix directories, while the service keeps serving'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Rows read and files moved per batch.'
+        )
+        parser.add_argument(
+            '--grace-sec', type=float, default=10,
+            help='Old names are removed this long after the rows point at the new ones, '
+                 'so downloads in flight can finish.'
+        )
+
+    def handle(self, *args, **options):
+        self.storage = UploadedImages._meta.get_field('image_path').storage
+        self.batch_size = options['batch_size']
+        self.grace_sec = options['grace_sec']
+        # rows already at their sharded name are skipped, so an interrupted run resumes
+        blobs_count = self.move_blobs()
+        images_count = self.move_unlinked_images()
+        thumbnails_count = self.move_thumbnails()
+        print('Moved %s blobs, %s images and %s thumbnails' % (
+            blobs_count, images_count, thumbnails_count
+        ))
+
+    def move_blobs(self):
+        image_blobs = ImageBlob.objects.order_by('id').values_list('id', 'sha256', 'blob_path')
+        last_id = moved_count = 0
+        while True:
+            batch = list(image_blobs.filter(id__gt=last_id)[:self.batch_size])
+            if not batch:
+                break
+            moved_paths = []
+            for blob_pk, sha256, blob_path in batch:
+                last_id = blob_pk
+                target_name = get_blob_path(ImageBlob(sha256=sha256), blob_path)
+                if blob_path == target_name:
+                    continue
+                source_path, target_path = self.storage.path(blob_path), self.storage.path(target_name)
+                if not self.link_or_log(source_path, target_path):
+                    continue
+                with transaction.atomic():
+                    # uploads and deletes of the blob wait for the row lock
+                    if not ImageBlob.objects.select_for_update().filter(
+                            pk=blob_pk, blob_path=blob_path).exists():
+                        continue
+                    ImageBlob.objects.filter(pk=blob_pk).update(blob_path=target_name)
+                    blob_images = UploadedImages.objects.filter(image_blob_id=blob_pk)
+                    moved_images = list(blob_images.values_list('image_author_id', 'image_id'))
+                    blob_images.update(image_path=target_name)
+                for image_author_id, image_id in moved_images:
+                    metadata_cache.invalidate_user_image(image_author_id, image_id)
+                moved_paths.append(source_path)
+            moved_count += self.remove_after_grace(moved_paths)
+        return moved_count
+
+    def move_unlinked_images(self):
+        # uploaded before deduplication, see "./manage.py backfillimageblobs"
+        unlinked_images = UploadedImages.objects.filter(image_blob__isnull=True).order_by('id').values_list(
+            'id', 'image_id', 'image_author_id', 'image_path'
+        )
+        last_id = moved_count = 0
+        while True:
+            batch = list(unlinked_images.filter(id__gt=last_id)[:self.batch_size])
+            if not batch:
+                break
+            moved_paths = []
+            for image_pk, image_id, image_author_id, image_path in batch:
+                last_id = image_pk
+                target_name = sharding.get_sharded_name(
+                    "user_images", image_id, os.path.basename(image_path), settings.MEDIA_SHARD_LEVELS
+                )
+                if image_path == target_name:
+                    continue
+                source_path = self.storage.path(image_path)
+                if os.path.exists(self.storage.path(target_name)) and \
+                        not os.path.samefile(source_path, self.storage.path(target_name)):
+                    target_name = self.storage.get_available_name(target_name)
+                if not self.link_or_log(source_path, self.storage.path(target_name)):
+                    continue
+                UploadedImages.objects.filter(pk=image_pk, image_path=image_path).update(
+                    image_path=target_name
+                )
+                metadata_cache.invalidate_user_image(image_author_id, image_id)
+                moved_paths.append(source_path)
+            moved_count += self.remove_after_grace(moved_paths)
+        return moved_count
+
+    def find_misplaced_thumbnails(self, thumbnail_store):
+        """
+        (name, path) of thumbnail files stored flat or under another level
+        count, indexed or not: lookup() forgets the ones it can not find.
+        """
+        misplaced_thumbnails = []
+        store_root = os.path.normpath(thumbnail_store.root)
+        for folder, _, file_names in os.walk(store_root):
+            # the index files
+            if folder == store_root:
+                continue
+            for file_name in file_names:
+                # renders in progress
+                if file_name.endswith('.tmp'):
+                    continue
+                thumbnail_name = "{}/{}".format(os.path.basename(folder), file_name)
+                thumbnail_path = os.path.join(folder, file_name)
+                if thumbnail_path != os.path.normpath(thumbnail_store.path(thumbnail_name)):
+                    misplaced_thumbnails.append((thumbnail_name, thumbnail_path))
+        return misplaced_thumbnails
+
+    def move_thumbnails(self):
+        thumbnail_store = get_thumbnail_store()
+        misplaced_thumbnails = self.find_misplaced_thumbnails(thumbnail_store)
+        moved_count = 0
+        for offset in range(0, len(misplaced_thumbnails), self.batch_size):
+            moved_paths = []
+            for thumbnail_name, thumbnail_path in misplaced_thumbnails[offset:offset + self.batch_size]:
+                target_path = thumbnail_store.path(thumbnail_name)
+                if os.path.exists(target_path) and not os.path.samefile(thumbnail_path, target_path):
+                    # rendered again at its new path already
+                    moved_paths.append(thumbnail_path)
+                    continue
+                if self.link_or_log(thumbnail_path, target_path):
+                    # back in the index and the disk budget, if lookup() forgot it
+                    thumbnail_store.add(thumbnail_name)
+                    moved_paths.append(thumbnail_path)
+            moved_count += self.remove_after_grace(moved_paths)
+        return moved_count
+
+    def link_or_log(self, source_path, target_path):
+        try:
+            if link_file(source_path, target_path):
+                return True
+            message = "target is another file"
+        except OSError as exc:
+            message = exc
+        logging.log(
+            level=logging.ERROR,
+            msg=f"Could not move {source_path} to {target_path}. error: {message}"
+        )
+        return False
+
+    def remove_after_grace(self, moved_paths):
+        if moved_paths:
+            time.sleep(self.grace_sec)
+        for moved_path in moved_paths:
+            try:
+                os.remove(moved_path)
+            except FileNotFoundError:
+                pass
+            # per image thumbnail directories of the flat layout
+            try:
+                os.rmdir(os.path.dirname(moved_path))
+            except OSError:
+                pass
+        return len(moved_paths)
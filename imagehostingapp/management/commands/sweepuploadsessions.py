@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from imagehostingapp.uploads import sweep_upload_sessions
+
+
+class Command(BaseCommand):
+
+    help = 'Removes abandoned chunked upload sessions and their staging files'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-age', type=int, default=None,
+            help='Idle seconds after which a session is abandoned. '
+                 'Defaults to UPLOAD_SESSION_TTL_SEC.'
+        )
+
+    def handle(self, *args, **options):
+        swept_sessions = sweep_upload_sessions(options['max_age'])
+        print('Swept %s upload sessions' % swept_sessions)
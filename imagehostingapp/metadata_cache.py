@@ -0,0 +1,54 @@
+"""
+Per user image metadata cache.
+
+Download views only need a handful of columns to authorize a request and
+locate the file: ownership of the image, its stored path, name,
+timestamps, byte size and checksum. Those are cached for each (user, image) pair, the file bytes
+are always served from storage. Entries are invalidated explicitly, when
+the image is saved or deleted.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+from imagehostingapp.models import UploadedImages
+
+
+CACHE_KEY_PREFIX = "image_metadata:v3"
+
+# cached for images the user does not own, so probing foreign UUIDs stays cheap
+NOT_OWNED = "not-owned"
+
+# Model order, from_db() takes a subset of values in concrete field order.
+METADATA_FIELDS = tuple(
+    field.attname for field in UploadedImages._meta.concrete_fields
+    if field.attname in {
+        'id', 'image_id', 'image_author_id', 'image_name', 'image_path',
+        'image_uri_expiry_sec', 'image_created_at', 'image_size', 'image_sha256',
+    }
+)
+
+
+def _cache_key(user_id, image_id):
+    return "{}:{}:{}".format(CACHE_KEY_PREFIX, user_id, image_id)
+
+
+def get_user_image(user, image_id):
+    """
+    Return the image of the user with metadata fields loaded, or None
+    if the user does not own such an image. Other fields are deferred.
+    """
+    cache_key = _cache_key(user.pk, image_id)
+    metadata = cache.get(cache_key)
+    if metadata is None:
+        metadata = UploadedImages.objects.filter(
+            image_id=image_id, image_author=user
+        ).values_list(*METADATA_FIELDS).first() or NOT_OWNED
+        cache.set(cache_key, metadata, settings.IMAGE_METADATA_CACHE_TIMEOUT)
+    if metadata == NOT_OWNED:
+        return None
+    return UploadedImages.from_db(DEFAULT_DB_ALIAS, METADATA_FIELDS, metadata)
+
+
+def invalidate_user_image(user_id, image_id):
+    cache.delete(_cache_key(user_id, image_id))
@@ -0,0 +1,17 @@
+# Generated by Django 4.0.4 on 2026-10-17 20:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imagehostingapp', '0002_uploadedimages_image_temp_uri_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='uploadedimages',
+            index=models.Index(fields=['image_author', 'image_created_at', 'id'], name='uploaded_author_created_idx'),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 4.0.4 on 2026-10-17 20:38
+
+from datetime import timedelta
+
+from django.db import migrations, models
+
+
+def populate_image_temp_tokens(apps, schema_editor):
+    """
+    Move temp ids out of image_temp_uri and precompute link expiry.
+    Temp ids were never checked for collisions, later duplicates are dropped.
+    """
+    UploadedImages = apps.get_model('imagehostingapp', 'UploadedImages')
+
+    seen_tokens = set()
+    images_with_temp_uri = UploadedImages.objects.exclude(
+        image_temp_uri=''
+    ).order_by('id').only('id', 'image_temp_uri', 'image_created_at', 'image_uri_expiry_sec')
+    for uploaded_image in images_with_temp_uri.iterator():
+        image_temp_token = uploaded_image.image_temp_uri.rstrip('/').rsplit('/', 1)[-1]
+        if not image_temp_token or image_temp_token in seen_tokens:
+            continue
+        seen_tokens.add(image_temp_token)
+        UploadedImages.objects.filter(pk=uploaded_image.pk).update(
+            image_temp_token=image_temp_token,
+            image_temp_expires_at=uploaded_image.image_created_at +
+            timedelta(seconds=uploaded_image.image_uri_expiry_sec),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imagehostingapp', '0003_uploadedimages_author_created_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadedimages',
+            name='image_temp_expires_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Image temp link expires at'),
+        ),
+        migrations.AddField(
+            model_name='uploadedimages',
+            name='image_temp_token',
+            field=models.CharField(blank=True, default=None, max_length=16, null=True, unique=True, verbose_name='Image Temp Token'),
+        ),
+        migrations.RunPython(
+            populate_image_temp_tokens, migrations.RunPython.noop
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 4.0.4 on 2026-10-17 20:39
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('imagehostingapp', '0004_uploadedimages_image_temp_token'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('session_id', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('file_name', models.CharField(max_length=255, verbose_name='File Name')),
+                ('content_type', models.CharField(max_length=64, verbose_name='Content Type')),
+                ('total_size', models.BigIntegerField(verbose_name='Total Size (bytes)')),
+                ('chunk_size', models.IntegerField(verbose_name='Chunk Size (bytes)')),
+                ('image_desc', models.CharField(default='', max_length=255, verbose_name='Image Description')),
+                ('image_uri_expiry_sec', models.IntegerField(default=-1, verbose_name='Image temp link expire after seconds')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('updated_at', models.DateTimeField(auto_now=True, db_index=True)),
+                ('session_author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+                ('uploaded_image', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='imagehostingapp.uploadedimages')),
+            ],
+            options={
+                'verbose_name': 'Upload Session',
+            },
+        ),
+        migrations.CreateModel(
+            name='UploadChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chunk_index', models.IntegerField(verbose_name='Chunk Index')),
+                ('chunk_size', models.IntegerField(verbose_name='Chunk Size (bytes)')),
+                ('chunk_sha256', models.CharField(max_length=64, verbose_name='Chunk SHA-256')),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='imagehostingapp.uploadsession')),
+            ],
+            options={
+                'verbose_name': 'Upload Chunk',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='uploadchunk',
+            constraint=models.UniqueConstraint(fields=('session', 'chunk_index'), name='upload_chunk_unique_index'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.0.4 on 2026-10-17 20:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imagehostingapp', '0005_uploadsession_uploadchunk'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadedimages',
+            name='image_format',
+            field=models.CharField(blank=True, default='', max_length=16, verbose_name='Image Format'),
+        ),
+        migrations.AddField(
+            model_name='uploadedimages',
+            name='image_height',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='Image Height'),
+        ),
+        migrations.AddField(
+            model_name='uploadedimages',
+            name='image_sha256',
+            field=models.CharField(blank=True, default='', max_length=64, verbose_name='Image SHA-256'),
+        ),
+        migrations.AddField(
+            model_name='uploadedimages',
+            name='image_size',
+            field=models.BigIntegerField(blank=True, null=True, verbose_name='Image Size in Bytes'),
+        ),
+        migrations.AddField(
+            model_name='uploadedimages',
+            name='image_width',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='Image Width'),
+        ),
+    ]
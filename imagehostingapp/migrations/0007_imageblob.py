@@ -0,0 +1,35 @@
+# Generated by Django 4.0.4 on 2026-10-17 20:57
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import imagehostingapp.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imagehostingapp', '0006_uploadedimages_file_metadata'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True, verbose_name='SHA-256')),
+                ('blob_path', models.FileField(max_length=255, upload_to=imagehostingapp.models.get_blob_path, verbose_name='Blob File')),
+                ('blob_size', models.BigIntegerField(verbose_name='Blob Size in Bytes')),
+                ('ref_count', models.PositiveIntegerField(default=0, verbose_name='Reference Count')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'verbose_name': 'Image Blob',
+            },
+        ),
+        migrations.AddField(
+            model_name='uploadedimages',
+            name='image_blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='images', to='imagehostingapp.imageblob', verbose_name='Image Blob'),
+        ),
+    ]
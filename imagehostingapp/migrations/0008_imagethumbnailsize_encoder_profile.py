@@ -0,0 +1,18 @@
+# Generated by Django 4.0.4 on 2026-10-17 21:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imagehostingapp', '0007_imageblob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imagethumbnailsize',
+            name='encoder_profile',
+            field=models.CharField(choices=[('pillow-default', 'pillow-default'), ('balanced', 'balanced'), ('compact', 'compact'), ('high', 'high')], default='balanced', max_length=32, verbose_name='Encoder Profile'),
+        ),
+    ]
@@ -1,15 +1,155 @@
+import os
 import string
-import random
+import secrets
+from collections import Counter
+from datetime import timedelta
 from uuid import uuid4
 
 from django.conf import settings
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import F
 from django.urls import reverse
 from django.utils import timezone
 
+from imagehostingapp import imaging, sharding
+from imagehostingapp.thumbnail_store import get_thumbnail_store
+
 # Create your models here.
 
 
+def get_blob_path(instance, filename):
+    """
+    Blobs are named by content, identical uploads share one file.
+    """
+    _, extension = os.path.splitext(filename)
+    return sharding.get_sharded_name(
+        "user_images", instance.sha256, instance.sha256 + extension.lower(),
+        settings.MEDIA_SHARD_LEVELS
+    )
+
+
+class ImageBlob(models.Model):
+    """
+    Image file stored once per content, referenced by every upload of it.
+    """
+    sha256 = models.CharField(max_length=64, unique=True, verbose_name="SHA-256")
+    blob_path = models.FileField(upload_to=get_blob_path, max_length=255, verbose_name="Blob File")
+    blob_size = models.BigIntegerField(verbose_name="Blob Size in Bytes")
+    ref_count = models.PositiveIntegerField(default=0, verbose_name="Reference Count")
+    created_at = models.DateTimeField(default=timezone.now)
+
+    @classmethod
+    def acquire(cls, uploaded_file, sha256, size):
+        """
+        Take a reference to the blob of uploaded_file. The file is only
+        stored when its checksum is new, a known one costs one UPDATE.
+        """
+        while True:
+            with transaction.atomic():
+                blob = cls.objects.select_for_update().filter(sha256=sha256).first()
+                if blob:
+                    cls.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1)
+                    return blob
+                blob = cls(sha256=sha256, blob_size=size, ref_count=1)
+                blob.blob_path = blob._store_file(uploaded_file)
+                try:
+                    with transaction.atomic():
+                        blob.save()
+                    return blob
+                except IntegrityError:
+                    # same bytes uploaded concurrently, reference that blob
+                    if blob.blob_path.name != get_blob_path(blob, uploaded_file.name):
+                        blob.blob_path.delete(save=False)
+                    uploaded_file.seek(0)
+
+    @classmethod
+    def acquire_many(cls, uploaded_files):
+        """
+        acquire() for a batch of (uploaded_file, sha256, size), one
+        reference each. Returns {sha256: blob}. Known checksums cost one
+        UPDATE per distinct reference count, new ones one INSERT.
+        """
+        references = Counter(sha256 for _, sha256, _ in uploaded_files)
+        with transaction.atomic():
+            blobs = {
+                blob.sha256: blob
+                for blob in cls.objects.select_for_update().filter(sha256__in=references)
+            }
+            blob_ids_by_count = {}
+            for blob in blobs.values():
+                blob_ids_by_count.setdefault(references[blob.sha256], []).append(blob.pk)
+            for reference_count, blob_ids in blob_ids_by_count.items():
+                cls.objects.filter(pk__in=blob_ids).update(ref_count=F('ref_count') + reference_count)
+            new_blobs = []
+            for uploaded_file, sha256, size in uploaded_files:
+                if sha256 in blobs:
+                    continue
+                blob = blobs[sha256] = cls(sha256=sha256, blob_size=size, ref_count=references[sha256])
+                blob.blob_path = blob._store_file(uploaded_file)
+                new_blobs.append(blob)
+            if not new_blobs:
+                return blobs
+            try:
+                with transaction.atomic():
+                    cls.objects.bulk_create(new_blobs)
+            except IntegrityError:
+                # same bytes uploaded concurrently, reference them blob by blob
+                for uploaded_file, sha256, size in uploaded_files:
+                    blob = blobs[sha256]
+                    if blob.pk is None:
+                        if blob.blob_path.name != get_blob_path(blob, uploaded_file.name):
+                            blob.blob_path.delete(save=False)
+                        uploaded_file.seek(0)
+                        blobs[sha256] = cls.acquire(uploaded_file, sha256, size)
+                        if references[sha256] > 1:
+                            cls.objects.filter(pk=blobs[sha256].pk).update(
+                                ref_count=F('ref_count') + references[sha256] - 1
+                            )
+                return blobs
+            if any(blob.pk is None for blob in new_blobs):
+                # backends not returning ids from bulk inserts
+                blobs.update(cls.objects.in_bulk(
+                    [blob.sha256 for blob in new_blobs], field_name='sha256'
+                ))
+        return blobs
+
+    @classmethod
+    def release(cls, blob_id):
+        """
+        Drop a reference, the last one deletes the blob, its file and
+        thumbnails once the transaction commits.
+        """
+        with transaction.atomic():
+            blob = cls.objects.select_for_update().filter(pk=blob_id).first()
+            if blob is None:
+                return
+            if blob.ref_count > 1:
+                cls.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') - 1)
+                return
+            blob.delete()
+            transaction.on_commit(blob._remove_files)
+
+    def _store_file(self, uploaded_file):
+        storage = self.blob_path.storage
+        blob_name = get_blob_path(self, uploaded_file.name)
+        # left behind by an upload that rolled back, the name vouches for the content
+        if storage.exists(blob_name) and storage.size(blob_name) == self.blob_size:
+            return blob_name
+        return storage.save(blob_name, uploaded_file)
+
+    def _remove_files(self):
+        # the same bytes may have been uploaded again, adopting the file
+        if not ImageBlob.objects.filter(blob_path=self.blob_path.name).exists():
+            self.blob_path.delete(save=False)
+        get_thumbnail_store().discard("{}/".format(self.sha256))
+
+    def __str__(self):
+        return "{}".format(self.sha256)
+
+    class Meta:
+        verbose_name = "Image Blob"
+
+
 class UploadedImages(models.Model):
     image_id = models.UUIDField(default=uuid4, unique=True, editable=False)
     image_author = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
@@ -17,35 +157,150 @@ class UploadedImages(models.Model):
     image_desc = models.CharField(max_length=255, verbose_name="Image Description", default='')
     image_path = models.ImageField(upload_to="user_images", verbose_name="Image to be Uploaded",
                                    null=False, blank=False)
+    image_width = models.PositiveIntegerField(null=True, blank=True, verbose_name="Image Width")
+    image_height = models.PositiveIntegerField(null=True, blank=True, verbose_name="Image Height")
+    image_format = models.CharField(max_length=16, blank=True, default='', verbose_name="Image Format")
+    image_size = models.BigIntegerField(null=True, blank=True, verbose_name="Image Size in Bytes")
+    image_sha256 = models.CharField(max_length=64, blank=True, default='', verbose_name="Image SHA-256")
+    image_blob = models.ForeignKey(ImageBlob, null=True, blank=True, on_delete=models.PROTECT,
+                                   related_name='images', verbose_name="Image Blob")
     image_uri = models.URLField(max_length=255, verbose_name="Image URI", default='')
     image_temp_uri = models.URLField(max_length=255, verbose_name="Image Temp URI", default='')
     image_uri_expiry_sec = models.IntegerField(
         default=-1, verbose_name="Image temp link expire after seconds"
     )
     image_created_at = models.DateTimeField(default=timezone.now)
+    image_temp_token = models.CharField(
+        max_length=16, unique=True, null=True, blank=True, default=None,
+        verbose_name="Image Temp Token"
+    )
+    image_temp_expires_at = models.DateTimeField(
+        null=True, blank=True, verbose_name="Image temp link expires at"
+    )
 
-    def save(self, *args, **kwargs):
-        # preserve file_name for duplicate uploads
-        self.image_name = self.image_path.name
+    TEMP_TOKEN_LENGTH = 8
+
+    @classmethod
+    def generate_temp_tokens(cls, count):
+        """
+        Unique temp tokens, checked against the db in one query per round.
+        Unique constraint is the last line of defence, try to avoid hitting it.
+        """
+        image_temp_tokens = set()
+        while len(image_temp_tokens) < count:
+            candidates = {
+                ''.join(secrets.choice(string.ascii_uppercase)
+                        for _ in range(cls.TEMP_TOKEN_LENGTH))
+                for _ in range(count - len(image_temp_tokens))
+            } - image_temp_tokens
+            taken_tokens = set(cls.objects.filter(
+                image_temp_token__in=candidates
+            ).values_list('image_temp_token', flat=True))
+            image_temp_tokens |= candidates - taken_tokens
+        return list(image_temp_tokens)
+
+    @classmethod
+    def generate_temp_token(cls):
+        return cls.generate_temp_tokens(1)[0]
+
+    @property
+    def needs_temp_token(self):
+        return self.image_uri_expiry_sec != -1 and not self.image_temp_token
+
+    def populate_file_metadata(self):
+        """
+        Read format, dimensions, byte size and checksum of the image file,
+        once, so serving and metadata work never go to the file again.
+        """
+        image_metadata = imaging.read_file_metadata(self.image_path.file)
+        self.image_format = image_metadata.format
+        self.image_width = image_metadata.width
+        self.image_height = image_metadata.height
+        self.image_size = image_metadata.size
+        self.image_sha256 = image_metadata.sha256
+
+    def attach_blob(self, image_blob=None):
+        """
+        Point the newly assigned file at the blob of its bytes, stored once
+        across users.
+        """
+        self.image_blob = image_blob or ImageBlob.acquire(
+            self.image_path.file, self.image_sha256, self.image_size
+        )
+        self.image_path = self.image_blob.blob_path.name
+
+    @classmethod
+    def attach_blobs(cls, uploaded_images):
+        """
+        Fill in the file metadata and attach the blobs of a batch of newly
+        assigned files, the blobs acquired together.
+        """
+        for uploaded_image in uploaded_images:
+            uploaded_image.populate_file_metadata()
+            # preserve file_name, blobs are named by content
+            uploaded_image.image_name = os.path.basename(uploaded_image.image_path.name)
+        image_blobs = ImageBlob.acquire_many([
+            (uploaded_image.image_path.file, uploaded_image.image_sha256, uploaded_image.image_size)
+            for uploaded_image in uploaded_images
+        ])
+        for uploaded_image in uploaded_images:
+            uploaded_image.attach_blob(image_blobs[uploaded_image.image_sha256])
+
+    def populate_derived_fields(self):
+        # newly assigned files only, stored ones are filled in by backfillimagemetadata
+        if not self.image_path._committed:
+            self.populate_file_metadata()
+            # preserve file_name, blobs are named by content
+            self.image_name = os.path.basename(self.image_path.name)
+            self.attach_blob()
+        elif not self.image_name:
+            self.image_name = self.image_path.name
         # help create download URLs
         self.image_uri = reverse('download_image',  kwargs={"image_id": self.image_id})
         # create temp uri
-        image_temp_id = ''.join(random.choices(string.ascii_uppercase, k=8))
-        self.image_temp_uri = reverse('download_temp_image', kwargs={"image_temp_id": image_temp_id}) \
-            if self.image_uri_expiry_sec != -1 else ''
-        return super(UploadedImages, self).save(*args, **kwargs)
+        if self.image_temp_token:
+            self.image_temp_uri = reverse('download_temp_image',
+                                          kwargs={"image_temp_id": self.image_temp_token})
+            self.image_temp_expires_at = self.image_created_at + \
+                timedelta(seconds=self.image_uri_expiry_sec)
+        else:
+            self.image_temp_uri = ''
+            self.image_temp_expires_at = None
+
+    def save(self, *args, **kwargs):
+        # create temp token, once
+        if self.needs_temp_token:
+            self.image_temp_token = self.generate_temp_token()
+        previous_blob_id = self.image_blob_id
+        with transaction.atomic():
+            self.populate_derived_fields()
+            saved = super(UploadedImages, self).save(*args, **kwargs)
+            # image file replaced, e.g. from the admin
+            if previous_blob_id and previous_blob_id != self.image_blob_id:
+                ImageBlob.release(previous_blob_id)
+        return saved
 
     def __str__(self):
         return "{}".format(self.image_path)
 
     class Meta:
         verbose_name = "Uploaded Image"
+        indexes = [
+            # keyset pagination of a user's images
+            models.Index(fields=['image_author', 'image_created_at', 'id'],
+                         name='uploaded_author_created_idx'),
+        ]
 
 
 class ImageThumbnailSize(models.Model):
     thumbnail_size_px = models.IntegerField(
         verbose_name="Image Thumbnail Size"
     )
+    encoder_profile = models.CharField(
+        max_length=32, verbose_name="Encoder Profile",
+        choices=[(profile, profile) for profile in imaging.ENCODER_PROFILES],
+        default=imaging.DEFAULT_ENCODER_PROFILE
+    )
 
     def __str__(self):
         return "{}px".format(self.thumbnail_size_px)
@@ -84,3 +339,51 @@ class Subscription(models.Model):
 
     class Meta:
         verbose_name = "User Subscription"
+
+
+class UploadSession(models.Model):
+    session_id = models.UUIDField(default=uuid4, unique=True, editable=False)
+    session_author = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    file_name = models.CharField(max_length=255, verbose_name="File Name")
+    content_type = models.CharField(max_length=64, verbose_name="Content Type")
+    total_size = models.BigIntegerField(verbose_name="Total Size (bytes)")
+    chunk_size = models.IntegerField(verbose_name="Chunk Size (bytes)")
+    image_desc = models.CharField(max_length=255, verbose_name="Image Description", default='')
+    image_uri_expiry_sec = models.IntegerField(
+        default=-1, verbose_name="Image temp link expire after seconds"
+    )
+    uploaded_image = models.ForeignKey(
+        UploadedImages, null=True, blank=True, on_delete=models.SET_NULL
+    )
+    created_at = models.DateTimeField(default=timezone.now)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    @property
+    def chunk_count(self):
+        return -(-self.total_size // self.chunk_size)
+
+    def expected_chunk_size(self, chunk_index):
+        return min(self.chunk_size, self.total_size - chunk_index * self.chunk_size)
+
+    def __str__(self):
+        return "{} | {}".format(self.session_id, self.file_name)
+
+    class Meta:
+        verbose_name = "Upload Session"
+
+
+class UploadChunk(models.Model):
+    session = models.ForeignKey(UploadSession, related_name='chunks', on_delete=models.CASCADE)
+    chunk_index = models.IntegerField(verbose_name="Chunk Index")
+    chunk_size = models.IntegerField(verbose_name="Chunk Size (bytes)")
+    chunk_sha256 = models.CharField(max_length=64, verbose_name="Chunk SHA-256")
+
+    def __str__(self):
+        return "{} | {}".format(self.session.session_id, self.chunk_index)
+
+    class Meta:
+        verbose_name = "Upload Chunk"
+        constraints = [
+            models.UniqueConstraint(fields=['session', 'chunk_index'],
+                                    name='upload_chunk_unique_index'),
+        ]
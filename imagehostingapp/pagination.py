@@ -0,0 +1,123 @@
+"""
+Keyset (cursor) pagination for image listings.
+
+Pages are ordered by (image_created_at, id) and each cursor carries the
+position of the row it was taken from, so a page is one index range scan
+on (image_author, image_created_at, id) however deep it is, and pages
+stay stable while new images are uploaded.
+"""
+import base64
+import binascii
+from collections import OrderedDict
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param, remove_query_param
+
+
+class ImageKeysetPagination(BasePagination):
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    page_size = 50
+    max_page_size = 500
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        self.cursor = self.decode_cursor(request)
+
+        if self.cursor is None:
+            is_reversed = False
+        else:
+            position_created_at, position_id, is_reversed = self.cursor
+            if is_reversed:
+                queryset = queryset.filter(
+                    Q(image_created_at__lt=position_created_at) |
+                    Q(image_created_at=position_created_at, id__lt=position_id)
+                )
+            else:
+                queryset = queryset.filter(
+                    Q(image_created_at__gt=position_created_at) |
+                    Q(image_created_at=position_created_at, id__gt=position_id)
+                )
+
+        if is_reversed:
+            queryset = queryset.order_by('-image_created_at', '-id')
+        else:
+            queryset = queryset.order_by('image_created_at', 'id')
+
+        # one extra row tells if there is a further page
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        self.page = results[:self.page_size]
+
+        if is_reversed:
+            self.page.reverse()
+            self.has_previous, self.has_next = has_more, True
+        else:
+            self.has_previous, self.has_next = self.cursor is not None, has_more
+        return self.page
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            decoded = base64.urlsafe_b64decode(encoded.encode('ascii')).decode('ascii')
+            created_at, position_id, direction = decoded.split('|')
+            position_created_at = parse_datetime(created_at)
+            if position_created_at is None or direction not in ('n', 'p'):
+                raise ValueError(decoded)
+            return position_created_at, int(position_id), direction == 'p'
+        except (TypeError, ValueError, UnicodeError, binascii.Error):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, image_obj, is_reversed):
+        position = "{}|{}|{}".format(
+            image_obj.image_created_at.isoformat(), image_obj.id, 'p' if is_reversed else 'n'
+        )
+        encoded = base64.urlsafe_b64encode(position.encode('ascii')).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        if not self.page:
+            # walked back past the first image, restart from the top
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(self.page[-1], is_reversed=False)
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(self.page[0], is_reversed=True)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True},
+                'previous': {'type': 'string', 'nullable': True},
+                'results': schema,
+            },
+        }
@@ -1,14 +1,44 @@
 
+from django.conf import settings
+from django.db import transaction
 from rest_framework import serializers
-from imagehostingapp.models import UploadedImages
+
+from imagehostingapp import thumbnails, uploads
+from imagehostingapp.models import UploadedImages, UploadSession
 
 
 VALID_UPLOAD_FORMATS = (
     'image/png',
     'image/jpg',
+    'image/jpeg',
 )
 
 
+class ImageUploadListSerializer(serializers.ListSerializer):
+    """
+    Batch File Upload Serializer, one INSERT for all the images
+    """
+
+    def create(self, validated_data):
+        uploaded_images = [self.child.build(attrs) for attrs in validated_data]
+        # blobs of the whole batch in a few queries, files stored once per content
+        UploadedImages.attach_blobs(uploaded_images)
+        image_temp_tokens = UploadedImages.generate_temp_tokens(
+            sum(uploaded_image.needs_temp_token for uploaded_image in uploaded_images)
+        )
+        for uploaded_image in uploaded_images:
+            if uploaded_image.needs_temp_token:
+                uploaded_image.image_temp_token = image_temp_tokens.pop()
+            uploaded_image.populate_derived_fields()
+        uploaded_images = UploadedImages.objects.bulk_create(uploaded_images)
+        # render tier thumbnails in background, once the upload is committed
+        transaction.on_commit(
+            lambda: [thumbnails.schedule_thumbnails(uploaded_image)
+                     for uploaded_image in uploaded_images]
+        )
+        return uploaded_images
+
+
 class ImageUploadSerializer(serializers.ModelSerializer):
     """
     File Upload Serializer
@@ -21,15 +51,23 @@ class ImageUploadSerializer(serializers.ModelSerializer):
         model = UploadedImages
         fields = ('image_id', 'image_desc', 'image_path', 'image_uri',
                   'image_author', 'image_uri_expiry_sec', 'image_temp_uri')
+        list_serializer_class = ImageUploadListSerializer
 
-    def create(self, validated_data):
-        uploaded_image = UploadedImages(
+    def build(self, validated_data):
+        return UploadedImages(
             image_desc=validated_data.get('image_desc', ''),
             image_path=validated_data['image_path'],
             image_author=self.context['request'].user,
             image_uri_expiry_sec=validated_data.get('image_uri_expiry_sec', -1),
         )
+
+    def create(self, validated_data):
+        uploaded_image = self.build(validated_data)
         uploaded_image.save()
+        # render tier thumbnails in background, once the upload is committed
+        transaction.on_commit(
+            lambda: thumbnails.schedule_thumbnails(uploaded_image)
+        )
         return uploaded_image
 
     def validate_image_path(self, value):
@@ -60,3 +98,61 @@ class ListImagesSerializer(serializers.ModelSerializer):
     class Meta:
         model = UploadedImages
         fields = ('image_name', 'image_desc', 'image_created_at')
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    """
+    Resumable Upload Session Serializer
+    """
+    chunk_count = serializers.IntegerField(read_only=True)
+    missing_chunks = serializers.SerializerMethodField()
+
+    class Meta:
+        model = UploadSession
+        fields = ('session_id', 'file_name', 'content_type', 'total_size',
+                  'chunk_size', 'chunk_count', 'missing_chunks',
+                  'image_desc', 'image_uri_expiry_sec', 'created_at')
+        read_only_fields = ('session_id', 'chunk_size', 'created_at')
+
+    def get_missing_chunks(self, upload_session):
+        return uploads.get_missing_chunks(upload_session)
+
+    def create(self, validated_data):
+        upload_session = UploadSession(
+            session_author=self.context['request'].user,
+            chunk_size=settings.UPLOAD_CHUNK_SIZE,
+            **validated_data
+        )
+        upload_session.save()
+        uploads.create_staging_file(upload_session)
+        return upload_session
+
+    def validate_content_type(self, value):
+        """
+        Check for valid image formats
+        """
+        if value not in VALID_UPLOAD_FORMATS:
+            raise serializers.ValidationError(
+                f"{value} not supported. Please upload PNG or JPG images."
+            )
+        return value
+
+    def validate_total_size(self, value):
+        """
+        Check for valid upload size
+        """
+        if value <= 0 or value > settings.UPLOAD_SESSION_MAX_SIZE:
+            raise serializers.ValidationError(
+                f"{value} should be between 1 to {settings.UPLOAD_SESSION_MAX_SIZE} bytes."
+            )
+        return value
+
+    def validate_image_uri_expiry_sec(self, value):
+        """
+        Check for valid URI expiry seconds
+        """
+        if value and (value < 300 or value > 30000):
+            raise serializers.ValidationError(
+                f"{value} should be between 300 to 30000 seconds."
+            )
+        return value
@@ -0,0 +1,325 @@
+"""
+Serve image files without holding them in worker memory.
+
+IMAGE_SERVING_MODE decides how downloads are served:
+    sendfile:          FileResponse, the WSGI server hands the file to os.sendfile
+                       (wsgi.file_wrapper).
+    x-accel-redirect:  empty response with an internal path for nginx to serve.
+    x-sendfile:        empty response with the file path for Apache (mod_xsendfile).
+    stream:            chunked streaming from the worker, as a fallback.
+
+Every mode answers conditional requests (If-None-Match, If-Modified-Since)
+with 304 Not Modified. Range requests get 206 Partial Content, including
+multipart/byteranges for several ranges, or are left to the front proxy
+when the transfer is offloaded.
+"""
+import os
+import logging
+import mimetypes
+from uuid import uuid4
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, parse_http_date_safe
+
+from rest_framework import status
+
+
+SERVING_MODE_SENDFILE = 'sendfile'
+SERVING_MODE_X_ACCEL_REDIRECT = 'x-accel-redirect'
+SERVING_MODE_X_SENDFILE = 'x-sendfile'
+SERVING_MODE_STREAM = 'stream'
+
+SERVING_MODES = (
+    SERVING_MODE_SENDFILE,
+    SERVING_MODE_X_ACCEL_REDIRECT,
+    SERVING_MODE_X_SENDFILE,
+    SERVING_MODE_STREAM,
+)
+
+# thumbnail variants, not known to every Python version
+mimetypes.add_type('image/webp', '.webp')
+mimetypes.add_type('image/avif', '.avif')
+
+# more ranges than this (after merging) are answered with the whole file
+MAX_RANGES = 16
+
+
+class RangeFile(object):
+    """
+    File like object exposing only a byte range of an open file.
+    fileno() is kept, so the WSGI server can still sendfile the range.
+    """
+
+    def __init__(self, file, start, length):
+        self.file = file
+        self.remaining = length
+        file.seek(start)
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+def content_disposition(file_name):
+    try:
+        file_name.encode('ascii')
+        escaped_file_name = file_name.replace('\\', '\\\\').replace('"', r'\"')
+        return 'attachment; filename="{}"'.format(escaped_file_name)
+    except UnicodeEncodeError:
+        return "attachment; filename*=utf-8''{}".format(quote(file_name))
+
+
+def get_internal_path(file_path):
+    """
+    Translate a file under MEDIA_ROOT to the proxy's internal location.
+    """
+    media_root = os.path.abspath(settings.MEDIA_ROOT)
+    relative_path = os.path.relpath(os.path.abspath(file_path), media_root)
+    if relative_path.startswith(os.pardir):
+        return None
+    return settings.IMAGE_SERVING_INTERNAL_PREFIX.rstrip('/') + '/' + \
+        quote(relative_path.replace(os.sep, '/'))
+
+
+def get_etag(file_stat):
+    return '"{:x}-{:x}"'.format(file_stat.st_size, file_stat.st_mtime_ns)
+
+
+def parse_range_header(range_header, file_size):
+    """
+    Parse a "bytes=" Range header into sorted, merged (start, end) pairs,
+    ends inclusive. None means the header should be ignored, and an empty
+    list means none of the ranges can be satisfied.
+    """
+    unit, _, range_specs = range_header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for range_spec in range_specs.split(','):
+        first, separator, last = range_spec.strip().partition('-')
+        if not separator:
+            return None
+        try:
+            if not first:
+                suffix_length = int(last)
+                if suffix_length <= 0:
+                    continue
+                start, end = max(file_size - suffix_length, 0), file_size - 1
+            else:
+                start = int(first)
+                end = int(last) if last else max(start, file_size - 1)
+                if start < 0 or end < start:
+                    return None
+                end = min(end, file_size - 1)
+        except ValueError:
+            return None
+        if start < file_size:
+            ranges.append((start, end))
+
+    merged_ranges = []
+    for start, end in sorted(ranges):
+        if merged_ranges and start <= merged_ranges[-1][1] + 1:
+            merged_ranges[-1] = (merged_ranges[-1][0], max(end, merged_ranges[-1][1]))
+        else:
+            merged_ranges.append((start, end))
+    if len(merged_ranges) > MAX_RANGES:
+        return None
+    return merged_ranges
+
+
+def is_range_still_valid(request, etag, last_modified):
+    """
+    If-Range: honour the Range header only for an unchanged file.
+    """
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        # strong comparison, weak tags never match
+        return if_range == etag
+    if_range_timestamp = parse_http_date_safe(if_range)
+    return if_range_timestamp is not None and last_modified is not None and \
+        if_range_timestamp == last_modified
+
+
+def iter_file_chunks(file_path, chunk_size, start=0, length=None):
+    with open(file_path, 'rb') as file:
+        file.seek(start)
+        while length is None or length > 0:
+            read_size = chunk_size if length is None else min(chunk_size, length)
+            chunk = file.read(read_size)
+            if not chunk:
+                break
+            if length is not None:
+                length -= len(chunk)
+            yield chunk
+
+
+def _byteranges_part_header(boundary, content_type, start, end, file_size):
+    return (
+        "--{}\r\nContent-Type: {}\r\nContent-Range: bytes {}-{}/{}\r\n\r\n".format(
+            boundary, content_type, start, end, file_size
+        )
+    ).encode('ascii')
+
+
+def iter_byteranges(file_path, chunk_size, ranges, boundary, content_type, file_size):
+    for start, end in ranges:
+        yield _byteranges_part_header(boundary, content_type, start, end, file_size)
+        yield from iter_file_chunks(file_path, chunk_size, start, end - start + 1)
+        yield b"\r\n"
+    yield "--{}--\r\n".format(boundary).encode('ascii')
+
+
+def _partial_response(file_path, file_mimetype, ranges, file_size, serving_mode):
+    chunk_size = settings.IMAGE_SERVING_CHUNK_SIZE
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        content_length = end - start + 1
+        if serving_mode == SERVING_MODE_STREAM:
+            response = StreamingHttpResponse(
+                iter_file_chunks(file_path, chunk_size, start, content_length),
+                content_type=file_mimetype, status=status.HTTP_206_PARTIAL_CONTENT
+            )
+        else:
+            response = FileResponse(
+                RangeFile(open(file_path, 'rb'), start, content_length),
+                content_type=file_mimetype, status=status.HTTP_206_PARTIAL_CONTENT
+            )
+        response['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, file_size)
+        response['Content-Length'] = content_length
+        return response
+
+    boundary = uuid4().hex
+    content_length = sum(
+        len(_byteranges_part_header(boundary, file_mimetype, start, end, file_size)) +
+        (end - start + 1) + 2
+        for start, end in ranges
+    ) + len("--{}--\r\n".format(boundary))
+    response = StreamingHttpResponse(
+        iter_byteranges(file_path, chunk_size, ranges, boundary, file_mimetype, file_size),
+        content_type='multipart/byteranges; boundary={}'.format(boundary),
+        status=status.HTTP_206_PARTIAL_CONTENT
+    )
+    response['Content-Length'] = content_length
+    return response
+
+
+def get_content_etag(sha256):
+    return '"{}"'.format(sha256)
+
+
+def serve_file(request, file_path, file_name, last_modified=None, file_size=None, etag=None):
+    """
+    Build the download response for the file at file_path,
+    offered to the client as file_name.
+    last_modified: datetime, defaults to the file modification time.
+    file_size, etag: stored metadata, when known with last_modified the
+    file is not stat'ed, and offloaded transfers never touch it.
+    """
+    serving_mode = settings.IMAGE_SERVING_MODE
+    file_mimetype = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+
+    if file_size is None or etag is None or last_modified is None:
+        file_stat = os.stat(file_path)
+        file_size = file_stat.st_size
+        etag = etag or get_etag(file_stat)
+        last_modified_timestamp = int(
+            last_modified.timestamp() if last_modified else file_stat.st_mtime
+        )
+    else:
+        last_modified_timestamp = int(last_modified.timestamp())
+    validator_headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(last_modified_timestamp),
+    }
+
+    # 304 Not Modified, or 412 Precondition Failed
+    conditional_response = get_conditional_response(
+        request, etag=etag, last_modified=last_modified_timestamp
+    )
+    if conditional_response is not None:
+        for header, value in validator_headers.items():
+            conditional_response[header] = value
+        patch_cache_control(conditional_response, private=True, no_cache=True)
+        return conditional_response
+
+    internal_path = None
+    if serving_mode == SERVING_MODE_X_ACCEL_REDIRECT:
+        internal_path = get_internal_path(file_path)
+        if not internal_path:
+            logging.log(
+                level=logging.WARNING,
+                msg=f"{file_path} is outside MEDIA_ROOT and can not be offloaded. Sending it from worker."
+            )
+
+    if internal_path:
+        response = HttpResponse(content_type=file_mimetype, status=status.HTTP_200_OK)
+        response['X-Accel-Redirect'] = internal_path
+    elif serving_mode == SERVING_MODE_X_SENDFILE:
+        response = HttpResponse(content_type=file_mimetype, status=status.HTTP_200_OK)
+        response['X-Sendfile'] = os.path.abspath(file_path)
+    else:
+        # offloaded transfers leave Range handling to the proxy
+        range_header = request.META.get('HTTP_RANGE')
+        ranges = None
+        if range_header and \
+                is_range_still_valid(request, etag, last_modified_timestamp):
+            ranges = parse_range_header(range_header, file_size)
+
+        if ranges == []:
+            response = HttpResponse(
+                status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
+            )
+            response['Content-Range'] = 'bytes */{}'.format(file_size)
+        elif ranges:
+            response = _partial_response(
+                file_path, file_mimetype, ranges, file_size, serving_mode
+            )
+        elif serving_mode == SERVING_MODE_STREAM:
+            response = StreamingHttpResponse(
+                iter_file_chunks(file_path, settings.IMAGE_SERVING_CHUNK_SIZE),
+                content_type=file_mimetype, status=status.HTTP_200_OK
+            )
+            response['Content-Length'] = file_size
+        else:
+            response = FileResponse(
+                open(file_path, 'rb'), content_type=file_mimetype, status=status.HTTP_200_OK
+            )
+        response['Accept-Ranges'] = 'bytes'
+
+    for header, value in validator_headers.items():
+        response[header] = value
+    # per user content, clients revalidate with the validators above
+    patch_cache_control(response, private=True, no_cache=True)
+    response['Content-Disposition'] = content_disposition(file_name)
+    return response
+
+
+def serve_image(request, image_query_obj):
+    """
+    Serve an original image, size and validators from its stored metadata.
+    """
+    if image_query_obj.image_sha256:
+        return serve_file(
+            request, image_query_obj.image_path.path, image_query_obj.image_name,
+            image_query_obj.image_created_at, image_query_obj.image_size,
+            get_content_etag(image_query_obj.image_sha256)
+        )
+    # not backfilled yet, see "./manage.py backfillimagemetadata"
+    return serve_file(
+        request, image_query_obj.image_path.path, image_query_obj.image_name,
+        image_query_obj.image_created_at
+    )
@@ -0,0 +1,36 @@
+"""
+Hash-prefix fan-out of media directories.
+
+Millions of files in one directory make lookups, backups and listings
+slow. Files are spread over levels of directories named by two hex digits
+of their key (256 per level), "ab/cd/<name>" for two levels, so no single
+directory grows past a few thousand entries.
+"""
+import os
+import hashlib
+import posixpath
+
+
+HEX_DIGITS = frozenset('0123456789abcdef')
+
+
+def get_shard_dirs(key, levels):
+    """
+    Keys that are hex digests already (checksums, UUIDs) are used as they
+    are, anything else is hashed first.
+    """
+    key = str(key).lower().replace('-', '')
+    if len(key) < 2 * levels or not HEX_DIGITS.issuperset(key):
+        key = hashlib.sha256(key.encode()).hexdigest()
+    return [key[2 * level:2 * level + 2] for level in range(levels)]
+
+
+def get_sharded_name(directory, key, file_name, levels):
+    """
+    Storage name, forward slashes whatever the platform.
+    """
+    return posixpath.join(directory, *get_shard_dirs(key, levels), file_name)
+
+
+def get_sharded_path(root, key, name, levels):
+    return os.path.join(root, *get_shard_dirs(key, levels), name)
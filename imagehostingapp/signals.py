@@ -0,0 +1,58 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+from django.dispatch import receiver
+
+from imagehostingapp import entitlements, metadata_cache, thumbnails
+from imagehostingapp.models import ImageBlob, UploadedImages, Subscription, AccountTiers, ImageThumbnailSize
+
+
+@receiver(post_save, sender=UploadedImages)
+@receiver(post_delete, sender=UploadedImages)
+def invalidate_image_metadata(sender, instance, **kwargs):
+    metadata_cache.invalidate_user_image(instance.image_author_id, instance.image_id)
+
+
+@receiver(post_delete, sender=UploadedImages)
+def release_image_blob(sender, instance, **kwargs):
+    if instance.image_blob_id:
+        ImageBlob.release(instance.image_blob_id)
+
+
+@receiver(post_delete, sender=UploadedImages)
+def discard_image_thumbnails(sender, instance, **kwargs):
+    # like blob files, once the delete commits
+    transaction.on_commit(lambda: thumbnails.discard_thumbnails(instance))
+
+
+@receiver(post_save, sender=Subscription)
+@receiver(post_delete, sender=Subscription)
+def invalidate_subscription_entitlements(sender, instance, **kwargs):
+    entitlements.invalidate_users([instance.user_id])
+
+
+@receiver(post_save, sender=AccountTiers)
+def invalidate_tier_entitlements(sender, instance, **kwargs):
+    entitlements.invalidate_tiers([instance.pk])
+
+
+@receiver(post_save, sender=ImageThumbnailSize)
+@receiver(pre_delete, sender=ImageThumbnailSize)
+def invalidate_thumbnail_size_entitlements(sender, instance, **kwargs):
+    # tier links are gone by post_delete, collect them before
+    entitlements.invalidate_tiers(
+        instance.accounttiers_set.values_list('pk', flat=True)
+    )
+
+
+@receiver(m2m_changed, sender=AccountTiers.thumbnail_sizes.through)
+def invalidate_tier_thumbnail_sizes_entitlements(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        entitlements.invalidate_tiers([instance.pk])
+    elif action == 'pre_clear':
+        entitlements.invalidate_tiers(
+            instance.accounttiers_set.values_list('pk', flat=True)
+        )
+    else:
+        entitlements.invalidate_tiers(pk_set)
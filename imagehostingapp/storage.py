@@ -0,0 +1,161 @@
+"""
+Image file storage spread over several volumes.
+
+Every volume is placed on a consistent hash ring with a number of points
+proportional to its weight (relative capacity), and a file belongs to the
+volume owning the first point after the hash of its name. Reads are
+routed by name alone, no db lookup. Adding a volume takes over only the
+files it now owns, about weight / total weight of them, and nothing moves
+between the existing volumes. "./manage.py rebalancemedia" moves those
+files, until then they are found on the volumes next in ring order.
+
+Volumes are plain directories, separate disks or network mounts; mount
+them under MEDIA_ROOT for 'x-accel-redirect' serving. Without
+MEDIA_VOLUMES configured this is FileSystemStorage on MEDIA_ROOT.
+"""
+import os
+import bisect
+import hashlib
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import FileSystemStorage
+from django.utils._os import safe_join
+from django.utils.functional import cached_property
+
+
+# ring points per unit of weight, more spread the load more evenly
+POINTS_PER_WEIGHT = 64
+
+
+def _ring_hash(value):
+    # stable across processes, unlike hash()
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+
+def parse_volumes(volume_specs):
+    """
+    [(name, root, weight)] from "name=root:weight" specs, weight defaults to 1.
+    """
+    volumes = []
+    for volume_spec in volume_specs:
+        name, separator, location = volume_spec.partition('=')
+        root, _, weight = location.rpartition(':')
+        if not root:
+            root, weight = location, '1'
+        if not separator or not name or not root or not weight.isdigit():
+            raise ImproperlyConfigured(
+                f"Invalid media volume {volume_spec!r}, expected name=root:weight."
+            )
+        volumes.append((name, os.path.abspath(root), int(weight)))
+    if volumes and not any(weight for _, _, weight in volumes):
+        raise ImproperlyConfigured("At least one media volume needs a weight above 0.")
+    return volumes
+
+
+class VolumeRing(object):
+
+    def __init__(self, volume_weights):
+        points = sorted(
+            (_ring_hash("{}#{}".format(name, point)), name)
+            for name, weight in volume_weights
+            for point in range(weight * POINTS_PER_WEIGHT)
+        )
+        self._hashes = [point_hash for point_hash, _ in points]
+        self._names = [name for _, name in points]
+        self._volume_count = len({name for name, weight in volume_weights if weight})
+
+    def get_volumes(self, key):
+        """
+        Distinct volume names in ring order from the key, the owner first.
+        The second one owned the key before the owner was added.
+        """
+        start = bisect.bisect(self._hashes, _ring_hash(key))
+        volumes = []
+        for offset in range(len(self._names)):
+            name = self._names[(start + offset) % len(self._names)]
+            if name not in volumes:
+                volumes.append(name)
+                if len(volumes) == self._volume_count:
+                    break
+        return volumes
+
+
+class MultiVolumeStorage(FileSystemStorage):
+
+    def _clear_cached_properties(self, setting, **kwargs):
+        super()._clear_cached_properties(setting, **kwargs)
+        if setting in ('MEDIA_ROOT', 'MEDIA_VOLUMES'):
+            self.__dict__.pop('volumes', None)
+            self.__dict__.pop('ring', None)
+
+    @cached_property
+    def volumes(self):
+        """
+        {name: root}, in configuration order.
+        """
+        return {
+            name: root for name, root, _ in parse_volumes(settings.MEDIA_VOLUMES)
+        } or {'default': self.location}
+
+    @cached_property
+    def ring(self):
+        volume_weights = [(name, weight) for name, _, weight in parse_volumes(settings.MEDIA_VOLUMES)]
+        return VolumeRing(volume_weights or [('default', 1)])
+
+    def get_volume(self, name):
+        return self.ring.get_volumes(name)[0]
+
+    def get_volume_path(self, volume, name):
+        return safe_join(self.volumes[volume], name)
+
+    def _get_candidate_volumes(self, name):
+        ring_volumes = self.ring.get_volumes(name)
+        # volumes drained with weight 0 are looked at last
+        return ring_volumes + [volume for volume in self.volumes if volume not in ring_volumes]
+
+    def path(self, name):
+        """
+        Where the file is, or where the owning volume would store it.
+        """
+        if len(self.volumes) == 1:
+            return safe_join(next(iter(self.volumes.values())), name)
+        candidate_volumes = self._get_candidate_volumes(name)
+        for volume in candidate_volumes:
+            volume_path = self.get_volume_path(volume, name)
+            if os.path.lexists(volume_path):
+                return volume_path
+        return self.get_volume_path(candidate_volumes[0], name)
+
+    def _save(self, name, content):
+        # FileSystemStorage names the file relative to MEDIA_ROOT, not its volume
+        full_path = os.path.normpath(os.path.join(self.location, super()._save(name, content)))
+        for volume_root in self.volumes.values():
+            if full_path.startswith(os.path.join(volume_root, '')):
+                return os.path.relpath(full_path, volume_root).replace('\\', '/')
+        raise ImproperlyConfigured(f"{full_path} is outside every media volume.")
+
+    def delete(self, name):
+        if not name:
+            raise ValueError("The name must be given to delete().")
+        # a file being rebalanced may be on two volumes for a moment
+        for volume in self.volumes:
+            volume_path = self.get_volume_path(volume, name)
+            try:
+                if os.path.isdir(volume_path):
+                    os.rmdir(volume_path)
+                else:
+                    os.remove(volume_path)
+            except FileNotFoundError:
+                pass
+
+    def listdir(self, path):
+        directories, files = set(), set()
+        for volume in self.volumes:
+            try:
+                with os.scandir(self.get_volume_path(volume, path)) as entries:
+                    for entry in entries:
+                        (directories if entry.is_dir() else files).add(entry.name)
+            except FileNotFoundError:
+                pass
+        return sorted(directories), sorted(files)
@@ -1,17 +1,72 @@
+import io
 import json
+import logging
+import base64
+import hashlib
 import os.path
+import shutil
+import tempfile
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
 from os import path
+from unittest import mock
 
+from asgiref.sync import async_to_sync
+from PIL import Image
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.files.base import ContentFile
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.urls import reverse
-from django.test import SimpleTestCase
+from django.utils import timezone
+from django.db import connection
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.conf import settings
 
 from rest_framework import status
 from rest_framework.test import APITestCase, APIClient
 
-from imagehostingapp.models import Subscription, ImageThumbnailSize, AccountTiers
+from imagestore import log, profiling
+from imagestore.asgi import StreamingASGIHandler
+from imagehostingapp import async_views, benchmarking, entitlements, imaging, loadtest, sharding, thumbnails
+from imagehostingapp.storage import VolumeRing
+from imagehostingapp.thumbnail_store import ThumbnailStore, get_thumbnail_store
+from imagehostingapp.models import (
+    Subscription, ImageThumbnailSize, AccountTiers, UploadedImages, ImageBlob
+)
+
+
+def clear_caches():
+    # test db rollbacks do not send signals, user ids get reused
+    cache.clear()
+    entitlements.invalidate_local()
+
+
+def override_media_root():
+    """
+    Store the uploads, staged chunks and thumbnails of a test in a new
+    temporary directory, removed by restore_media_root().
+    """
+    media_root = tempfile.mkdtemp()
+    media_settings = override_settings(
+        MEDIA_ROOT=media_root, MEDIA_VOLUMES=[],
+        UPLOAD_STAGING_ROOT=path.join(media_root, 'staging'),
+        THUMBNAIL_STORE_ROOT=path.join(media_root, 'thumbnails'),
+    )
+    media_settings.enable()
+    return media_settings
+
+
+def restore_media_root(media_settings):
+    # renders still queued write into the directory
+    thumbnails.wait_for_renders()
+    media_root = settings.MEDIA_ROOT
+    media_settings.disable()
+    shutil.rmtree(media_root, ignore_errors=True)
 
 
 class PingAPITestCase(SimpleTestCase):
@@ -36,6 +91,129 @@ class PingAPITestCase(SimpleTestCase):
         )
 
 
+class MetricsTestCase(APITestCase):
+    """
+    Test request metrics summed across workers
+    """
+
+    PASSWORD = 'pa$$w0rd'
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.admin_user = User.objects.create_superuser(
+            'superuser1', 'email@domain.tld', cls.PASSWORD
+        )
+        cls.client = APIClient()
+        cls.metrics_url = reverse('api_metrics')
+
+    def setUp(self):
+        clear_caches()
+        self.metrics_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.metrics_dir.cleanup)
+
+    def get_sample(self, sample_name):
+        response = self.client.get(self.metrics_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        for line in response.content.decode().splitlines():
+            if line.startswith(sample_name + ' '):
+                return float(line.split()[-1])
+        return 0.0
+
+    def test_metrics_summed_across_workers(self):
+        ping_requests = 'imagestore_http_requests_total{method="GET",status="200",view="api_ping_server"}'
+        list_queries = 'imagestore_db_queries_total{view="list_upload_image-list"}'
+        with override_settings(METRICS_DIR=self.metrics_dir.name):
+            # another worker's file
+            with open(path.join(self.metrics_dir.name, 'worker-1-test.json'), 'w') as metrics_file:
+                json.dump({
+                    'counters': [['imagestore_http_requests_total',
+                                  {'method': 'GET', 'status': '200', 'view': 'api_ping_server'}, 5]],
+                    'histograms': [],
+                }, metrics_file)
+            ping_count = self.get_sample(ping_requests)
+            list_query_count = self.get_sample(list_queries)
+            self.client.get(reverse('api_ping_server'))
+            self.client.login(username=self.admin_user.username, password=self.PASSWORD)
+            self.client.get(reverse('list_upload_image-list'))
+            self.assertEqual(self.get_sample(ping_requests), ping_count + 1)
+            self.assertGreater(self.get_sample(list_queries), list_query_count)
+        os.remove(path.join(self.metrics_dir.name, 'worker-1-test.json'))
+        with override_settings(METRICS_DIR=self.metrics_dir.name):
+            self.assertEqual(self.get_sample(ping_requests), ping_count - 5 + 1)
+        response = self.client.get(self.metrics_url)
+        self.assertIn('# TYPE imagestore_http_request_duration_seconds histogram',
+                      response.content.decode())
+        self.assertIn('imagestore_http_request_duration_seconds_bucket{le="+Inf",view="api_ping_server"}',
+                      response.content.decode())
+
+    @override_settings(METRICS_ALLOWED_IPS=['10.0.0.5'], METRICS_TOKEN='s3cret')
+    def test_metrics_restricted_to_scrapers(self):
+        # forwarded addresses are up to the client
+        response = self.client.get(self.metrics_url, HTTP_X_FORWARDED_FOR='10.0.0.5, 127.0.0.1')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        response = self.client.get(self.metrics_url, HTTP_AUTHORIZATION='Bearer forged')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        response = self.client.get(self.metrics_url, HTTP_AUTHORIZATION='Bearer s3cret')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(self.metrics_url, REMOTE_ADDR='10.0.0.5')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class ProfilingTestCase(APITestCase):
+    """
+    Test on-demand request profiles
+    """
+
+    PASSWORD = 'pa$$w0rd'
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.admin_user = User.objects.create_superuser(
+            'superuser1', 'email@domain.tld', cls.PASSWORD
+        )
+        cls.client = APIClient()
+        cls.list_upload_image_url = reverse('list_upload_image-list')
+
+    def setUp(self):
+        clear_caches()
+        self.profiles_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.profiles_dir.cleanup)
+
+    def read_profile(self, profile_id):
+        with open(path.join(self.profiles_dir.name, profile_id + '.json')) as profile_file:
+            return json.load(profile_file)
+
+    def test_request_profiled_on_demand(self):
+        with override_settings(PROFILES_DIR=self.profiles_dir.name, PROFILES_MAX_COUNT=1):
+            # not asked for, or with a forged token
+            response = self.client.get(reverse('api_ping_server'))
+            self.assertNotIn('X-Imagestore-Profile-Id', response)
+            response = self.client.get(reverse('api_ping_server'), HTTP_X_IMAGESTORE_PROFILE='profile:forged')
+            self.assertNotIn('X-Imagestore-Profile-Id', response)
+            self.assertEqual(os.listdir(self.profiles_dir.name), [])
+
+            response = self.client.get(
+                reverse('api_ping_server'), HTTP_X_IMAGESTORE_PROFILE=profiling.create_token()
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            profile = self.read_profile(response['X-Imagestore-Profile-Id'])
+            self.assertEqual(profile['request']['view'], 'api_ping_server')
+            self.assertTrue(path.exists(path.join(
+                self.profiles_dir.name, response['X-Imagestore-Profile-Id'] + '.folded'
+            )))
+
+            # staff users ask with a query flag, the SQL is kept
+            self.client.login(username=self.admin_user.username, password=self.PASSWORD)
+            response = self.client.get(self.list_upload_image_url + '?profile=1')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            profile = self.read_profile(response['X-Imagestore-Profile-Id'])
+            self.assertTrue(any('imagehostingapp_uploadedimages' in query['sql'] for query in profile['sql']))
+            # older profiles are removed
+            self.assertEqual(len(os.listdir(self.profiles_dir.name)), 2)
+
+
 class UploadListImageTestCase(APITestCase):
     """
     Test Upload and List an Image
@@ -52,6 +230,10 @@ class UploadListImageTestCase(APITestCase):
         cls.client = APIClient()
         cls.list_upload_image_url = reverse('list_upload_image-list')
 
+    def setUp(self):
+        clear_caches()
+        self.media_settings = override_media_root()
+
     def test_upload_image_403(self):
         # Make request
         response = self.client.post(self.list_upload_image_url)
@@ -130,19 +312,367 @@ class UploadListImageTestCase(APITestCase):
         get_response = self.client.get(self.list_upload_image_url)
         # Check response status
         self.assertEqual(get_response.status_code, status.HTTP_200_OK)
-        self.assertIn('image_name', get_response.json()[0])
-        self.assertIn('image_desc', get_response.json()[0])
-        self.assertEqual(get_response.json()[0]['image_name'], 'test_img_2.png',
+        self.assertIn('image_name', get_response.json()['results'][0])
+        self.assertIn('image_desc', get_response.json()['results'][0])
+        self.assertEqual(get_response.json()['results'][0]['image_name'], 'test_img_2.png',
                          "Uploaded image name should be preserved")
 
+    @override_settings(IMAGE_SERVING_MODE='x-accel-redirect')
+    def test_image_file_metadata_stored_and_backfilled(self):
+        Subscription.objects.create(user=self.admin_user, tier=AccountTiers.objects.create(
+            account_tier_name="Enterprise", is_original_image_url_present=True,
+            is_expiring_links_available=True
+        ))
+        self.client.login(username=self.admin_user.username,
+                          password=self.PASSWORD)
+        test_img_path = path.join(
+            settings.BASE_DIR,
+            'imagehostingapp/tests/testdata/test_img_2.png'
+        )
+        with open(test_img_path, 'rb') as file:
+            f_content = file.read()
+        with Image.open(test_img_path) as img_file:
+            image_size = img_file.size
+        image = SimpleUploadedFile(
+            "test_img_2.png", f_content, content_type="image/png"
+        )
+        response = self.client.post(self.list_upload_image_url, data={'image_path': image})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        uploaded_image = UploadedImages.objects.get(image_author=self.admin_user)
+        self.assertEqual((uploaded_image.image_width, uploaded_image.image_height), image_size)
+        self.assertEqual(uploaded_image.image_format, 'PNG')
+        self.assertEqual(uploaded_image.image_size, len(f_content))
+        self.assertEqual(uploaded_image.image_sha256, hashlib.sha256(f_content).hexdigest())
+
+        # offloaded download is answered from stored metadata alone
+        download_image_url = reverse('download_image', kwargs={"image_id": uploaded_image.image_id})
+        with mock.patch('imagehostingapp.serving.os.stat', wraps=os.stat) as os_stat:
+            response = self.client.get(download_image_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['ETag'], '"{}"'.format(uploaded_image.image_sha256))
+        # the patch is process wide, the file cache stats its own paths
+        self.assertNotIn(uploaded_image.image_path.path,
+                         [str(stat_call.args[0]) for stat_call in os_stat.call_args_list])
+
+        # rows stored before the columns existed are backfilled
+        UploadedImages.objects.update(image_format='', image_width=None, image_height=None,
+                                      image_size=None, image_sha256='')
+        call_command('backfillimagemetadata', stdout=io.StringIO())
+        backfilled_image = UploadedImages.objects.get(pk=uploaded_image.pk)
+        self.assertEqual(
+            (backfilled_image.image_format, backfilled_image.image_width, backfilled_image.image_height,
+             backfilled_image.image_size, backfilled_image.image_sha256),
+            (uploaded_image.image_format, uploaded_image.image_width, uploaded_image.image_height,
+             uploaded_image.image_size, uploaded_image.image_sha256)
+        )
+
+    def test_duplicate_uploads_share_blob(self):
+        other_user = User.objects.create_superuser(
+            'superuser9', 'email9@domain.tld', self.PASSWORD
+        )
+        test_img_path = path.join(
+            settings.BASE_DIR,
+            'imagehostingapp/tests/testdata/test_img_2.png'
+        )
+        with open(test_img_path, 'rb') as file:
+            f_content = file.read()
+        for user in (self.admin_user, other_user):
+            self.client.login(username=user.username, password=self.PASSWORD)
+            image = SimpleUploadedFile(
+                "test_img_2.png", f_content, content_type="image/png"
+            )
+            response = self.client.post(self.list_upload_image_url, data={'image_path': image})
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        first_image, second_image = UploadedImages.objects.order_by('id')
+        # one file and one set of thumbnails for the same bytes
+        image_blob = ImageBlob.objects.get()
+        self.assertEqual(image_blob.sha256, hashlib.sha256(f_content).hexdigest())
+        self.assertEqual(image_blob.ref_count, 2)
+        self.assertEqual(first_image.image_path.name, second_image.image_path.name)
+        self.assertEqual(first_image.image_path.name, image_blob.blob_path.name)
+        self.assertEqual(second_image.image_name, 'test_img_2.png')
+        self.assertEqual(thumbnails.get_thumbnail_name(first_image, 200),
+                         thumbnails.get_thumbnail_name(second_image, 200))
+
+        # the last reference removes the file
+        first_image.delete()
+        image_blob.refresh_from_db()
+        self.assertEqual(image_blob.ref_count, 1)
+        self.assertTrue(path.exists(second_image.image_path.path))
+        with self.captureOnCommitCallbacks(execute=True):
+            second_image.delete()
+        self.assertFalse(ImageBlob.objects.exists())
+        self.assertFalse(path.exists(second_image.image_path.path))
+
+    def test_legacy_image_thumbnails_discarded(self):
+        # uploaded before checksums, thumbnails keyed by UUID
+        uploaded_image = UploadedImages.objects.create(
+            image_author=self.admin_user, image_path='user_images/test_img_legacy.png'
+        )
+        thumbnail_store = get_thumbnail_store()
+        thumbnail_name = thumbnails.get_thumbnail_name(uploaded_image, 200)
+        self.assertTrue(thumbnail_name.startswith("{}/".format(uploaded_image.image_id)))
+        os.makedirs(path.dirname(thumbnail_store.path(thumbnail_name)), exist_ok=True)
+        with open(thumbnail_store.path(thumbnail_name), 'wb') as file:
+            file.write(b'thumbnail')
+        thumbnail_store.add(thumbnail_name)
+        with self.captureOnCommitCallbacks(execute=True):
+            uploaded_image.delete()
+        self.assertIsNone(thumbnail_store.lookup(thumbnail_name))
+        self.assertFalse(path.exists(thumbnail_store.path(thumbnail_name)))
+
+    def test_shard_media_files(self):
+        self.client.login(username=self.admin_user.username,
+                          password=self.PASSWORD)
+        test_img_path = path.join(
+            settings.BASE_DIR,
+            'imagehostingapp/tests/testdata/test_img_2.png'
+        )
+        with open(test_img_path, 'rb') as file:
+            image = SimpleUploadedFile(
+                "test_img_2.png", file.read(), content_type="image/png"
+            )
+        response = self.client.post(self.list_upload_image_url, data={'image_path': image})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        uploaded_image = UploadedImages.objects.get(image_author=self.admin_user)
+        sha256 = uploaded_image.image_sha256
+        sharded_name = "user_images/{}/{}/{}.png".format(sha256[:2], sha256[2:4], sha256)
+        self.assertEqual(uploaded_image.image_path.name, sharded_name)
+
+        # move everything back to the flat layout
+        storage = uploaded_image.image_path.storage
+        flat_name = "user_images/{}.png".format(sha256)
+        os.replace(storage.path(sharded_name), storage.path(flat_name))
+        ImageBlob.objects.update(blob_path=flat_name)
+        UploadedImages.objects.update(image_path=flat_name)
+        thumbnail_store = get_thumbnail_store()
+        thumbnail_name = thumbnails.get_thumbnail_name(uploaded_image, 200)
+        os.makedirs(path.dirname(thumbnail_store.path(thumbnail_name)), exist_ok=True)
+        with open(thumbnail_store.path(thumbnail_name), 'wb') as file:
+            file.write(b'thumbnail')
+        thumbnail_store.add(thumbnail_name)
+        os.makedirs(path.dirname(thumbnail_store.legacy_path(thumbnail_name)), exist_ok=True)
+        os.replace(thumbnail_store.path(thumbnail_name), thumbnail_store.legacy_path(thumbnail_name))
+        # flat thumbnails are served until moved
+        self.assertEqual(thumbnail_store.lookup(thumbnail_name), thumbnail_store.legacy_path(thumbnail_name))
+        # stored under another level count, lookup() has forgotten it
+        other_levels_name = thumbnails.get_thumbnail_name(uploaded_image, 400)
+        other_levels_path = sharding.get_sharded_path(
+            thumbnail_store.root, sha256, other_levels_name, settings.MEDIA_SHARD_LEVELS - 1
+        )
+        os.makedirs(path.dirname(other_levels_path), exist_ok=True)
+        with open(other_levels_path, 'wb') as file:
+            file.write(b'thumbnail')
+        self.assertIsNone(thumbnail_store.lookup(other_levels_name))
+
+        call_command('shardmediafiles', grace_sec=0, stdout=io.StringIO())
+        moved_image = UploadedImages.objects.get(pk=uploaded_image.pk)
+        self.assertEqual(moved_image.image_path.name, sharded_name)
+        self.assertEqual(ImageBlob.objects.get().blob_path.name, sharded_name)
+        self.assertTrue(path.exists(storage.path(sharded_name)))
+        self.assertFalse(path.exists(storage.path(flat_name)))
+        self.assertEqual(thumbnail_store.lookup(thumbnail_name), thumbnail_store.path(thumbnail_name))
+        self.assertFalse(path.exists(thumbnail_store.legacy_path(thumbnail_name)))
+        self.assertEqual(thumbnail_store.lookup(other_levels_name), thumbnail_store.path(other_levels_name))
+        self.assertFalse(path.exists(other_levels_path))
+        # nothing left to move on a second run
+        with mock.patch('builtins.print') as mock_print:
+            call_command('shardmediafiles', grace_sec=0)
+        mock_print.assert_called_once_with('Moved 0 blobs, 0 images and 0 thumbnails')
+
+    def test_batch_upload_images(self):
+        self.client.login(username=self.admin_user.username,
+                          password=self.PASSWORD)
+        images = []
+        for test_img_name, content_type in (('test_img_2.png', 'image/png'),
+                                            ('test_img_1.tiff', 'image/tiff'),
+                                            ('test_img_2.png', 'image/png')):
+            test_img_path = path.join(
+                settings.BASE_DIR, 'imagehostingapp/tests/testdata', test_img_name
+            )
+            with open(test_img_path, 'rb') as file:
+                images.append(SimpleUploadedFile(test_img_name, file.read(), content_type))
+        payload = {
+            'image_path': images,
+            'image_desc': ['batch image 1', 'batch image 2', 'batch image 3'],
+            'image_uri_expiry_sec': 400,
+        }
+        # Make request
+        response = self.client.post(reverse('list_upload_image-batch'), data=payload)
+        # Check response status, tiff is rejected and the rest is stored
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        results = response.json()['results']
+        self.assertEqual([result['status'] for result in results], [201, 400, 201])
+        self.assertEqual(results[0]['image_desc'], 'batch image 1')
+        self.assertEqual(results[2]['image_desc'], 'batch image 3')
+        self.assertIn('image_path', results[1]['errors'])
+        uploaded_images = UploadedImages.objects.filter(image_author=self.admin_user)
+        self.assertEqual(uploaded_images.count(), 2)
+        image_temp_tokens = set(uploaded_images.values_list('image_temp_token', flat=True))
+        self.assertEqual(len(image_temp_tokens), 2)
+        self.assertNotIn(None, image_temp_tokens)
+        for uploaded_image in uploaded_images:
+            self.assertEqual(uploaded_image.image_temp_uri, reverse(
+                'download_temp_image', kwargs={'image_temp_id': uploaded_image.image_temp_token}
+            ))
+            self.assertTrue(path.exists(uploaded_image.image_path.path))
+        # both pngs share one blob
+        image_blob = ImageBlob.objects.get()
+        self.assertEqual(image_blob.ref_count, 2)
+        self.assertEqual(set(uploaded_images.values_list('image_blob', flat=True)), {image_blob.pk})
+
+        # blobs of a batch are acquired together, not per file
+        with open(path.join(settings.BASE_DIR, 'imagehostingapp/tests/testdata/test_img_2.png'), 'rb') as file:
+            f_content = file.read()
+        uploaded_files = [(ContentFile(f_content, name='test_img_2.png'), image_blob.sha256, len(f_content))
+                          for _ in range(3)]
+        with CaptureQueriesContext(connection) as queries:
+            image_blobs = ImageBlob.acquire_many(uploaded_files)
+        self.assertEqual(image_blobs[image_blob.sha256].pk, image_blob.pk)
+        self.assertEqual(len([query for query in queries if 'imagehostingapp_imageblob' in query['sql']]), 2)
+        image_blob.refresh_from_db()
+        self.assertEqual(image_blob.ref_count, 5)
+
+    def tearDown(self):
+        restore_media_root(self.media_settings)
+
+
+class ChunkedUploadTestCase(APITestCase):
+    """
+    Test Resumable Chunked Upload of an Image
+    """
+
+    PASSWORD = 'pa$$w0rd'
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.admin_user = User.objects.create_superuser(
+            'superuser1', 'email@domain.tld', cls.PASSWORD
+        )
+        cls.client = APIClient()
+        cls.upload_session_url = reverse('upload_session-list')
+
+    def setUp(self):
+        clear_caches()
+        self.media_settings = override_media_root()
+
+    def _put_chunk(self, session_id, chunk_index, chunk, chunk_sha256=None):
+        return self.client.put(
+            reverse('upload_session-chunk',
+                    kwargs={"session_id": session_id, "chunk_index": chunk_index}),
+            data=chunk, content_type='application/octet-stream',
+            HTTP_X_CHUNK_SHA256=chunk_sha256 or hashlib.sha256(chunk).hexdigest()
+        )
+
+    @override_settings(UPLOAD_CHUNK_SIZE=1024)
+    def test_chunked_upload_image_png(self):
+        self.client.login(username=self.admin_user.username,
+                          password=self.PASSWORD)
+        test_img_path = path.join(
+            settings.BASE_DIR,
+            'imagehostingapp/tests/testdata/test_img_2.png'
+        )
+        with open(test_img_path, 'rb') as file:
+            f_content = file.read()
+        # Start session
+        response = self.client.post(self.upload_session_url, data={
+            'file_name': 'test_img_2.png',
+            'content_type': 'image/png',
+            'total_size': len(f_content),
+            'image_desc': 'some random image 8',
+        })
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        session_id = response.json()['session_id']
+        chunk_count = response.json()['chunk_count']
+        self.assertEqual(response.json()['missing_chunks'], list(range(chunk_count)))
+        chunks = [f_content[index * 1024:(index + 1) * 1024] for index in range(chunk_count)]
+
+        # Corrupted chunk is refused
+        response = self._put_chunk(session_id, 0, chunks[0], chunk_sha256='0' * 64)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # Upload all chunks but the first one, in reverse
+        for chunk_index in reversed(range(1, chunk_count)):
+            response = self._put_chunk(session_id, chunk_index, chunks[chunk_index])
+            self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        # Finalize refuses incomplete uploads
+        finalize_url = reverse('upload_session-finalize', kwargs={"session_id": session_id})
+        response = self.client.post(finalize_url)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+        # Resume
+        response = self.client.get(
+            reverse('upload_session-detail', kwargs={"session_id": session_id})
+        )
+        self.assertEqual(response.json()['missing_chunks'], [0])
+        response = self._put_chunk(session_id, 0, chunks[0])
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        response = self.client.post(finalize_url)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertJSONEqual(
+            json.dumps({'image_desc': 'some random image 8',
+                        'image_author': 'superuser1',
+                        'image_uri_expiry_sec': -1}),
+            response.json()
+        )
+        uploaded_image = UploadedImages.objects.get(image_author=self.admin_user)
+        with uploaded_image.image_path.open('rb') as file:
+            self.assertEqual(file.read(), f_content)
+
+    def tearDown(self):
+        restore_media_root(self.media_settings)
+
+
+class ListImagesPaginationTestCase(APITestCase):
+    """
+    Test Listing Images a page at a time
+    """
+
+    PASSWORD = 'pa$$w0rd'
+
     @classmethod
-    def tearDownClass(cls):
-        super().tearDownClass()
-        # remove test files uploaded
-        upload_folder = path.join(settings.MEDIA_ROOT, "user_images")
-        for test_file in os.listdir(upload_folder):
-            if test_file.startswith("test_img_"):
-                os.remove(path.join(upload_folder, test_file))
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.admin_user = User.objects.create_superuser(
+            'superuser1', 'email@domain.tld', cls.PASSWORD
+        )
+        cls.client = APIClient()
+        cls.list_upload_image_url = reverse('list_upload_image-list')
+
+    def setUp(self):
+        clear_caches()
+
+    def test_list_images_keyset_pagination(self):
+        for index in range(5):
+            UploadedImages.objects.create(
+                image_author=self.admin_user,
+                image_desc='some random image {}'.format(index),
+                image_path='user_images/test_img_{}.png'.format(index),
+            )
+        self.client.login(username=self.admin_user.username,
+                          password=self.PASSWORD)
+        # Walk forward
+        response = self.client.get(self.list_upload_image_url, {'page_size': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        image_names = [image['image_name'] for image in response.json()['results']]
+        self.assertIsNone(response.json()['previous'])
+        while response.json()['next']:
+            response = self.client.get(response.json()['next'])
+            image_names += [image['image_name'] for image in response.json()['results']]
+        self.assertEqual(image_names, ['user_images/test_img_{}.png'.format(index)
+                                       for index in range(5)])
+
+        # Walk back from the last page
+        response = self.client.get(response.json()['previous'])
+        self.assertEqual([image['image_name'] for image in response.json()['results']],
+                         ['user_images/test_img_2.png', 'user_images/test_img_3.png'])
+
+        # Invalid cursor
+        response = self.client.get(self.list_upload_image_url, {'cursor': 'bogus'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
 
 class DownloadImageTestCase(APITestCase):
@@ -168,6 +698,10 @@ class DownloadImageTestCase(APITestCase):
         cls.client = APIClient()
         cls.list_upload_image_url = reverse('list_upload_image-list')
 
+    def setUp(self):
+        clear_caches()
+        self.media_settings = override_media_root()
+
     def test_download_image_subscribed_user(self):
         # create subscription
         self.account_tier.thumbnail_sizes.add(*[self.thumbnail_size])
@@ -201,15 +735,172 @@ class DownloadImageTestCase(APITestCase):
         response = self.client.get(download_image_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertIn('image/png', response._content_type_for_repr)
+        self.assertEqual(b''.join(response.streaming_content), f_content)
 
-    @classmethod
-    def tearDownClass(cls):
-        super().tearDownClass()
-        # remove test files uploaded
-        upload_folder = path.join(settings.MEDIA_ROOT, "user_images")
-        for test_file in os.listdir(upload_folder):
-            if test_file.startswith("test_img_"):
-                os.remove(path.join(upload_folder, test_file))
+        # Deleted image should not be served from cached metadata
+        UploadedImages.objects.filter(image_id=image_uuid).delete()
+        response = self.client.get(download_image_url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_download_image_async_views(self):
+        # create subscription
+        self.account_tier.thumbnail_sizes.add(*[self.thumbnail_size])
+        Subscription.objects.create(user=self.admin_user, tier=self.account_tier)
+        test_img_path = path.join(
+            settings.BASE_DIR,
+            'imagehostingapp/tests/testdata/test_img_2.png'
+        )
+        with open(test_img_path, 'rb') as file:
+            f_content = file.read()
+        uploaded_image = UploadedImages.objects.create(
+            image_desc='some random image async', image_author=self.admin_user,
+            image_path=SimpleUploadedFile("test_img_2.png", f_content, content_type="image/png"),
+        )
+
+        def make_request(url, username=self.admin_user.username, password=self.PASSWORD):
+            credentials = base64.b64encode(f"{username}:{password}".encode()).decode()
+            request = RequestFactory().get(url, HTTP_AUTHORIZATION=f"Basic {credentials}")
+            request.client_ip = '127.0.0.1'
+            return request
+
+        download_image_url = reverse('download_image', kwargs={"image_id": uploaded_image.image_id})
+        response = async_to_sync(async_views.download_image)(
+            make_request(download_image_url, password='wrong'), image_id=uploaded_image.image_id
+        )
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        response = async_to_sync(async_views.download_image)(
+            make_request(download_image_url), image_id=uploaded_image.image_id
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # body is pulled off the event loop and sent a part at a time
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        async_to_sync(StreamingASGIHandler().send_response)(response, send)
+        self.assertEqual(messages[0]['status'], status.HTTP_200_OK)
+        self.assertIn((b'Accept-Ranges', b'bytes'), messages[0]['headers'])
+        self.assertEqual(b''.join(message.get('body', b'') for message in messages[1:]), f_content)
+        self.assertEqual(messages[-1], {'type': 'http.response.body'})
+
+        response = async_to_sync(async_views.download_image_thumbnail)(
+            make_request(download_image_url), image_id=uploaded_image.image_id, thumbnail_size_px=200
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = async_to_sync(async_views.list_upload_images)(
+            make_request(self.list_upload_image_url)
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content)['results'][0]['image_desc'],
+                         'some random image async')
+
+    def test_download_image_conditional_and_range(self):
+        # create subscription
+        self.account_tier.thumbnail_sizes.add(*[self.thumbnail_size])
+        Subscription.objects.create(user=self.admin_user, tier=self.account_tier)
+        # login
+        self.client.login(username=self.admin_user.username,
+                          password=self.PASSWORD)
+        test_img_path = path.join(
+            settings.BASE_DIR,
+            'imagehostingapp/tests/testdata/test_img_2.png'
+        )
+        with open(test_img_path, 'rb') as file:
+            f_content = file.read()
+        image = SimpleUploadedFile(
+            "test_img_2.png", f_content, content_type="image/png"
+        )
+        payload = {
+            'image_desc': 'some random image 4',
+            'image_path': image,
+        }
+        # Make request
+        response = self.client.post(self.list_upload_image_url, data=payload)
+        # Check response status
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        image_uuid = response.json()["image_url"].split("/")[-2]
+        download_image_url = reverse('download_image', kwargs={"image_id": image_uuid})
+        response = self.client.get(download_image_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        etag = response['ETag']
+        last_modified = response['Last-Modified']
+
+        # Conditional requests
+        response = self.client.get(download_image_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        response = self.client.get(download_image_url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # Single range
+        response = self.client.get(download_image_url, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/{}'.format(len(f_content)))
+        self.assertEqual(b''.join(response.streaming_content), f_content[10:20])
+
+        # Multiple ranges
+        response = self.client.get(download_image_url, HTTP_RANGE='bytes=0-3,-4')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertIn('multipart/byteranges', response['Content-Type'])
+        body = b''.join(response.streaming_content)
+        self.assertEqual(len(body), int(response['Content-Length']))
+        self.assertIn(f_content[:4], body)
+        self.assertIn(f_content[-4:], body)
+
+        # Stale If-Range falls back to the whole file
+        response = self.client.get(download_image_url, HTTP_RANGE='bytes=10-19',
+                                   HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # Unsatisfiable range
+        response = self.client.get(download_image_url,
+                                   HTTP_RANGE='bytes={}-'.format(len(f_content)))
+        self.assertEqual(response.status_code,
+                         status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+
+    @override_settings(IMAGE_SERVING_MODE='x-accel-redirect',
+                       IMAGE_SERVING_INTERNAL_PREFIX='/protected-media/')
+    def test_download_image_x_accel_redirect(self):
+        # create subscription
+        self.account_tier.thumbnail_sizes.add(*[self.thumbnail_size])
+        Subscription.objects.create(user=self.admin_user, tier=self.account_tier)
+        # login
+        self.client.login(username=self.admin_user.username,
+                          password=self.PASSWORD)
+        test_img_path = path.join(
+            settings.BASE_DIR,
+            'imagehostingapp/tests/testdata/test_img_2.png'
+        )
+        with open(test_img_path, 'rb') as file:
+            f_content = file.read()
+        image = SimpleUploadedFile(
+            "test_img_2.png", f_content, content_type="image/png"
+        )
+        payload = {
+            'image_desc': 'some random image 5',
+            'image_path': image,
+        }
+        # Make request
+        response = self.client.post(self.list_upload_image_url, data=payload)
+        # Check response status
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        image_uuid = response.json()["image_url"].split("/")[-2]
+        download_image_url = reverse('download_image', kwargs={"image_id": image_uuid})
+        # Make request, file should be left to the proxy
+        response = self.client.get(download_image_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['X-Accel-Redirect'].startswith('/protected-media/user_images/'))
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['Content-Disposition'],
+                         'attachment; filename="test_img_2.png"')
+
+    def tearDown(self):
+        restore_media_root(self.media_settings)
 
 
 class DownloadImageInvalidTestCase(APITestCase):
@@ -235,6 +926,10 @@ class DownloadImageInvalidTestCase(APITestCase):
         cls.client = APIClient()
         cls.list_upload_image_url = reverse('list_upload_image-list')
 
+    def setUp(self):
+        clear_caches()
+        self.media_settings = override_media_root()
+
     def test_download_image_subscribed_user(self):
         # create subscription
         self.account_tier.thumbnail_sizes.add(*[self.thumbnail_size])
@@ -265,14 +960,8 @@ class DownloadImageInvalidTestCase(APITestCase):
         self.assertIn("image_url_thumbnail_200", response_json,
                       "Response should have thumbnail URL.")
 
-    @classmethod
-    def tearDownClass(cls):
-        super().tearDownClass()
-        # remove test files uploaded
-        upload_folder = path.join(settings.MEDIA_ROOT, "user_images")
-        for test_file in os.listdir(upload_folder):
-            if test_file.startswith("test_img_"):
-                os.remove(path.join(upload_folder, test_file))
+    def tearDown(self):
+        restore_media_root(self.media_settings)
 
 
 class DownloadThumbnailTestCase(APITestCase):
@@ -298,6 +987,10 @@ class DownloadThumbnailTestCase(APITestCase):
         cls.client = APIClient()
         cls.list_upload_image_url = reverse('list_upload_image-list')
 
+    def setUp(self):
+        clear_caches()
+        self.media_settings = override_media_root()
+
     def test_download_thumbnail_subscribed_user(self):
         # create subscription
         self.account_tier.thumbnail_sizes.add(*[self.thumbnail_size])
@@ -353,14 +1046,538 @@ class DownloadThumbnailTestCase(APITestCase):
             response.json()
         )
 
+    @override_settings(THUMBNAIL_VARIANT_FORMATS=['WEBP'])
+    def test_download_thumbnail_negotiates_variant(self):
+        self.account_tier.thumbnail_sizes.add(*[self.thumbnail_size])
+        Subscription.objects.create(user=self.admin_user, tier=self.account_tier)
+        self.client.login(username=self.admin_user.username,
+                          password=self.PASSWORD)
+        test_img_path = path.join(
+            settings.BASE_DIR,
+            'imagehostingapp/tests/testdata/test_img_2.png'
+        )
+        with open(test_img_path, 'rb') as file:
+            f_content = file.read()
+        uploaded_image = UploadedImages.objects.create(
+            image_desc='some random image 6', image_author=self.admin_user,
+            image_path=SimpleUploadedFile("test_img_2.png", f_content, content_type="image/png"),
+        )
+        download_thumbnail_url = reverse(
+            'download_image_thumbnail',
+            kwargs={"image_id": uploaded_image.image_id,
+                    "thumbnail_size_px": self.thumbnail_size.thumbnail_size_px}
+        )
+        # browsers list WebP explicitly
+        response = self.client.get(
+            download_thumbnail_url, HTTP_ACCEPT='image/avif,image/webp,image/*,*/*;q=0.8'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        self.assertIn('Accept', response['Vary'])
+        self.assertIn('400px_test_img_2.webp', response['Content-Disposition'])
+        with Image.open(io.BytesIO(b''.join(response.streaming_content))) as thumbnail:
+            self.assertEqual(thumbnail.format, 'WEBP')
+        # wildcards, or WebP refused, get the source format
+        for accept_header in ('*/*', 'image/webp;q=0,image/png,*/*;q=0.5'):
+            response = self.client.get(download_thumbnail_url, HTTP_ACCEPT=accept_header)
+            self.assertEqual(response['Content-Type'], 'image/png')
+            self.assertIn('Accept', response['Vary'])
+        # variants are stored apart
+        self.assertNotEqual(thumbnails.get_thumbnail_name(uploaded_image, 400, 'WEBP'),
+                            thumbnails.get_thumbnail_name(uploaded_image, 400))
+
+    def test_download_thumbnail_render_queue_saturated(self):
+        # create subscription
+        self.account_tier.thumbnail_sizes.add(*[self.thumbnail_size])
+        Subscription.objects.create(user=self.admin_user, tier=self.account_tier)
+        self.client.login(username=self.admin_user.username,
+                          password=self.PASSWORD)
+        test_img_path = path.join(
+            settings.BASE_DIR,
+            'imagehostingapp/tests/testdata/test_img_2.png'
+        )
+        with open(test_img_path, 'rb') as file:
+            f_content = file.read()
+        uploaded_image = UploadedImages.objects.create(
+            image_desc='some random image 6', image_author=self.admin_user,
+            image_path=SimpleUploadedFile("test_img_2.png", f_content, content_type="image/png"),
+        )
+        download_thumbnail_url = reverse(
+            'download_image_thumbnail',
+            kwargs={"image_id": uploaded_image.image_id,
+                    "thumbnail_size_px": self.thumbnail_size.thumbnail_size_px}
+        )
+        # Make request, no room in the render queue
+        with override_settings(THUMBNAIL_RENDER_QUEUE_LIMIT=0, THUMBNAIL_RENDER_RETRY_AFTER_SEC=7):
+            response = self.client.get(download_thumbnail_url)
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], '7')
+        # rendered in the pool once there is room
+        response = self.client.get(download_thumbnail_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        with Image.open(io.BytesIO(b''.join(response.streaming_content))) as thumbnail:
+            self.assertEqual(thumbnail.format, 'PNG')
+            self.assertLessEqual(thumbnail.size[1], self.thumbnail_size.thumbnail_size_px)
+
+    def test_download_thumbnail_render_failed(self):
+        # create subscription
+        self.account_tier.thumbnail_sizes.add(*[self.thumbnail_size])
+        Subscription.objects.create(user=self.admin_user, tier=self.account_tier)
+        self.client.login(username=self.admin_user.username,
+                          password=self.PASSWORD)
+        test_img_path = path.join(
+            settings.BASE_DIR,
+            'imagehostingapp/tests/testdata/test_img_2.png'
+        )
+        with open(test_img_path, 'rb') as file:
+            f_content = file.read()
+        uploaded_image = UploadedImages.objects.create(
+            image_desc='some random image 6', image_author=self.admin_user,
+            image_path=SimpleUploadedFile("test_img_2.png", f_content, content_type="image/png"),
+        )
+        download_thumbnail_url = reverse(
+            'download_image_thumbnail',
+            kwargs={"image_id": uploaded_image.image_id,
+                    "thumbnail_size_px": self.thumbnail_size.thumbnail_size_px}
+        )
+        # the job's own timeout, and a render worker killed mid-job
+        for render_error in (TimeoutError("Thumbnail rendering timed out."), BrokenProcessPool()):
+            rendered = Future()
+            rendered.set_exception(render_error)
+            render_pool = mock.Mock()
+            render_pool.submit.return_value = rendered
+            with mock.patch('imagehostingapp.thumbnails._get_render_pool', return_value=render_pool), \
+                    override_settings(THUMBNAIL_RENDER_RETRY_AFTER_SEC=7):
+                response = self.client.get(download_thumbnail_url)
+            self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertEqual(response['Retry-After'], '7')
+
+    def tearDown(self):
+        restore_media_root(self.media_settings)
+
+
+class ThumbnailPregenerationTestCase(APITestCase):
+    """
+    Test Thumbnails are rendered in background after Upload
+    """
+
+    PASSWORD = 'pa$$w0rd'
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.admin_user = User.objects.create_superuser(
+            'superuser2', 'email@domain.tld', cls.PASSWORD
+        )
+        cls.thumbnail_size = \
+            ImageThumbnailSize.objects.create(thumbnail_size_px=200)
+        cls.account_tier = AccountTiers.objects.create(
+            account_tier_name="Basic",
+            is_original_image_url_present=False,
+            is_expiring_links_available=False
+        )
+        cls.client = APIClient()
+        cls.list_upload_image_url = reverse('list_upload_image-list')
+
+    def setUp(self):
+        clear_caches()
+        self.media_settings = override_media_root()
+
+    def test_thumbnails_pregenerated_on_upload(self):
+        # create subscription
+        self.account_tier.thumbnail_sizes.add(*[self.thumbnail_size])
+        Subscription.objects.create(user=self.admin_user, tier=self.account_tier)
+        # login
+        self.client.login(username=self.admin_user.username,
+                          password=self.PASSWORD)
+        test_img_path = path.join(
+            settings.BASE_DIR,
+            'imagehostingapp/tests/testdata/test_img_2.png'
+        )
+        with open(test_img_path, 'rb') as file:
+            f_content = file.read()
+        image = SimpleUploadedFile(
+            "test_img_2.png", f_content, content_type="image/png"
+        )
+        payload = {
+            'image_desc': 'some random image 7',
+            'image_path': image,
+        }
+        # Make request, and keep hold of the background jobs
+        scheduled_jobs = []
+        schedule_thumbnails = thumbnails.schedule_thumbnails
+        with mock.patch.object(
+                thumbnails, 'schedule_thumbnails',
+                side_effect=lambda obj: scheduled_jobs.append(schedule_thumbnails(obj))):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(self.list_upload_image_url, data=payload)
+        # Check response status
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(scheduled_jobs), 1, "Thumbnails should be queued once")
+        scheduled_jobs[0].result(timeout=30)
+
+        uploaded_image = UploadedImages.objects.get(image_author=self.admin_user)
+        thumbnail_name = thumbnails.get_thumbnail_name(uploaded_image, 200)
+        self.assertTrue(get_thumbnail_store().lookup(thumbnail_name),
+                        "Thumbnail should be pre-generated")
+
+    def test_backfill_thumbnails_single_decode(self):
+        # create subscription with two sizes
+        self.account_tier.thumbnail_sizes.add(
+            self.thumbnail_size, ImageThumbnailSize.objects.create(thumbnail_size_px=100)
+        )
+        Subscription.objects.create(user=self.admin_user, tier=self.account_tier)
+        test_img_path = path.join(
+            settings.BASE_DIR,
+            'imagehostingapp/tests/testdata/test_img_2.png'
+        )
+        with open(test_img_path, 'rb') as file:
+            f_content = file.read()
+        uploaded_image = UploadedImages.objects.create(
+            image_desc='some random image 8', image_author=self.admin_user,
+            image_path=SimpleUploadedFile("test_img_2.png", f_content, content_type="image/png"),
+        )
+        with mock.patch.object(imaging.Image, 'open', wraps=Image.open) as image_open:
+            call_command('backfillthumbnails', user=self.admin_user.username, stdout=io.StringIO())
+        self.assertEqual(image_open.call_count, 1, "Original should be decoded once")
+        for height in (100, 200):
+            thumbnail_path = get_thumbnail_store().lookup(
+                thumbnails.get_thumbnail_name(uploaded_image, height)
+            )
+            self.assertTrue(thumbnail_path, f"{height}px thumbnail should be backfilled")
+            with Image.open(thumbnail_path) as thumbnail:
+                self.assertEqual(thumbnail.size[1], height)
+        # nothing left to do on the next run
+        with mock.patch.object(imaging.Image, 'open', wraps=Image.open) as image_open:
+            call_command('backfillthumbnails', stdout=io.StringIO())
+        self.assertEqual(image_open.call_count, 0)
+
+    def tearDown(self):
+        restore_media_root(self.media_settings)
+
+
+class EntitlementsTestCase(APITestCase):
+    """
+    Test cached Subscription Entitlements
+    """
+
+    PASSWORD = 'pa$$w0rd'
+
     @classmethod
-    def tearDownClass(cls):
-        super().tearDownClass()
-        # remove test files uploaded
-        upload_folder = path.join(settings.MEDIA_ROOT, "user_images")
-        for test_file in os.listdir(upload_folder):
-            if test_file.startswith("test_img_"):
-                os.remove(path.join(upload_folder, test_file))
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.admin_user = User.objects.create_superuser(
+            'superuser3', 'email@domain.tld', cls.PASSWORD
+        )
+        cls.thumbnail_size = \
+            ImageThumbnailSize.objects.create(thumbnail_size_px=200)
+        cls.account_tier = AccountTiers.objects.create(
+            account_tier_name="Basic",
+            is_original_image_url_present=False,
+            is_expiring_links_available=False
+        )
+
+    def setUp(self):
+        clear_caches()
+
+    def test_entitlements_cached_and_invalidated(self):
+        self.assertIsNone(entitlements.get_entitlements(self.admin_user))
+        # create subscription
+        self.account_tier.thumbnail_sizes.add(*[self.thumbnail_size])
+        Subscription.objects.create(user=self.admin_user, tier=self.account_tier)
+        user_entitlements = entitlements.get_entitlements(self.admin_user)
+        self.assertEqual(user_entitlements.tier_name, "Basic")
+        self.assertEqual(user_entitlements.thumbnail_sizes, (200,))
+        self.assertEqual(user_entitlements.encoder_profiles, {200: 'balanced'})
+
+        # steady state makes no queries
+        with self.assertNumQueries(0):
+            entitlements.get_entitlements(self.admin_user)
+
+        # tier changes are picked up
+        self.account_tier.thumbnail_sizes.add(
+            ImageThumbnailSize.objects.create(thumbnail_size_px=400)
+        )
+        self.assertEqual(entitlements.get_entitlements(self.admin_user).thumbnail_sizes,
+                         (200, 400))
+        self.account_tier.is_original_image_url_present = True
+        self.account_tier.save()
+        self.assertTrue(entitlements.get_entitlements(self.admin_user).is_original_image_url_present)
+        Subscription.objects.filter(user=self.admin_user).delete()
+        self.assertIsNone(entitlements.get_entitlements(self.admin_user))
+
+
+class ImagingTestCase(SimpleTestCase):
+    """
+    Test thumbnail resize engine fast paths
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+    def test_render_thumbnail_jpeg_draft(self):
+        image_path = benchmarking.create_sample_image(
+            path.join(self.temp_dir.name, 'sample.jpg'), size=(1600, 1200)
+        )
+        with Image.open(image_path) as img_file:
+            thumbnail = imaging.render_thumbnail(img_file, 150)
+            # decoded at a DCT-domain scale, not at full resolution
+            self.assertLess(img_file.size, (1600, 1200))
+        self.assertEqual(thumbnail.size, (200, 150))
+
+    def test_render_thumbnails_cascade(self):
+        image_path = benchmarking.create_sample_image(
+            path.join(self.temp_dir.name, 'sample.jpg'), size=(1600, 1200)
+        )
+        with Image.open(image_path) as img_file:
+            rendered_thumbnails = imaging.render_thumbnails(img_file, [100, 400, 200])
+        self.assertEqual({height: thumbnail.size for height, thumbnail in rendered_thumbnails.items()},
+                         {400: (533, 400), 200: (267, 200), 100: (133, 100)})
+
+    def test_render_thumbnail_png_not_enlarged(self):
+        image_path = benchmarking.create_sample_image(
+            path.join(self.temp_dir.name, 'sample.png'), size=(300, 200), image_format='PNG'
+        )
+        with Image.open(image_path) as img_file:
+            self.assertEqual(imaging.render_thumbnail(img_file, 100).size, (150, 100))
+        with Image.open(image_path) as img_file:
+            self.assertEqual(imaging.render_thumbnail(img_file, 500).size, (300, 200))
+
+    def test_encode_thumbnail_profiles(self):
+        image_path = benchmarking.create_sample_image(
+            path.join(self.temp_dir.name, 'sample.jpg'), size=(1600, 1200)
+        )
+        with Image.open(image_path) as img_file:
+            thumbnail = imaging.render_thumbnail(img_file, 200)
+        encoded_files = {}
+        for encoder_profile in ('pillow-default', 'balanced'):
+            encoded_files[encoder_profile] = io.BytesIO()
+            imaging.encode_thumbnail(thumbnail, encoded_files[encoder_profile], 'JPEG', encoder_profile)
+        with Image.open(encoded_files['balanced']) as img_file:
+            self.assertTrue(img_file.info.get('progressive'))
+        self.assertLess(encoded_files['balanced'].tell(), encoded_files['pillow-default'].tell())
+
+        # small PNG thumbnails are palette quantized by the compact profile
+        png_file = io.BytesIO()
+        imaging.encode_thumbnail(thumbnail, png_file, 'PNG', 'compact')
+        with Image.open(png_file) as img_file:
+            self.assertEqual(img_file.mode, 'P')
+
+    def test_benchmark_thumbnails_regression_gate(self):
+        baseline_path = path.join(self.temp_dir.name, 'thumbnails.json')
+        benchmark_options = {
+            'source_kind': ['PNG-P'], 'source_size': ['64x48'], 'height': [20], 'repeat': 1,
+            'baseline': baseline_path, 'stdout': io.StringIO(),
+        }
+        with mock.patch('builtins.print'):
+            call_command('benchthumbnails', update_baseline=True, **benchmark_options)
+        with open(baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)
+        self.assertEqual(list(baseline['cases']), ['PNG-P-64x48-20px-balanced'])
+        self.assertGreater(baseline['cases']['PNG-P-64x48-20px-balanced']['ns_per_pixel']['total'], 0)
+
+        # a baseline far faster than this run fails the gate
+        baseline['cases']['PNG-P-64x48-20px-balanced']['ns_per_pixel']['total'] /= 1000
+        with open(baseline_path, 'w') as baseline_file:
+            json.dump(baseline, baseline_file)
+        with mock.patch('builtins.print'), self.assertRaisesMessage(CommandError, '1 of 1 cases regressed'):
+            call_command('benchthumbnails', **benchmark_options)
+
+
+class LoadTestReportTestCase(SimpleTestCase):
+    """
+    Test load test report statistics
+    """
+
+    def test_percentiles_and_baseline_comparison(self):
+        latencies = sorted(float(latency) for latency in range(1, 101))
+        self.assertEqual(loadtest.percentile(latencies, 0.50), 50.0)
+        self.assertEqual(loadtest.percentile(latencies, 0.99), 99.0)
+        self.assertEqual(loadtest.percentile([7.0], 0.95), 7.0)
+        self.assertEqual(loadtest.percentile([], 0.95), 0.0)
+
+        baseline = {'workloads': {
+            'list': {'throughput_rps': 100.0, 'latency_ms': {'p95': 10.0}},
+            'upload': {'throughput_rps': 0.0, 'latency_ms': {'p95': 0.0}},
+        }}
+        report = {'workloads': {
+            'list': {'throughput_rps': 80.0, 'latency_ms': {'p95': 15.0}},
+            'upload': {'throughput_rps': 20.0, 'latency_ms': {'p95': 50.0}},
+            'thumbnail': {'throughput_rps': 50.0, 'latency_ms': {'p95': 5.0}},
+        }}
+        comparison = loadtest.compare_reports(report, baseline)
+        self.assertEqual([workload for workload, _, _ in comparison], ['list'])
+        _, throughput_change, p95_change = comparison[0]
+        self.assertAlmostEqual(throughput_change, -0.2)
+        self.assertAlmostEqual(p95_change, 0.5)
+
+
+class QueuedLoggingTestCase(SimpleTestCase):
+    """
+    Test log records written by the listener thread, sampled and rate limited
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+    def test_workers_share_rotated_log_file(self):
+        log_path = path.join(self.temp_dir.name, 'app.log')
+        # one handler per gunicorn worker, all on the same file
+        handlers = [
+            log.QueuedRotatingFileHandler(log_path, maxBytes=500, backupCount=50) for _ in range(2)
+        ]
+        for worker, handler in enumerate(handlers):
+            logger = logging.getLogger('test.queued.worker{}'.format(worker))
+            logger.propagate = False
+            logger.addHandler(handler)
+            self.addCleanup(logger.removeHandler, handler)
+            self.addCleanup(handler.close)
+        for line in range(200):
+            logging.getLogger('test.queued.worker{}'.format(line % 2)).warning('line %s', line)
+        log.flush()
+        lines = []
+        for file_name in os.listdir(self.temp_dir.name):
+            if file_name.startswith('app.log') and not file_name.endswith('.lock'):
+                with open(path.join(self.temp_dir.name, file_name)) as log_file:
+                    lines.extend(log_file.read().splitlines())
+                self.assertLessEqual(path.getsize(path.join(self.temp_dir.name, file_name)), 500)
+        # rotated, nothing lost or overwritten
+        self.assertGreater(len(os.listdir(self.temp_dir.name)), 3)
+        self.assertEqual(sorted(lines), sorted('line {}'.format(line) for line in range(200)))
+
+    def test_sampling_and_rate_limit_filters(self):
+        debug_record = logging.makeLogRecord({'name': 'test', 'levelno': logging.DEBUG})
+        error_record = logging.makeLogRecord({'name': 'test', 'levelno': logging.ERROR})
+        sampling_filter = log.SamplingFilter(rate=0, max_level='DEBUG')
+        self.assertFalse(sampling_filter.filter(debug_record))
+        self.assertTrue(sampling_filter.filter(error_record))
+
+        rate_limit_filter = log.RateLimitFilter(rate=0.001, burst=3)
+        self.assertEqual([rate_limit_filter.filter(debug_record) for _ in range(5)],
+                         [True, True, True, False, False])
+        self.assertTrue(rate_limit_filter.filter(error_record))
+        # limited per logger
+        self.assertTrue(rate_limit_filter.filter(logging.makeLogRecord({'name': 'other', 'levelno': logging.DEBUG})))
+        # 0 is no limit, not an empty bucket
+        unlimited_filter = log.RateLimitFilter(rate=0, burst=0)
+        self.assertTrue(all(unlimited_filter.filter(debug_record) for _ in range(1000)))
+
+    def test_rate_limited_records_counted(self):
+        log_path = path.join(self.temp_dir.name, 'app.log')
+        handler = log.QueuedRotatingFileHandler(log_path)
+        handler.addFilter(log.RateLimitFilter(rate=0.001, burst=3))
+        logger = logging.getLogger('test.queued.rate_limit')
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        self.addCleanup(handler.close)
+        for line in range(10):
+            logger.info('line %s', line)
+        logger.warning('after the burst')
+        log.flush()
+        with open(log_path) as log_file:
+            lines = log_file.read().splitlines()
+        # reported ahead of the next records the listener writes
+        self.assertEqual(sorted(lines), sorted(['7 log records dropped by the rate limit.',
+                                                'line 0', 'line 1', 'line 2', 'after the burst']))
+
+
+class ThumbnailStoreTestCase(SimpleTestCase):
+    """
+    Test Thumbnail Store hits and LRU eviction
+    """
+
+    def setUp(self):
+        self.store_root = tempfile.TemporaryDirectory()
+        self.thumbnail_store = ThumbnailStore(self.store_root.name, budget_bytes=250)
+
+    def _write_thumbnail(self, name, size):
+        os.makedirs(path.dirname(self.thumbnail_store.path(name)), exist_ok=True)
+        with open(self.thumbnail_store.path(name), 'wb') as file:
+            file.write(b'0' * size)
+        return self.thumbnail_store.add(name)
+
+    def test_thumbnail_store_hit_and_miss(self):
+        self.assertIsNone(self.thumbnail_store.lookup('image-1/200px.png'))
+        thumbnail_path = self._write_thumbnail('image-1/200px.png', 100)
+        self.assertEqual(self.thumbnail_store.lookup('image-1/200px.png'), thumbnail_path)
+        self.assertEqual(self.thumbnail_store.usage(), 100)
+
+    def test_thumbnail_store_evicts_least_recently_used(self):
+        self._write_thumbnail('image-1/200px.png', 100)
+        self._write_thumbnail('image-2/200px.png', 100)
+        # exceed the budget, the oldest thumbnail should go
+        self._write_thumbnail('image-3/200px.png', 100)
+        self.assertIsNone(self.thumbnail_store.lookup('image-1/200px.png'))
+        self.assertFalse(path.exists(self.thumbnail_store.path('image-1/200px.png')))
+        self.assertIsNotNone(self.thumbnail_store.lookup('image-3/200px.png'))
+        self.assertEqual(self.thumbnail_store.usage(), 200)
+
+    def tearDown(self):
+        self.store_root.cleanup()
+
+
+class MultiVolumeStorageTestCase(SimpleTestCase):
+    """
+    Test Image placement over weighted volumes and rebalancing
+    """
+
+    def setUp(self):
+        self.volumes_root = tempfile.TemporaryDirectory()
+        self.file_names = ['user_images/{:04d}.png'.format(index) for index in range(2000)]
+
+    def _volume_spec(self, name, weight):
+        return '{}={}:{}'.format(name, path.join(self.volumes_root.name, name), weight)
+
+    def test_volume_ring_weighted_and_minimal_movement(self):
+        ring = VolumeRing([('disk1', 3), ('disk2', 1)])
+        owners = {name: ring.get_volumes(name)[0] for name in self.file_names}
+        disk1_share = list(owners.values()).count('disk1') / len(owners)
+        self.assertGreater(disk1_share, 0.65)
+        self.assertLess(disk1_share, 0.85)
+
+        # a new volume only takes files over, and from where reads fall back to
+        grown_ring = VolumeRing([('disk1', 3), ('disk2', 1), ('disk3', 2)])
+        moved_names = [name for name in self.file_names
+                       if grown_ring.get_volumes(name)[0] != owners[name]]
+        for name in moved_names:
+            self.assertEqual(grown_ring.get_volumes(name)[:2], ['disk3', owners[name]])
+        moved_share = len(moved_names) / len(self.file_names)
+        self.assertGreater(moved_share, 0.2)
+        self.assertLess(moved_share, 0.45)
+
+    def test_storage_reads_and_rebalance(self):
+        storage = UploadedImages._meta.get_field('image_path').storage
+        volume_specs = [self._volume_spec('disk1', 1), self._volume_spec('disk2', 1)]
+        with override_settings(MEDIA_VOLUMES=volume_specs):
+            for name in self.file_names[:50]:
+                storage.save(name, ContentFile(name.encode()))
+            for name in self.file_names[:50]:
+                self.assertTrue(storage.path(name).startswith(storage.volumes[storage.get_volume(name)]))
+
+        with override_settings(MEDIA_VOLUMES=volume_specs + [self._volume_spec('disk3', 1)]):
+            # found without a db lookup before and after the files are moved
+            for name in self.file_names[:50]:
+                with storage.open(name) as file:
+                    self.assertEqual(file.read(), name.encode())
+            with mock.patch('builtins.print') as mock_print:
+                call_command('rebalancemedia', grace_sec=0)
+            moved_count = int(mock_print.call_args[0][0].split()[1])
+            self.assertGreater(moved_count, 0)
+            for name in self.file_names[:50]:
+                owner_path = storage.get_volume_path(storage.get_volume(name), name)
+                self.assertEqual(storage.path(name), owner_path)
+                with open(owner_path, 'rb') as file:
+                    self.assertEqual(file.read(), name.encode())
+                other_paths = [storage.get_volume_path(volume, name) for volume in storage.volumes
+                               if storage.get_volume_path(volume, name) != owner_path]
+                self.assertFalse(any(path.exists(other_path) for other_path in other_paths))
+
+    def tearDown(self):
+        self.volumes_root.cleanup()
 
 
 class DownloadTempImageTestCase(APITestCase):
@@ -386,6 +1603,10 @@ class DownloadTempImageTestCase(APITestCase):
         cls.client = APIClient()
         cls.list_upload_image_url = reverse('list_upload_image-list')
 
+    def setUp(self):
+        clear_caches()
+        self.media_settings = override_media_root()
+
     def test_download_temp_url_subscribed_user(self):
         # create subscription
         self.account_tier.thumbnail_sizes.add(*[self.thumbnail_size])
@@ -423,6 +1644,21 @@ class DownloadTempImageTestCase(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertIn('image/png', response._content_type_for_repr)
 
+        # Expired temp link
+        UploadedImages.objects.filter(image_temp_token=image_temp_id).update(
+            image_temp_expires_at=timezone.now() - timedelta(seconds=1)
+        )
+        response = self.client.get(download_temp_url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertJSONEqual(
+            json.dumps({'error': 'The temporary URL has been expired.'}),
+            response.json()
+        )
+        # Unknown temp link
+        response = self.client.get(reverse('download_temp_image', kwargs={"image_temp_id": 'UNKNOWNX'}))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertJSONEqual(json.dumps({'error': 'Image does not exist.'}), response.json())
+
     def test_download_temp_url_invalid_expiry_range(self):
         # create subscription
         self.account_tier.thumbnail_sizes.add(*[self.thumbnail_size])
@@ -453,11 +1689,5 @@ class DownloadTempImageTestCase(APITestCase):
             response.json()
         )
 
-    @classmethod
-    def tearDownClass(cls):
-        super().tearDownClass()
-        # remove test files uploaded
-        upload_folder = path.join(settings.MEDIA_ROOT, "user_images")
-        for test_file in os.listdir(upload_folder):
-            if test_file.startswith("test_img_"):
-                os.remove(path.join(upload_folder, test_file))
+    def tearDown(self):
+        restore_media_root(self.media_settings)
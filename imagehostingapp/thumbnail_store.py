@@ -0,0 +1,238 @@
+"""
+Persistent on-disk thumbnail store.
+
+Thumbnails are stored under a name derived from the image and its size,
+"<key>/<size>", in hash-prefix directories of the key, and tracked in a small sqlite index holding each file's size and last
+access time. Hits are served straight from disk, and least recently used
+thumbnails are evicted once the store grows beyond its disk budget.
+The index is shared by all the worker processes on a node.
+"""
+import os
+import time
+import sqlite3
+import logging
+from threading import local, Lock
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from imagehostingapp import sharding
+
+
+INDEX_FILE_NAME = "index.sqlite3"
+
+# last access time is refreshed at most once in this many seconds per entry,
+# so repeat hits do not turn into index writes
+ACCESS_RESOLUTION_SEC = 60
+
+
+class ThumbnailStore(object):
+
+    def __init__(self, root, budget_bytes, shard_levels=2):
+        self.root = root
+        self.budget_bytes = budget_bytes
+        self.shard_levels = shard_levels
+        self._local = local()
+
+    @property
+    def _index(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            os.makedirs(self.root, exist_ok=True)
+            connection = sqlite3.connect(
+                os.path.join(self.root, INDEX_FILE_NAME),
+                timeout=30, isolation_level=None
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS thumbnails ("
+                "name TEXT PRIMARY KEY, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS thumbnails_last_access "
+                "ON thumbnails (last_access)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS usage ("
+                "id INTEGER PRIMARY KEY CHECK (id = 1), total_size INTEGER NOT NULL)"
+            )
+            connection.execute(
+                "INSERT OR IGNORE INTO usage (id, total_size) VALUES (1, 0)"
+            )
+            self._local.connection = connection
+        return connection
+
+    def path(self, name):
+        key, _, _ = name.partition('/')
+        return sharding.get_sharded_path(self.root, key, name, self.shard_levels)
+
+    def legacy_path(self, name):
+        # flat layout, until moved by "./manage.py shardmediafiles"
+        return os.path.join(self.root, name)
+
+    def names(self):
+        return [name for name, in self._index.execute("SELECT name FROM thumbnails")]
+
+    def lookup(self, name):
+        """
+        Return the path of a stored thumbnail, or None on a miss.
+        """
+        row = self._index.execute(
+            "SELECT last_access FROM thumbnails WHERE name = ?", (name,)
+        ).fetchone()
+        if row is None:
+            return None
+        thumbnail_path = self.path(name)
+        if not os.path.exists(thumbnail_path):
+            thumbnail_path = self.legacy_path(name)
+        if not os.path.exists(thumbnail_path):
+            # removed behind our back, forget it
+            self._forget(name)
+            return None
+        now = time.time()
+        if now - row[0] > ACCESS_RESOLUTION_SEC:
+            self._index.execute(
+                "UPDATE thumbnails SET last_access = ? WHERE name = ?", (now, name)
+            )
+        return thumbnail_path
+
+    def add(self, name):
+        """
+        Record a thumbnail written at path(name), and enforce the disk budget.
+        """
+        size = os.stat(self.path(name)).st_size
+        index = self._index
+        index.execute("BEGIN IMMEDIATE")
+        try:
+            row = index.execute(
+                "SELECT size FROM thumbnails WHERE name = ?", (name,)
+            ).fetchone()
+            previous_size = row[0] if row else 0
+            index.execute(
+                "INSERT OR REPLACE INTO thumbnails (name, size, last_access) VALUES (?, ?, ?)",
+                (name, size, time.time())
+            )
+            index.execute(
+                "UPDATE usage SET total_size = total_size + ? WHERE id = 1",
+                (size - previous_size,)
+            )
+            evicted = self._evict_over_budget(index, keep=name)
+            index.execute("COMMIT")
+        except Exception:
+            index.execute("ROLLBACK")
+            raise
+        self._remove_files(evicted)
+        return self.path(name)
+
+    def discard(self, prefix):
+        """
+        Drop every thumbnail whose name starts with prefix.
+        """
+        index = self._index
+        index.execute("BEGIN IMMEDIATE")
+        try:
+            rows = index.execute(
+                "SELECT name, size FROM thumbnails WHERE name LIKE ? ESCAPE '\\'",
+                (self._escape_like(prefix) + '%',)
+            ).fetchall()
+            self._delete_rows(index, rows)
+            index.execute("COMMIT")
+        except Exception:
+            index.execute("ROLLBACK")
+            raise
+        self._remove_files(name for name, _ in rows)
+
+    def usage(self):
+        return self._index.execute(
+            "SELECT total_size FROM usage WHERE id = 1"
+        ).fetchone()[0]
+
+    def _forget(self, name):
+        index = self._index
+        index.execute("BEGIN IMMEDIATE")
+        try:
+            rows = index.execute(
+                "SELECT name, size FROM thumbnails WHERE name = ?", (name,)
+            ).fetchall()
+            self._delete_rows(index, rows)
+            index.execute("COMMIT")
+        except Exception:
+            index.execute("ROLLBACK")
+            raise
+
+    def _evict_over_budget(self, index, keep):
+        total_size = index.execute(
+            "SELECT total_size FROM usage WHERE id = 1"
+        ).fetchone()[0]
+        if total_size <= self.budget_bytes:
+            return []
+        evicted_rows = []
+        cursor = index.execute(
+            "SELECT name, size FROM thumbnails ORDER BY last_access"
+        )
+        for name, size in cursor:
+            if total_size <= self.budget_bytes:
+                break
+            if name == keep:
+                continue
+            evicted_rows.append((name, size))
+            total_size -= size
+        cursor.close()
+        self._delete_rows(index, evicted_rows)
+        return [name for name, _ in evicted_rows]
+
+    @staticmethod
+    def _delete_rows(index, rows):
+        if not rows:
+            return
+        index.executemany(
+            "DELETE FROM thumbnails WHERE name = ?", [(name,) for name, _ in rows]
+        )
+        index.execute(
+            "UPDATE usage SET total_size = total_size - ? WHERE id = 1",
+            (sum(size for _, size in rows),)
+        )
+
+    def _remove_files(self, names):
+        for name in names:
+            try:
+                try:
+                    os.remove(self.path(name))
+                except FileNotFoundError:
+                    os.remove(self.legacy_path(name))
+            except FileNotFoundError:
+                pass
+            except OSError as exc:
+                logging.log(
+                    level=logging.ERROR,
+                    msg=f"Could not remove evicted thumbnail {name}. error: {exc}"
+                )
+
+    @staticmethod
+    def _escape_like(value):
+        return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+_store = None
+_store_lock = Lock()
+
+
+def get_thumbnail_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ThumbnailStore(
+                settings.THUMBNAIL_STORE_ROOT, settings.THUMBNAIL_STORE_BUDGET_BYTES,
+                settings.MEDIA_SHARD_LEVELS
+            )
+        return _store
+
+
+@receiver(setting_changed)
+def reset_thumbnail_store(setting, **kwargs):
+    global _store
+    if setting in ('THUMBNAIL_STORE_ROOT', 'THUMBNAIL_STORE_BUDGET_BYTES', 'MEDIA_SHARD_LEVELS'):
+        with _store_lock:
+            _store = None
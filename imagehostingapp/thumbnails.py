@@ -0,0 +1,360 @@
+"""
+Image thumbnail rendering and upload time pre-generation.
+
+Thumbnails of every size in the uploader's account tier are queued right
+after an upload commits and built in the background into the thumbnail
+store. Download views then only serve a file that already exists, and
+render on demand only when the background job has not finished yet (or the
+thumbnail has been evicted since).
+
+All the sizes of an image are rendered together from one decode of the
+original, whether at upload, on demand or by "./manage.py backfillthumbnails".
+
+Clients accepting AVIF or WebP (Accept header) get a variant in that
+encoding, stored next to the source format one. Variants are rendered on
+their first request, pre-generation only covers the source format.
+
+Rendering runs in a bounded pool of worker processes, never in the web
+worker itself, so a burst of thumbnail misses can not starve other
+requests. Jobs queued or running per web process are capped: once the cap
+is reached, on-demand renders are refused (503, Retry-After) and upload
+time pre-generation is skipped. Pre-generation also leaves half the queue
+for downloads.
+"""
+import os
+import time
+import logging
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeoutError, wait
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+
+from django.conf import settings
+
+from imagestore import metrics
+from imagehostingapp import entitlements, imaging
+from imagehostingapp.thumbnail_store import get_thumbnail_store
+
+
+_render_pool = None
+_render_pool_lock = Lock()
+# jobs queued or running in the pool, by this process
+_pending_renders = 0
+# thumbnail name -> future of the job rendering it, shared by waiters
+_inflight_renders = {}
+
+
+# variant format: (content type, file extension)
+THUMBNAIL_VARIANTS = {
+    'AVIF': ('image/avif', '.avif'),
+    'WEBP': ('image/webp', '.webp'),
+}
+
+
+class ThumbnailRenderUnavailable(Exception):
+    """
+    The render queue is saturated, or the job did not finish in time.
+    """
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.retry_after = settings.THUMBNAIL_RENDER_RETRY_AFTER_SEC
+
+
+def get_thumbnail_extension(image_query_obj, output_format=None):
+    if output_format:
+        return THUMBNAIL_VARIANTS[output_format][1]
+    _, extension = os.path.splitext(image_query_obj.image_path.name)
+    return extension.lower()
+
+
+def get_thumbnail_key(image_query_obj):
+    """
+    Thumbnails are keyed by content checksum, so uploads of the same bytes
+    share them. Images not backfilled yet fall back to the UUID.
+    """
+    return image_query_obj.image_sha256 or str(image_query_obj.image_id)
+
+
+def get_thumbnail_name(image_query_obj, height, output_format=None,
+                       encoder_profile=imaging.DEFAULT_ENCODER_PROFILE):
+    """
+    Thumbnails are stored by key, size and encoder profile.
+    """
+    return "{}/{}px-{}{}".format(
+        get_thumbnail_key(image_query_obj), height, encoder_profile,
+        get_thumbnail_extension(image_query_obj, output_format)
+    )
+
+
+def discard_thumbnails(image_query_obj):
+    """
+    Drop the thumbnails of a deleted image. Checksum keyed ones are shared,
+    they go with the last reference to the blob.
+    """
+    if not image_query_obj.image_sha256:
+        get_thumbnail_store().discard("{}/".format(get_thumbnail_key(image_query_obj)))
+
+
+def get_thumbnail_names(image_query_obj, encoder_profiles, output_format=None):
+    """
+    {height: thumbnail_name} from {height: encoder profile}.
+    """
+    return {
+        height: get_thumbnail_name(image_query_obj, height, output_format, encoder_profile)
+        for height, encoder_profile in encoder_profiles.items()
+    }
+
+
+def get_thumbnail_file_name(image_query_obj, height, output_format=None):
+    """
+    Name offered to the client, the uploaded name with the thumbnail's extension.
+    """
+    image_name, _ = os.path.splitext(image_query_obj.image_name)
+    return "{}px_{}{}".format(
+        height, image_name, get_thumbnail_extension(image_query_obj, output_format)
+    )
+
+
+def negotiate_output_format(accept_header):
+    """
+    First of THUMBNAIL_VARIANT_FORMATS the client accepts explicitly and
+    Pillow can encode, None for the source format. Wildcards do not count,
+    "*/*" clients are not known to decode WebP or AVIF.
+    """
+    accepted_qualities = {}
+    for media_range in accept_header.split(','):
+        media_type, *params = media_range.split(';')
+        quality = 1.0
+        for param in params:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted_qualities[media_type.strip().lower()] = quality
+    for output_format in settings.THUMBNAIL_VARIANT_FORMATS:
+        content_type, _ = THUMBNAIL_VARIANTS[output_format]
+        if accepted_qualities.get(content_type, 0) > 0 and imaging.is_format_supported(output_format):
+            return output_format
+    return None
+
+
+def create_thumbnail(source_path, thumbnail_path, height):
+    return imaging.create_thumbnails(source_path, {height: thumbnail_path})[height]
+
+
+def _get_render_pool():
+    global _render_pool
+    if _render_pool is None:
+        # spawn, forking a web worker would copy its threads and connections
+        _render_pool = ProcessPoolExecutor(
+            max_workers=settings.THUMBNAIL_RENDER_WORKERS,
+            mp_context=multiprocessing.get_context('spawn'),
+        )
+    return _render_pool
+
+
+def _discard_broken_pool(render_pool):
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is render_pool:
+            _render_pool = None
+    render_pool.shutdown(wait=False)
+
+
+def submit_render(source_path, thumbnail_names, reserve=0, output_format=None, encoder_profiles=None):
+    """
+    Queue rendering of {height: thumbnail_name} in the render pool, leaving
+    reserve queue slots free. Returns a future resolved with the thumbnail
+    names once they are in the store. Encoded as output_format, or the
+    source format when None, with {height: encoder profile}.
+    Raises ThumbnailRenderUnavailable when the queue is saturated.
+    """
+    global _pending_renders
+    thumbnail_store = get_thumbnail_store()
+    stored = Future()
+    with _render_pool_lock:
+        if _pending_renders >= settings.THUMBNAIL_RENDER_QUEUE_LIMIT - reserve:
+            raise ThumbnailRenderUnavailable("Thumbnail render queue is full.")
+        render_pool = _get_render_pool()
+        try:
+            rendered = render_pool.submit(
+                imaging.render_job, source_path,
+                {height: thumbnail_store.path(thumbnail_name)
+                 for height, thumbnail_name in thumbnail_names.items()},
+                settings.THUMBNAIL_RENDER_TIMEOUT_SEC, output_format, encoder_profiles
+            )
+        except BrokenProcessPool:
+            rendered = None
+        else:
+            _pending_renders += 1
+            for thumbnail_name in thumbnail_names.values():
+                _inflight_renders[thumbnail_name] = stored
+    if rendered is None:
+        _discard_broken_pool(render_pool)
+        raise ThumbnailRenderUnavailable("Thumbnail render pool is restarting.")
+
+    def on_rendered(rendered):
+        global _pending_renders
+        try:
+            metrics.observe('imagestore_thumbnail_render_duration_seconds', rendered.result())
+            for thumbnail_name in thumbnail_names.values():
+                thumbnail_store.add(thumbnail_name)
+        except Exception as exc:
+            logging.log(
+                level=logging.ERROR,
+                msg=f"Thumbnail rendering failed for {source_path} at "
+                    f"{sorted(thumbnail_names)}px. error: {exc!r}"
+            )
+            if isinstance(exc, BrokenProcessPool):
+                _discard_broken_pool(render_pool)
+            stored.set_exception(exc)
+        else:
+            stored.set_result(thumbnail_names)
+        finally:
+            with _render_pool_lock:
+                _pending_renders -= 1
+                for thumbnail_name in thumbnail_names.values():
+                    if _inflight_renders.get(thumbnail_name) is stored:
+                        del _inflight_renders[thumbnail_name]
+
+    rendered.add_done_callback(on_rendered)
+    return stored
+
+
+def wait_for_renders(timeout_sec=None):
+    """
+    Wait for the jobs queued by this process to finish.
+    """
+    with _render_pool_lock:
+        stored_futures = set(_inflight_renders.values())
+    wait(stored_futures, timeout=timeout_sec)
+
+
+def get_or_create_thumbnail(image_query_obj, height, encoder_profiles=None, output_format=None):
+    """
+    Serve the stored thumbnail, fall back to render on demand in the pool.
+    encoder_profiles: {height: encoder profile} of the tier, missing sibling
+    sizes are rendered in the same pass.
+    Raises ThumbnailRenderUnavailable when it can not be rendered in time.
+    """
+    encoder_profiles = encoder_profiles or {}
+    thumbnail_store = get_thumbnail_store()
+    thumbnail_name = get_thumbnail_name(
+        image_query_obj, height, output_format,
+        encoder_profiles.get(height, imaging.DEFAULT_ENCODER_PROFILE)
+    )
+    thumbnail_path = thumbnail_store.lookup(thumbnail_name)
+    metrics.inc('imagestore_thumbnail_cache_total', {'result': 'hit' if thumbnail_path else 'miss'})
+    if thumbnail_path:
+        return thumbnail_path
+    stored = _inflight_renders.get(thumbnail_name)
+    if stored is None:
+        logging.log(
+            level=logging.DEBUG,
+            msg=f"Thumbnail {thumbnail_name} is not ready yet. Rendering on demand."
+        )
+        thumbnail_names = {height: thumbnail_name}
+        for sibling_height, sibling_name in get_thumbnail_names(
+                image_query_obj, encoder_profiles, output_format).items():
+            if sibling_height not in thumbnail_names and not thumbnail_store.lookup(sibling_name):
+                thumbnail_names[sibling_height] = sibling_name
+        stored = submit_render(
+            image_query_obj.image_path.path, thumbnail_names,
+            output_format=output_format, encoder_profiles=encoder_profiles
+        )
+    try:
+        stored.result(timeout=settings.THUMBNAIL_RENDER_TIMEOUT_SEC)
+    except (FutureTimeoutError, TimeoutError):
+        # waiting here, or the job's own alarm; distinct classes before Python 3.11
+        raise ThumbnailRenderUnavailable("Thumbnail rendering is taking too long.")
+    except BrokenProcessPool:
+        # a render worker died, e.g. OOM-killed
+        raise ThumbnailRenderUnavailable("Thumbnail render pool is restarting.")
+    return thumbnail_store.path(thumbnail_name)
+
+
+def generate_thumbnails(source_path, thumbnail_names, encoder_profiles=None):
+    """
+    Render all the missing thumbnails of an image in this process,
+    decoding it once. Returns the number of thumbnails rendered.
+    """
+    thumbnail_store = get_thumbnail_store()
+    thumbnail_names = {
+        height: thumbnail_name for height, thumbnail_name in thumbnail_names.items()
+        if not thumbnail_store.lookup(thumbnail_name)
+    }
+    if not thumbnail_names:
+        return 0
+    try:
+        started_at = time.perf_counter()
+        imaging.create_thumbnails(source_path, {
+            height: thumbnail_store.path(thumbnail_name)
+            for height, thumbnail_name in thumbnail_names.items()
+        }, encoder_profiles=encoder_profiles)
+        metrics.observe('imagestore_thumbnail_render_duration_seconds', time.perf_counter() - started_at)
+    except Exception as exc:
+        logging.log(
+            level=logging.ERROR,
+            msg=f"Thumbnail generation failed for {source_path} at "
+                f"{sorted(thumbnail_names)}px. error: {exc}"
+        )
+        return 0
+    for thumbnail_name in thumbnail_names.values():
+        thumbnail_store.add(thumbnail_name)
+    return len(thumbnail_names)
+
+
+def get_tier_encoder_profiles(image_query_obj):
+    """
+    {height: encoder profile} of every thumbnail size in the uploader's tier.
+    """
+    user_entitlements = entitlements.get_entitlements(image_query_obj.image_author_id)
+    if not user_entitlements:
+        return {}
+    return user_entitlements.encoder_profiles
+
+
+def backfill_thumbnails(image_query_obj):
+    """
+    Render the missing tier thumbnails of an image now, in this process.
+    """
+    encoder_profiles = get_tier_encoder_profiles(image_query_obj)
+    if not encoder_profiles:
+        return 0
+    return generate_thumbnails(
+        image_query_obj.image_path.path,
+        get_thumbnail_names(image_query_obj, encoder_profiles), encoder_profiles
+    )
+
+
+def schedule_thumbnails(image_query_obj):
+    """
+    Queue generation of every thumbnail size in the uploader's tier.
+    Tier lookup happens here, so render workers never touch the db.
+    """
+    if not settings.THUMBNAIL_PREGENERATE:
+        return None
+    thumbnail_store = get_thumbnail_store()
+    encoder_profiles = get_tier_encoder_profiles(image_query_obj)
+    thumbnail_names = {
+        height: thumbnail_name
+        for height, thumbnail_name in get_thumbnail_names(image_query_obj, encoder_profiles).items()
+        if not thumbnail_store.lookup(thumbnail_name)
+    }
+    if not thumbnail_names:
+        return None
+    try:
+        return submit_render(
+            image_query_obj.image_path.path, thumbnail_names,
+            reserve=settings.THUMBNAIL_RENDER_QUEUE_LIMIT // 2, encoder_profiles=encoder_profiles
+        )
+    except ThumbnailRenderUnavailable as exc:
+        # rendered on first download, or by backfillthumbnails
+        logging.log(
+            level=logging.WARNING,
+            msg=f"Thumbnail pre-generation skipped for {image_query_obj.image_id}. {exc}"
+        )
+        return None
@@ -0,0 +1,139 @@
+"""
+Resumable chunked uploads.
+
+A client creates an upload session, PUTs numbered chunks with their
+SHA-256, asks which chunks were received, and finalizes the session into
+an UploadedImages row. Each chunk is written straight from the request
+stream into a staging file at its offset, and the finished staging file
+is moved (not copied) into storage. Abandoned sessions are swept.
+"""
+import os
+import hashlib
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.utils import timezone
+
+from imagehostingapp.models import UploadSession, UploadChunk
+
+
+READ_BLOCK_SIZE = 64 * 1024
+
+
+class ChunkError(Exception):
+    pass
+
+
+class StagedUploadedFile(UploadedFile):
+    """
+    Uploaded file backed by a staging file on disk. Like Django's
+    TemporaryUploadedFile, storage moves it in place instead of copying.
+    """
+
+    def __init__(self, staging_path, name, content_type, size):
+        super().__init__(open(staging_path, 'rb'), name, content_type, size)
+        self.staging_path = staging_path
+
+    def temporary_file_path(self):
+        return self.staging_path
+
+
+def get_staging_path(upload_session):
+    return os.path.join(
+        settings.UPLOAD_STAGING_ROOT, "{}.part".format(upload_session.session_id)
+    )
+
+
+def create_staging_file(upload_session):
+    os.makedirs(settings.UPLOAD_STAGING_ROOT, exist_ok=True)
+    with open(get_staging_path(upload_session), 'wb') as staging_file:
+        staging_file.truncate(upload_session.total_size)
+
+
+def write_chunk(upload_session, chunk_index, stream, content_length, chunk_sha256):
+    """
+    Write the chunk at its offset in the staging file, verifying its
+    size and checksum, and record it as received.
+    """
+    if not 0 <= chunk_index < upload_session.chunk_count:
+        raise ChunkError(f"Chunk index should be between 0 and {upload_session.chunk_count - 1}.")
+    expected_size = upload_session.expected_chunk_size(chunk_index)
+    if content_length != expected_size:
+        raise ChunkError(f"Chunk {chunk_index} should be {expected_size} bytes.")
+    if not chunk_sha256:
+        raise ChunkError("X-Chunk-SHA256 header is required.")
+
+    sha256 = hashlib.sha256()
+    offset = chunk_index * upload_session.chunk_size
+    remaining = expected_size
+    staging_fd = os.open(get_staging_path(upload_session), os.O_WRONLY)
+    try:
+        while remaining:
+            data = stream.read(min(READ_BLOCK_SIZE, remaining)) if stream else b''
+            if not data:
+                raise ChunkError(f"Chunk {chunk_index} is incomplete.")
+            sha256.update(data)
+            while data:
+                written = os.pwrite(staging_fd, data, offset)
+                data = data[written:]
+                offset += written
+                remaining -= written
+    finally:
+        os.close(staging_fd)
+
+    if sha256.hexdigest() != chunk_sha256.lower():
+        raise ChunkError(f"Chunk {chunk_index} checksum mismatch.")
+    UploadChunk.objects.update_or_create(
+        session=upload_session, chunk_index=chunk_index,
+        defaults=dict(chunk_size=expected_size, chunk_sha256=sha256.hexdigest()),
+    )
+    # keep the session away from the sweeper while it makes progress
+    upload_session.save(update_fields=['updated_at'])
+
+
+def get_missing_chunks(upload_session):
+    received_chunks = set(
+        upload_session.chunks.values_list('chunk_index', flat=True)
+    )
+    return [chunk_index for chunk_index in range(upload_session.chunk_count)
+            if chunk_index not in received_chunks]
+
+
+def get_staged_file(upload_session):
+    return StagedUploadedFile(
+        get_staging_path(upload_session), upload_session.file_name,
+        upload_session.content_type, upload_session.total_size
+    )
+
+
+def remove_staging_file(upload_session):
+    # moved into storage already, unless its bytes were a known blob
+    try:
+        os.remove(get_staging_path(upload_session))
+    except FileNotFoundError:
+        pass
+
+
+def discard_session(upload_session):
+    remove_staging_file(upload_session)
+    upload_session.delete()
+
+
+def sweep_upload_sessions(max_age_sec=None):
+    """
+    Remove sessions, and their staging files, idle for longer than max age.
+    """
+    if max_age_sec is None:
+        max_age_sec = settings.UPLOAD_SESSION_TTL_SEC
+    idle_since = timezone.now() - timedelta(seconds=max_age_sec)
+    swept_sessions = 0
+    for upload_session in UploadSession.objects.filter(updated_at__lt=idle_since).iterator():
+        discard_session(upload_session)
+        swept_sessions += 1
+    logging.log(
+        level=logging.INFO,
+        msg=f"Swept {swept_sessions} upload sessions idle since {idle_since}."
+    )
+    return swept_sessions
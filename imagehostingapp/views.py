@@ -2,32 +2,29 @@ from django.shortcuts import render
 
 # Create your views here.
 import io
-import os
-import math
-import mimetypes
 import logging
-from datetime import timedelta
 from enum import Enum
-from PIL import Image
 
 from django.conf import settings
+from django.db import transaction
 from django.http import HttpResponse
-from django.urls import reverse
-from django.utils.decorators import method_decorator
-from django.utils.encoding import smart_str
 from django.utils import timezone
-from django.views.decorators.cache import cache_page
-from wsgiref.util import FileWrapper
+from django.utils.cache import patch_vary_headers
 
-from rest_framework.parsers import MultiPartParser, FormParser
+from rest_framework.decorators import action
+from rest_framework.parsers import JSONParser, MultiPartParser, FormParser
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status, viewsets
 
-from imagestore import APP_NAME, APP_VERSION
-from imagehostingapp.serializers import ImageUploadSerializer, ListImagesSerializer
-from imagehostingapp.models import UploadedImages, AccountTiers, Subscription
+from imagestore import APP_NAME, APP_VERSION, metrics
+from imagehostingapp import entitlements, metadata_cache, serving, thumbnails, uploads
+from imagehostingapp.pagination import ImageKeysetPagination
+from imagehostingapp.serializers import (
+    ImageUploadSerializer, ListImagesSerializer, UploadSessionSerializer
+)
+from imagehostingapp.models import UploadedImages, UploadSession
 
 
 class ServiceStatues(Enum):
@@ -57,32 +54,34 @@ class PingImageHostingApp(APIView):
         return Response(response_message, status=status.HTTP_200_OK)
 
 
-class ListUploadImages(viewsets.ModelViewSet):
+class MetricsImageHostingApp(APIView):
     """
-    API to list and upload images
+    API to scrape request metrics of all the workers, Prometheus text format.
+    curl -X GET -H "Authorization: Bearer <metrics-token>" http://127.0.0.1:8080/api/metrics
     """
-    permission_classes = (IsAuthenticated,)
-    serializer_class = ListImagesSerializer
-    parser_classes = [MultiPartParser, FormParser]
-
-    def get_queryset(self):
-        return UploadedImages.objects.filter(image_author=self.request.user)
-
-    def list(self, request, *args, **kwargs):
+    def get(self, request) -> HttpResponse:
         """
-        API to list all uploaded images.
-        curl -L -X GET -S -u "username:password" \
-             http://127.0.0.1:8080/api/image/
+        Metrics of ImageHosting App.
         """
-        logging.log(
-            level=logging.DEBUG,
-            msg=f"Client with IP {request.client_ip} accessing the List Image API."
+        if not metrics.is_scrape_allowed(request):
+            logging.log(
+                level=logging.WARNING,
+                msg=f"Client with IP {request.client_ip} refused access to the Metrics API."
+            )
+            return Response({"error": "Metrics are not available to this client."},
+                            status=status.HTTP_403_FORBIDDEN)
+        return HttpResponse(
+            metrics.render(metrics.collect()),
+            content_type='text/plain; version=0.0.4; charset=utf-8'
         )
-        queryset = UploadedImages.objects.filter(image_author=self.request.user)
-        serializer = ListImagesSerializer(queryset, many=True)
-        return Response(serializer.data)
 
-    def _populate_image_urls_as_per_user_subscription(self, upload_response):
+
+class ImageURLsMixin(object):
+    """
+    Respond users with image URLs as per their subscription
+    """
+
+    def _populate_image_urls_as_per_user_subscription(self, upload_response, user_entitlements=None):
         # hide internal image_path in user response
         del upload_response['image_path']
         # and pop image_uuid and image_uri
@@ -90,34 +89,63 @@ class ListUploadImages(viewsets.ModelViewSet):
         download_uri = upload_response.pop('image_uri')
         image_temp_uri = upload_response.pop('image_temp_uri')
 
-        user_subscription_query_set = Subscription.objects.filter(user=self.request.user)
+        if user_entitlements is None:
+            user_entitlements = entitlements.get_entitlements(self.request.user)
 
         # Uncomment following if we want to restrict images upload feature
         # for users NOT subscribed to any of the plans.
-        # if not user_subscription_query_set:
+        # if not user_entitlements:
         #     return {"error": "User is not subscribed to any plan."}, status.HTTP_400_BAD_REQUEST
 
-        user_subscription = user_subscription_query_set.first()
-
-        if user_subscription:
+        if user_entitlements:
             # Add thumbnail URLs
-            if user_subscription.tier.thumbnail_sizes:
-                thumbnails = user_subscription.tier.thumbnail_sizes.all()
-                for thumbnail in thumbnails:
-                    thumbnail_url_user_response_key = \
-                        "image_url_thumbnail_{}".format(thumbnail.thumbnail_size_px)
-                    thumbnail_url = "{}size/{}/".format(
-                        self.request.build_absolute_uri(download_uri),
-                        thumbnail.thumbnail_size_px
-                    )
-                    upload_response[thumbnail_url_user_response_key] = thumbnail_url
+            for thumbnail_size_px in user_entitlements.thumbnail_sizes:
+                thumbnail_url_user_response_key = \
+                    "image_url_thumbnail_{}".format(thumbnail_size_px)
+                thumbnail_url = "{}size/{}/".format(
+                    self.request.build_absolute_uri(download_uri),
+                    thumbnail_size_px
+                )
+                upload_response[thumbnail_url_user_response_key] = thumbnail_url
             # Add original image URL
-            if user_subscription.tier.is_original_image_url_present:
+            if user_entitlements.is_original_image_url_present:
                 upload_response['image_url'] = self.request.build_absolute_uri(download_uri)
-            if user_subscription.tier.is_expiring_links_available and image_temp_uri:
+            if user_entitlements.is_expiring_links_available and image_temp_uri:
                 upload_response['image_temp_url'] = self.request.build_absolute_uri(image_temp_uri)
         return upload_response, status.HTTP_201_CREATED
 
+
+class ListUploadImages(ImageURLsMixin, viewsets.ModelViewSet):
+    """
+    API to list and upload images
+    """
+    permission_classes = (IsAuthenticated,)
+    serializer_class = ListImagesSerializer
+    parser_classes = [MultiPartParser, FormParser]
+    pagination_class = ImageKeysetPagination
+
+    def get_queryset(self):
+        return UploadedImages.objects.filter(image_author=self.request.user)
+
+    def list(self, request, *args, **kwargs):
+        """
+        API to list uploaded images, a page at a time.
+        curl -L -X GET -S -u "username:password" \
+             http://127.0.0.1:8080/api/image/?page_size=50
+
+        Follow "next" / "previous" links for further pages.
+        """
+        logging.log(
+            level=logging.DEBUG,
+            msg=f"Client with IP {request.client_ip} accessing the List Image API."
+        )
+        queryset = self.get_queryset().only(
+            'id', 'image_name', 'image_desc', 'image_created_at'
+        )
+        page = self.paginate_queryset(queryset)
+        serializer = ListImagesSerializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
     def create(self, request, *args, **kwargs):
         """
         API to Upload Images
@@ -152,6 +180,200 @@ class ListUploadImages(viewsets.ModelViewSet):
         )
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    @action(detail=False, methods=['post'])
+    def batch(self, request, *args, **kwargs):
+        """
+        API to Upload many Images at once
+        curl -L -X POST -S -u "username:password" \
+            -F image_path='@"/path/to/image/first.png"' -F image_desc="first image" \
+            -F image_path='@"/path/to/image/second.jpg"' -F image_desc="second image" \
+            -F image_uri_expiry_sec=400 \
+            http://127.0.0.1:8080/api/image/batch/
+
+        image_desc: str:optional, one per image in order
+        image_uri_expiry_sec: int:optional, applies to all images
+        """
+        logging.log(
+            level=logging.DEBUG,
+            msg=f"Client with IP {request.client_ip} accessing the Batch Upload Image API."
+        )
+        image_files = request.FILES.getlist('image_path')
+        image_descs = request.data.getlist('image_desc')
+        image_uri_expiry_sec = request.data.get('image_uri_expiry_sec')
+        if not image_files:
+            return Response({"image_path": ["No file was submitted."]},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if len(image_files) > settings.BATCH_UPLOAD_MAX_FILES:
+            return Response(
+                {"error": f"At most {settings.BATCH_UPLOAD_MAX_FILES} images per batch."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # validate every image, failures do not stop the rest of the batch
+        results = [None] * len(image_files)
+        valid_indexes, valid_data = [], []
+        for index, image_file in enumerate(image_files):
+            image_data = {'image_path': image_file}
+            if index < len(image_descs):
+                image_data['image_desc'] = image_descs[index]
+            if image_uri_expiry_sec is not None:
+                image_data['image_uri_expiry_sec'] = image_uri_expiry_sec
+            serializer = ImageUploadSerializer(data=image_data, context={'request': request})
+            if serializer.is_valid():
+                valid_indexes.append(index)
+                valid_data.append(serializer.validated_data)
+            else:
+                results[index] = dict(index=index, status=status.HTTP_400_BAD_REQUEST,
+                                      errors=serializer.errors)
+
+        if valid_data:
+            list_serializer = ImageUploadSerializer(many=True, context={'request': request})
+            with transaction.atomic():
+                uploaded_images = list_serializer.create(valid_data)
+            user_entitlements = entitlements.get_entitlements(request.user)
+            for index, uploaded_image in zip(valid_indexes, uploaded_images):
+                response_json = ImageUploadSerializer(
+                    uploaded_image, context={'request': request}
+                ).data.copy()
+                response_json, status_code = self._populate_image_urls_as_per_user_subscription(
+                    response_json, user_entitlements
+                )
+                results[index] = dict(index=index, status=status_code, **response_json)
+
+        if len(valid_data) == len(image_files):
+            status_code = status.HTTP_201_CREATED
+        elif valid_data:
+            status_code = status.HTTP_207_MULTI_STATUS
+        else:
+            status_code = status.HTTP_400_BAD_REQUEST
+        logging.log(
+            level=logging.INFO if valid_data else logging.ERROR,
+            msg=f"Batch Upload Image stored {len(valid_data)} of {len(image_files)} images "
+                f"for client with IP {request.client_ip}."
+        )
+        return Response({"results": results}, status=status_code)
+
+
+class UploadSessions(ImageURLsMixin, viewsets.GenericViewSet):
+    """
+    API to upload large images in chunks, resumable
+    """
+    permission_classes = (IsAuthenticated,)
+    serializer_class = UploadSessionSerializer
+    parser_classes = [JSONParser, FormParser, MultiPartParser]
+    lookup_field = 'session_id'
+    lookup_value_regex = '[0-9a-f-]{36}'
+
+    def get_queryset(self):
+        return UploadSession.objects.filter(
+            session_author=self.request.user, uploaded_image__isnull=True
+        )
+
+    def create(self, request, *args, **kwargs):
+        """
+        API to start an upload session
+        curl -L -X POST -S -u "username:password" \
+            -F file_name="someImage.png" -F content_type="image/png" \
+            -F total_size=52428800 -F image_desc="some random image" \
+            http://127.0.0.1:8080/api/upload/
+
+        image_desc: str:optional, image_uri_expiry_sec: int:optional
+        """
+        logging.log(
+            level=logging.DEBUG,
+            msg=f"Client with IP {request.client_ip} accessing the Upload Session API."
+        )
+        serializer = UploadSessionSerializer(
+            data=request.data, context={'request': request}
+        )
+        if serializer.is_valid():
+            serializer.save()
+            return Response(serializer.data, status=status.HTTP_201_CREATED)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    def retrieve(self, request, *args, **kwargs):
+        """
+        API to query the chunks still missing from an upload session
+        curl -L -X GET -S -u "username:password" \
+            http://127.0.0.1:8080/api/upload/<session-uuid>/
+        """
+        serializer = UploadSessionSerializer(self.get_object())
+        return Response(serializer.data)
+
+    def destroy(self, request, *args, **kwargs):
+        """
+        API to abort an upload session
+        """
+        uploads.discard_session(self.get_object())
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @action(detail=True, methods=['put'], url_path=r'chunk/(?P<chunk_index>[0-9]+)')
+    def chunk(self, request, chunk_index, *args, **kwargs):
+        """
+        API to upload a chunk, any order, sized chunk_size except the last one
+        curl -L -X PUT -S -u "username:password" \
+            -H "X-Chunk-SHA256: <sha256-hex-of-chunk>" \
+            --data-binary @chunk_0 \
+            http://127.0.0.1:8080/api/upload/<session-uuid>/chunk/0/
+        """
+        upload_session = self.get_object()
+        try:
+            content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+            uploads.write_chunk(
+                upload_session, int(chunk_index), request.stream, content_length,
+                request.META.get('HTTP_X_CHUNK_SHA256', '')
+            )
+        except uploads.ChunkError as exc:
+            return Response({"error": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @action(detail=True, methods=['post'])
+    def finalize(self, request, *args, **kwargs):
+        """
+        API to turn a completely uploaded session into an image
+        curl -L -X POST -S -u "username:password" \
+            http://127.0.0.1:8080/api/upload/<session-uuid>/finalize/
+        """
+        with transaction.atomic():
+            upload_session = self.get_queryset().select_for_update().filter(
+                session_id=kwargs['session_id']
+            ).first()
+            if not upload_session:
+                return Response({"error": "Upload session does not exist."},
+                                status=status.HTTP_404_NOT_FOUND)
+            missing_chunks = uploads.get_missing_chunks(upload_session)
+            if missing_chunks:
+                return Response({"error": "Upload is incomplete.",
+                                 "missing_chunks": missing_chunks},
+                                status=status.HTTP_409_CONFLICT)
+
+            upload_data = {
+                'image_desc': upload_session.image_desc,
+                'image_path': uploads.get_staged_file(upload_session),
+            }
+            if upload_session.image_uri_expiry_sec != -1:
+                upload_data['image_uri_expiry_sec'] = upload_session.image_uri_expiry_sec
+            serializer = ImageUploadSerializer(
+                data=upload_data, context={'request': request}
+            )
+            if not serializer.is_valid():
+                uploads.discard_session(upload_session)
+                return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+            uploaded_image = serializer.save()
+            upload_session.uploaded_image = uploaded_image
+            upload_session.save(update_fields=['uploaded_image', 'updated_at'])
+            upload_session.chunks.all().delete()
+            transaction.on_commit(lambda: uploads.remove_staging_file(upload_session))
+
+        response_json = serializer.data.copy()
+        response_json, status_code = \
+            self._populate_image_urls_as_per_user_subscription(response_json)
+        logging.log(
+            level=logging.INFO,
+            msg=f"Chunked upload succeed for client with IP {request.client_ip}."
+        )
+        return Response(response_json, status_code)
+
 
 class DownloadImage(APIView):
     """
@@ -163,35 +385,21 @@ class DownloadImage(APIView):
     permission_classes = (IsAuthenticated,)
 
     def retrieve_original_image(self, image_query_obj):
-        file_name = image_query_obj.image_path.name
-        file_path = settings.MEDIA_ROOT + '/' + file_name
-        with open(file_path, 'rb') as file:
-            file_wrapper = FileWrapper(file)
-            file_mimetype = mimetypes.guess_type(file_path)[0]
-            response = HttpResponse(file_wrapper, content_type=file_mimetype,
-                                    status=status.HTTP_200_OK)
-            original_image_name = image_query_obj.image_name
-            response['X-Sendfile'] = original_image_name
-            response['Content-Length'] = os.stat(file_path).st_size
-            response['Content-Disposition'] = \
-                'attachment; filename={}'.format(smart_str(original_image_name))
-            return response
+        return serving.serve_image(self.request, image_query_obj)
 
     def check_user_subscription(self):
         # Verify subscription status of auth user for retrieving original images
-        user_subscription_query_set = Subscription.objects.filter(user=self.request.user)
-        if not user_subscription_query_set:
+        user_entitlements = entitlements.get_entitlements(self.request.user)
+        if not user_entitlements:
             return Response({"error": "User is not subscribed to any plan."},
                             status=status.HTTP_400_BAD_REQUEST)
 
-        user_subscription = user_subscription_query_set.first()
-        if not user_subscription.tier.is_original_image_url_present:
+        if not user_entitlements.is_original_image_url_present:
             return Response(
                 {"error": f"Downloading original image is not available in the "
-                          f"{user_subscription.tier.account_tier_name} tier. Please Upgrade."
+                          f"{user_entitlements.tier_name} tier. Please Upgrade."
                  }, status=status.HTTP_400_BAD_REQUEST)
 
-    @method_decorator(cache_page(60 * 60 * 6))
     def get(self, request, **kwargs) -> HttpResponse:
         """
         Download the original image
@@ -200,19 +408,16 @@ class DownloadImage(APIView):
             level=logging.DEBUG,
             msg=f"Client with IP {request.client_ip} accessing the Download Original Image API."
         )
-        db_query_params = {}
-        db_query_params.update(dict(image_id=kwargs['image_id']))
-        db_query_params.update(dict(image_author=request.user))
-
         # Verify if the image UUID belongs to auth user
-        image_query_set = UploadedImages.objects.filter(**db_query_params)
-        if not image_query_set:
+        image_query_object = metadata_cache.get_user_image(request.user, kwargs['image_id'])
+        if not image_query_object:
             return Response({"error": "Image does not belong to the user."},
                             status=status.HTTP_403_FORBIDDEN)
 
-        self.check_user_subscription()
+        subscription_error_response = self.check_user_subscription()
+        if subscription_error_response:
+            return subscription_error_response
 
-        image_query_object = image_query_set.get()
         return self.retrieve_original_image(image_query_object)
 
 
@@ -225,43 +430,31 @@ class DownloadImageThumbnail(APIView):
     """
     permission_classes = (IsAuthenticated,)
 
-    def _create_and_save_thumbnail(self, image_query_obj, height, thumbnail_name):
-        file_name = image_query_obj.image_path.name
-        # calculate thumbnail size
-        current_width = image_query_obj.image_path.width
-        current_height = image_query_obj.image_path.height
-        aspect_ratio = math.floor(current_width / current_height)
-        width = height * aspect_ratio
-        thumbnail_size = width, height
-        # create and store thumbnail
-        file_path = os.path.join(settings.MEDIA_ROOT, file_name)
-        thumbnail_directory = os.path.join(settings.MEDIA_ROOT, "thumbnails")
-        new_file_path = os.path.join(thumbnail_directory, thumbnail_name)
-        os.makedirs(thumbnail_directory, exist_ok=True)
-        with Image.open(file_path) as img_file:
-            img_file.thumbnail(thumbnail_size, Image.ANTIALIAS)
-            img_file.save(new_file_path)
-            return new_file_path
-
-    def _retrieve_image_thumbnail(self, image_query_obj, new_height):
-        new_thumbnail_name = "{}px_{}".format(
-                new_height, image_query_obj.image_name
+    def _retrieve_image_thumbnail(self, image_query_obj, new_height, encoder_profiles=None):
+        output_format = thumbnails.negotiate_output_format(self.request.META.get('HTTP_ACCEPT', ''))
+        new_thumbnail_name = thumbnails.get_thumbnail_file_name(
+            image_query_obj, new_height, output_format
         )
-        thumbnail_path = self._create_and_save_thumbnail(
-            image_query_obj, new_height, new_thumbnail_name
+        try:
+            thumbnail_path = thumbnails.get_or_create_thumbnail(
+                image_query_obj, new_height, encoder_profiles, output_format
+            )
+        except thumbnails.ThumbnailRenderUnavailable as exc:
+            logging.log(
+                level=logging.WARNING,
+                msg=f"Thumbnail not served to client with IP {self.request.client_ip}. {exc}"
+            )
+            return Response({"error": f"{exc} Please retry."},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            headers={'Retry-After': str(exc.retry_after)})
+        response = serving.serve_file(
+            self.request, thumbnail_path,
+            new_thumbnail_name, image_query_obj.image_created_at
         )
-        with open(thumbnail_path, 'rb') as image_thumbnail:
-            file_wrapper = FileWrapper(image_thumbnail)
-            file_mimetype = mimetypes.guess_type(thumbnail_path)
-            response = HttpResponse(file_wrapper, content_type=file_mimetype,
-                                    status=status.HTTP_200_OK)
-            response['X-Sendfile'] = new_thumbnail_name
-            response['Content-Length'] = os.stat(thumbnail_path).st_size
-            response['Content-Disposition'] = \
-                'attachment; filename={}'.format(smart_str(new_thumbnail_name))
-            return response
-
-    @method_decorator(cache_page(60 * 60 * 6))
+        # the encoding depends on Accept
+        patch_vary_headers(response, ('Accept',))
+        return response
+
     def get(self, request, **kwargs) -> HttpResponse:
         """
         Download the image thumbnail
@@ -270,37 +463,28 @@ class DownloadImageThumbnail(APIView):
             level=logging.DEBUG,
             msg=f"Client with IP {request.client_ip} accessing the Download Image Thumbnail API."
         )
-        db_query_params = {}
-        db_query_params.update(dict(image_id=kwargs['image_id']))
-        db_query_params.update(dict(image_author=request.user))
-
         # Verify if the image UUID belongs to auth user
-        image_query_set = UploadedImages.objects.filter(**db_query_params)
-        if not image_query_set:
+        image_query_object = metadata_cache.get_user_image(request.user, kwargs['image_id'])
+        if not image_query_object:
             return Response({"error": "Image does not belong to the user."},
                             status=status.HTTP_403_FORBIDDEN)
 
-        # Verify subscription status of auth user for retrieving original images
-        user_subscription_query_set = Subscription.objects.filter(user=request.user)
-        if not user_subscription_query_set:
+        # Verify subscription status of auth user for retrieving image thumbnails
+        user_entitlements = entitlements.get_entitlements(request.user)
+        if not user_entitlements:
             return Response({"error": "User is not subscribed to any plan."},
                             status=status.HTTP_400_BAD_REQUEST)
 
-        user_subscription = user_subscription_query_set.first()
-        image_thumbnails = user_subscription.tier.thumbnail_sizes.all()
         input_thumbnail_size = kwargs['thumbnail_size_px']
-        filter_thumbnail_sizes = filter(
-                lambda thumbnail: thumbnail.thumbnail_size_px == input_thumbnail_size,
-                image_thumbnails
-        )
-        if not next(filter_thumbnail_sizes, None):
+        if input_thumbnail_size not in user_entitlements.thumbnail_sizes:
             return Response(
                 {"error": f"Downloading image thumbnail of size {input_thumbnail_size} is not available in the "
-                          f"{user_subscription.tier.account_tier_name} tier."
+                          f"{user_entitlements.tier_name} tier."
                  }, status=status.HTTP_400_BAD_REQUEST)
 
-        image_query_object = image_query_set.get()
-        return self._retrieve_image_thumbnail(image_query_object, input_thumbnail_size)
+        return self._retrieve_image_thumbnail(
+            image_query_object, input_thumbnail_size, user_entitlements.encoder_profiles
+        )
 
 
 class DownloadTempImage(DownloadImage):
@@ -320,24 +504,19 @@ class DownloadTempImage(DownloadImage):
             level=logging.DEBUG,
             msg=f"Client with IP {request.client_ip} accessing the Download Image Temp URL."
         )
-        db_query_params = {}
-        image_temp_uri = reverse('download_temp_image',
-                                 kwargs={"image_temp_id": kwargs['image_temp_id']})
-        db_query_params.update(dict(image_temp_uri=image_temp_uri))
-        db_query_params.update(dict(image_author=request.user))
-
-        # Verify if the image UUID belongs to auth user
-        image_query_set = UploadedImages.objects.filter(**db_query_params)
-        if not image_query_set:
-            return Response({"error": "Image does not exist."},
-                            status=status.HTTP_400_BAD_REQUEST)
-
-        image_query_object = image_query_set.first()
-        is_url_still_valid = (image_query_object.image_created_at +
-                              timedelta(seconds=image_query_object.image_uri_expiry_sec)) > timezone.now()
-        if is_url_still_valid:
-            self.check_user_subscription()
+        # Verify the temp link belongs to auth user and is still valid, single index probe
+        temp_images = UploadedImages.objects.filter(
+            image_temp_token=kwargs['image_temp_id'], image_author=request.user
+        )
+        image_query_object = temp_images.filter(image_temp_expires_at__gt=timezone.now()).first()
+        if image_query_object:
+            subscription_error_response = self.check_user_subscription()
+            if subscription_error_response:
+                return subscription_error_response
             return self.retrieve_original_image(image_query_object)
-        else:
+        # misses only, tell an expired link apart
+        if temp_images.exists():
             return Response({"error": "The temporary URL has been expired."},
                             status=status.HTTP_404_NOT_FOUND)
+        return Response({"error": "Image does not exist."},
+                        status=status.HTTP_400_BAD_REQUEST)
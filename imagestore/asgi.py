@@ -9,8 +9,63 @@ https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIHandler
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'imagestore.settings')
 
-application = get_asgi_application()
+
+class StreamingASGIHandler(ASGIHandler):
+    """
+    Django 4.0 iterates streaming responses (downloads) on the event loop,
+    so every file read blocks it. Pull each part in the thread pool instead,
+    and await the client before reading the next one.
+    """
+
+    @staticmethod
+    def get_response_headers(response):
+        response_headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode("ascii")
+            if isinstance(value, str):
+                value = value.encode("latin1")
+            response_headers.append((bytes(header), bytes(value)))
+        for c in response.cookies.values():
+            response_headers.append(
+                (b"Set-Cookie", c.output(header="").encode("ascii").strip())
+            )
+        return response_headers
+
+    async def send_response(self, response, send):
+        if not response.streaming:
+            return await super().send_response(response, send)
+        await send({
+            "type": "http.response.start",
+            "status": response.status_code,
+            "headers": self.get_response_headers(response),
+        })
+        # Access `__iter__` and not `streaming_content` directly in case
+        # it has been overridden in a subclass.
+        parts = iter(response)
+        next_part = sync_to_async(next, thread_sensitive=False)
+        try:
+            while True:
+                part = await next_part(parts, None)
+                if part is None:
+                    break
+                for chunk, _ in self.chunk_bytes(part):
+                    await send({
+                        "type": "http.response.body",
+                        "body": chunk,
+                        "more_body": True,
+                    })
+            # Final closing message.
+            await send({"type": "http.response.body"})
+        finally:
+            await sync_to_async(response.close, thread_sensitive=True)()
+
+
+django.setup(set_prefix=False)
+application = StreamingASGIHandler()
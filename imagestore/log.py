@@ -0,0 +1,231 @@
+"""
+Logging off the request path.
+
+QueuedRotatingFileHandler only filters a record and puts it on a queue in
+the logging thread. One listener thread per process takes the records off
+the queue and formats and writes them, a batch per file at a time. Several
+gunicorn workers write the same files: every batch is written, and the
+file rotated, under an flock on "<file>.lock", and a worker reopens the
+file once another one has rotated it.
+
+SamplingFilter and RateLimitFilter drop records at or below a level
+(DEBUG, INFO) before they are queued, warnings and errors always pass.
+"""
+import os
+import time
+import queue
+import fcntl
+import atexit
+import random
+import logging
+import threading
+import logging.handlers
+
+
+# records waiting for the listener, beyond this they are dropped
+QUEUE_SIZE = 10000
+# records written per file and flock
+BATCH_SIZE = 500
+
+_queue = None
+_listener = None
+_listener_pid = None
+_listener_lock = threading.Lock()
+_STOP = object()
+
+
+def _get_queue():
+    global _queue, _listener, _listener_pid
+    # a forked worker (gunicorn --preload) has no listener thread of its own
+    if _listener_pid == os.getpid():
+        return _queue
+    with _listener_lock:
+        if _listener_pid != os.getpid():
+            _queue = queue.Queue(QUEUE_SIZE)
+            _listener = threading.Thread(target=_listen, args=(_queue,), name='log-listener', daemon=True)
+            _listener.start()
+            _listener_pid = os.getpid()
+    return _queue
+
+
+def _listen(record_queue):
+    while True:
+        batches = {}
+        batch_size = 0
+        item = record_queue.get()
+        while item is not _STOP:
+            handler, record = item
+            batches.setdefault(handler, []).append(record)
+            batch_size += 1
+            if batch_size >= BATCH_SIZE:
+                break
+            try:
+                item = record_queue.get_nowait()
+            except queue.Empty:
+                break
+        for handler, records in batches.items():
+            handler.write_records(records)
+        for _ in range(batch_size):
+            record_queue.task_done()
+        if item is _STOP:
+            return
+
+
+def flush():
+    """
+    Wait until the records queued so far are written.
+    """
+    if _listener_pid == os.getpid():
+        _queue.join()
+
+
+@atexit.register
+def stop_listener(timeout_sec=5):
+    """
+    Write the records still queued, and stop the listener.
+    """
+    if _listener_pid != os.getpid():
+        return
+    try:
+        _queue.put(_STOP, timeout=timeout_sec)
+    except queue.Full:
+        return
+    _listener.join(timeout_sec)
+
+
+class QueuedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    RotatingFileHandler written to by the listener thread, safe to share
+    between processes.
+    """
+
+    def __init__(self, filename, mode='a', maxBytes=0, backupCount=0, encoding=None, delay=True, errors=None):
+        super().__init__(filename, mode, maxBytes, backupCount, encoding, delay, errors)
+        self.lock_filename = self.baseFilename + '.lock'
+        self._lock_file = None
+        self._lock_file_pid = None
+        self.dropped_count = 0
+        self.rate_limited_count = 0
+
+    def filter(self, record):
+        for record_filter in self.filters:
+            passed = record_filter.filter(record) if hasattr(record_filter, 'filter') else record_filter(record)
+            if not passed:
+                if isinstance(record_filter, RateLimitFilter):
+                    self.rate_limited_count += 1
+                return False
+        return True
+
+    def handle(self, record):
+        passed = self.filter(record)
+        if passed:
+            if record.args:
+                # args may change before the listener gets to them
+                record.msg, record.args = record.getMessage(), None
+            try:
+                _get_queue().put_nowait((self, record))
+            except queue.Full:
+                self.dropped_count += 1
+        return passed
+
+    def _acquire_file_lock(self):
+        if self._lock_file_pid != os.getpid():
+            self._lock_file = open(self.lock_filename, 'a')
+            self._lock_file_pid = os.getpid()
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+
+    def _release_file_lock(self):
+        fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _reopen_if_rotated(self):
+        if self.stream is None:
+            return
+        try:
+            rotated = os.stat(self.baseFilename).st_ino != os.fstat(self.stream.fileno()).st_ino
+        except FileNotFoundError:
+            rotated = True
+        if rotated:
+            self.stream.close()
+            self.stream = self._open()
+
+    def write_records(self, records):
+        if self.dropped_count:
+            dropped_count, self.dropped_count = self.dropped_count, 0
+            records.insert(0, logging.makeLogRecord({
+                'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                'msg': f"{dropped_count} log records dropped, the log queue was full.",
+            }))
+        if self.rate_limited_count:
+            rate_limited_count, self.rate_limited_count = self.rate_limited_count, 0
+            records.insert(0, logging.makeLogRecord({
+                'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                'msg': f"{rate_limited_count} log records dropped by the rate limit.",
+            }))
+        self.acquire()
+        try:
+            self._acquire_file_lock()
+            try:
+                self._reopen_if_rotated()
+                for record in records:
+                    try:
+                        if self.shouldRollover(record):
+                            self.doRollover()
+                        logging.FileHandler.emit(self, record)
+                    except Exception:
+                        self.handleError(record)
+            finally:
+                self._release_file_lock()
+        except OSError:
+            for record in records:
+                self.handleError(record)
+        finally:
+            self.release()
+
+    def emit(self, record):
+        # only called directly, handle() queues records
+        self.write_records([record])
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Pass a fraction (rate) of the records up to max_level.
+    """
+
+    def __init__(self, rate=1.0, max_level='INFO'):
+        super().__init__()
+        self.rate = float(rate)
+        self.max_level = logging.getLevelName(max_level) if isinstance(max_level, str) else max_level
+
+    def filter(self, record):
+        return record.levelno > self.max_level or random.random() < self.rate
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Pass at most rate records a second, in bursts of up to burst, per
+    logger name, of the records up to max_level. A rate of 0 passes all.
+    """
+
+    def __init__(self, rate=100, burst=None, max_level='INFO'):
+        super().__init__()
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.max_level = logging.getLevelName(max_level) if isinstance(max_level, str) else max_level
+        # logger name: [tokens, last refill time]
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > self.max_level or self.rate <= 0:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(record.name)
+            if bucket is None:
+                bucket = self._buckets[record.name] = [self.burst, now]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                return False
+            bucket[0] -= 1
+            return True
@@ -0,0 +1,250 @@
+"""
+Request metrics in Prometheus text format, served at /api/metrics.
+
+Every process keeps its counters and histograms in memory. With
+METRICS_DIR set, each process also writes them to its own file there, at
+most every METRICS_FLUSH_INTERVAL_SEC, and /api/metrics sums the files of
+all the gunicorn workers. Files of exited workers are kept, so counters
+do not go back when a worker is replaced; clear METRICS_DIR when the
+server starts.
+
+DB queries are counted by a wrapper installed on every new connection,
+attributed to the request through a context variable, which also follows
+async views into their sync_to_async threads.
+
+Metrics are only served to clients connecting from METRICS_ALLOWED_IPS,
+or sending "Authorization: Bearer <METRICS_TOKEN>".
+"""
+import os
+import json
+import time
+import uuid
+import atexit
+import bisect
+import logging
+import contextvars
+from threading import Lock
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.utils.crypto import constant_time_compare
+
+
+# upper bounds in seconds, +Inf is implied
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# name: (type, help)
+METRICS = {
+    'imagestore_http_requests_total': (
+        'counter', 'Requests by view, method and status code.'),
+    'imagestore_http_request_duration_seconds': (
+        'histogram', 'Time to the response, streamed bodies not included.'),
+    'imagestore_http_response_bytes_total': (
+        'counter', 'Response body bytes, from Content-Length for streamed bodies.'),
+    'imagestore_db_queries_total': (
+        'counter', 'DB queries run while serving requests.'),
+    'imagestore_db_query_duration_seconds_total': (
+        'counter', 'Time spent in DB queries while serving requests.'),
+    'imagestore_thumbnail_cache_total': (
+        'counter', 'Thumbnail store lookups for downloads, by result.'),
+    'imagestore_thumbnail_render_duration_seconds': (
+        'histogram', 'Pillow render time of a thumbnail job, all its sizes.'),
+}
+
+# [query count, query seconds] of the request being served
+_request_queries = contextvars.ContextVar('request_queries', default=None)
+
+
+class Registry(object):
+
+    def __init__(self):
+        self._lock = Lock()
+        # (name, labels): value
+        self._counters = {}
+        # (name, labels): [bucket counts..., +Inf count, sum]
+        self._histograms = {}
+        self._file_token = uuid.uuid4().hex
+        self._flushed_at = 0.0
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(DURATION_BUCKETS) + 1) + [0.0]
+            histogram[bisect.bisect_left(DURATION_BUCKETS, value)] += 1
+            histogram[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': [[name, dict(labels), value] for (name, labels), value in self._counters.items()],
+                'histograms': [[name, dict(labels), list(histogram)]
+                               for (name, labels), histogram in self._histograms.items()],
+            }
+
+    def flush(self, force=False):
+        """
+        Write this process' metrics to its file in METRICS_DIR, if the
+        flush interval has passed.
+        """
+        if not settings.METRICS_DIR:
+            return
+        now = time.monotonic()
+        if not force and now - self._flushed_at < settings.METRICS_FLUSH_INTERVAL_SEC:
+            return
+        self._flushed_at = now
+        file_path = os.path.join(settings.METRICS_DIR, "worker-{}-{}.json".format(os.getpid(), self._file_token))
+        try:
+            os.makedirs(settings.METRICS_DIR, exist_ok=True)
+            with open(file_path + '.tmp', 'w') as metrics_file:
+                json.dump(self.snapshot(), metrics_file)
+            # readers only see complete files
+            os.replace(file_path + '.tmp', file_path)
+        except OSError as exc:
+            logging.log(
+                level=logging.ERROR,
+                msg=f"Could not write metrics to {file_path}. error: {exc}"
+            )
+
+
+registry = Registry()
+atexit.register(registry.flush, force=True)
+
+
+def inc(name, labels=None, value=1):
+    registry.inc(name, labels or {}, value)
+
+
+def observe(name, value, labels=None):
+    registry.observe(name, labels or {}, value)
+
+
+def _record_query(execute, sql, params, many, context):
+    request_queries = _request_queries.get()
+    if request_queries is None:
+        return execute(sql, params, many, context)
+    started_at = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        request_queries[0] += 1
+        request_queries[1] += time.perf_counter() - started_at
+
+
+@receiver(connection_created)
+def install_query_recorder(sender, connection, **kwargs):
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+def start_request():
+    """
+    Start counting the DB queries of the current request.
+    """
+    request_queries = [0, 0.0]
+    _request_queries.set(request_queries)
+    return request_queries
+
+
+def record_request(request, response, duration_sec, request_queries):
+    resolver_match = getattr(request, 'resolver_match', None)
+    view = resolver_match.view_name if resolver_match else 'unmatched'
+    inc('imagestore_http_requests_total', {
+        'view': view, 'method': request.method, 'status': str(response.status_code)
+    })
+    observe('imagestore_http_request_duration_seconds', duration_sec, {'view': view})
+    if response.streaming:
+        response_bytes = int(response.get('Content-Length') or 0)
+    else:
+        response_bytes = len(response.content)
+    inc('imagestore_http_response_bytes_total', {'view': view}, response_bytes)
+    inc('imagestore_db_queries_total', {'view': view}, request_queries[0])
+    inc('imagestore_db_query_duration_seconds_total', {'view': view}, request_queries[1])
+    registry.flush()
+
+
+def is_scrape_allowed(request):
+    # the peer address, X-Forwarded-For is up to the client
+    if request.META.get('REMOTE_ADDR') in settings.METRICS_ALLOWED_IPS:
+        return True
+    scheme, _, token = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+    return bool(settings.METRICS_TOKEN) and scheme.lower() == 'bearer' and \
+        constant_time_compare(token, settings.METRICS_TOKEN)
+
+
+def collect():
+    """
+    Snapshots of every worker, this process' own one up to date.
+    """
+    if not settings.METRICS_DIR:
+        return [registry.snapshot()]
+    registry.flush(force=True)
+    snapshots = []
+    try:
+        file_names = os.listdir(settings.METRICS_DIR)
+    except FileNotFoundError:
+        file_names = []
+    for file_name in file_names:
+        if not file_name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(settings.METRICS_DIR, file_name)) as metrics_file:
+                snapshots.append(json.load(metrics_file))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in sorted(labels.items())
+    ) + '}'
+
+
+def render(snapshots):
+    """
+    Prometheus text exposition of the summed snapshots.
+    """
+    counters, histograms = {}, {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(sorted(labels.items())))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, histogram in snapshot['histograms']:
+            key = (name, tuple(sorted(labels.items())))
+            if key in histograms:
+                histograms[key] = [total + value for total, value in zip(histograms[key], histogram)]
+            else:
+                histograms[key] = list(histogram)
+    lines = []
+    for name, (metric_type, metric_help) in METRICS.items():
+        lines.append('# HELP {} {}'.format(name, metric_help))
+        lines.append('# TYPE {} {}'.format(name, metric_type))
+        if metric_type == 'counter':
+            for (counter_name, labels), value in sorted(counters.items()):
+                if counter_name == name:
+                    lines.append('{}{} {}'.format(name, _format_labels(dict(labels)), value))
+            continue
+        for (histogram_name, labels), histogram in sorted(histograms.items()):
+            if histogram_name != name:
+                continue
+            labels = dict(labels)
+            cumulative_count = 0
+            for upper_bound, bucket_count in zip(DURATION_BUCKETS + ('+Inf',), histogram[:-1]):
+                cumulative_count += bucket_count
+                lines.append('{}_bucket{} {}'.format(
+                    name, _format_labels(dict(labels, le=str(upper_bound))), cumulative_count
+                ))
+            lines.append('{}_sum{} {}'.format(name, _format_labels(labels), histogram[-1]))
+            lines.append('{}_count{} {}'.format(name, _format_labels(labels), cumulative_count))
+    return '\n'.join(lines) + '\n'
@@ -1,38 +1,70 @@
+import time
+import asyncio
+
+from asgiref.sync import sync_to_async
+
+from imagestore import metrics, profiling
+
 
 class CustomMiddleware(object):
+    # Both modes, so async views under ASGI are not run through a thread
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         """
         One-time configuration and initialisation.
         """
         self.get_response = get_response
+        if asyncio.iscoroutinefunction(self.get_response):
+            # Mark the class as async-capable, but do the actual switch
+            # inside __call__ to avoid swapping out dunder methods
+            self._is_coroutine = asyncio.coroutines._is_coroutine
 
     def __call__(self, request):
         """
         Code to be executed for each request before the view (and later
         middleware) are called.
         """
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        self.process_request(request)
+        profiler = profiling.start_profiler() if profiling.should_profile(request) else None
+        started_at = time.perf_counter()
+        request_queries = metrics.start_request()
         response = self.get_response(request)
+        duration_sec = time.perf_counter() - started_at
+        metrics.record_request(request, response, duration_sec, request_queries)
+        if profiler:
+            profiler.stop()
+            profiling.save_profile(profiler, request, response, duration_sec)
         return response
 
-    def process_view(self, request, view_func, view_args, view_kwargs):
+    async def __acall__(self, request):
+        self.process_request(request)
+        # request.user is loaded from the session, by a query, only for ?profile=1
+        if 'profile' in request.GET:
+            should_profile = await sync_to_async(profiling.should_profile)(request)
+        else:
+            should_profile = profiling.should_profile(request)
+        # started here, the SQL recorder is seen by this request's context only
+        profiler = profiling.start_profiler(is_async=True) if should_profile else None
+        started_at = time.perf_counter()
+        request_queries = metrics.start_request()
+        response = await self.get_response(request)
+        duration_sec = time.perf_counter() - started_at
+        metrics.record_request(request, response, duration_sec, request_queries)
+        if profiler:
+            profiler.stop()
+            await sync_to_async(profiling.save_profile)(profiler, request, response, duration_sec)
+        return response
+
+    def process_request(self, request):
         """
-        Called just before Django calls the view.
+        Called before the view, in the request's own mode.
         """
         client_ip_address = request.META.get('REMOTE_ADDR', '')
         x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
         if x_forwarded_for and ',' in x_forwarded_for:
             client_ip_address = x_forwarded_for.split(',')[0]
         request.client_ip = client_ip_address
-        return None
-
-    def process_exception(self, request, exception):
-        """
-        Called when a view raises an exception.
-        """
-        return None
-
-    def process_template_response(self, request, response):
-        """
-        Called just after the view has finished executing.
-        """
-        return response
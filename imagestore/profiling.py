@@ -0,0 +1,202 @@
+"""
+On-demand sampling profiler for single requests.
+
+A request is profiled when it carries a valid X-Imagestore-Profile header
+(a signed token from "./manage.py profiletoken"), when a staff user logged
+in to the admin adds ?profile=1, or for 1 in PROFILING_SAMPLE_RATE requests.
+A thread then samples the stack of the thread serving the request every
+PROFILING_INTERVAL_MS, while the SQL the request runs is recorded, and
+both are written to PROFILES_DIR:
+    <profile id>.folded  collapsed stacks, for flamegraph.pl or speedscope
+    <profile id>.json    the request, its SQL with timings, and the stacks
+The profile id is returned in the X-Imagestore-Profile-Id response header.
+
+Requests not profiled only pay for the checks of the triggers. Async
+views hop between the event loop and sync_to_async threads, so their
+profiles sample every thread of the process, other requests included.
+"""
+import os
+import sys
+import json
+import time
+import random
+import logging
+import threading
+import contextvars
+from datetime import datetime
+from collections import Counter
+
+from django.conf import settings
+from django.core import signing
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.utils.text import slugify
+
+
+PROFILE_HEADER = 'HTTP_X_IMAGESTORE_PROFILE'
+PROFILE_ID_HEADER = 'X-Imagestore-Profile-Id'
+
+TOKEN_SALT = 'imagestore.profiling'
+
+# [(sql, seconds)] of the request being profiled
+_profiled_queries = contextvars.ContextVar('profiled_queries', default=None)
+
+
+def create_token():
+    return signing.TimestampSigner(salt=TOKEN_SALT).sign('profile')
+
+
+def is_valid_token(token):
+    try:
+        signing.TimestampSigner(salt=TOKEN_SALT).unsign(token, max_age=settings.PROFILING_TOKEN_MAX_AGE_SEC)
+    except signing.BadSignature:
+        return False
+    return True
+
+
+def should_profile(request):
+    token = request.META.get(PROFILE_HEADER)
+    if token:
+        return is_valid_token(token)
+    # the session user, DRF authentication has not run yet
+    if 'profile' in request.GET:
+        return request.user.is_staff
+    return settings.PROFILING_SAMPLE_RATE > 0 and random.randrange(settings.PROFILING_SAMPLE_RATE) == 0
+
+
+def _record_query(execute, sql, params, many, context):
+    profiled_queries = _profiled_queries.get()
+    if profiled_queries is None:
+        return execute(sql, params, many, context)
+    started_at = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profiled_queries.append((sql, time.perf_counter() - started_at))
+
+
+@receiver(connection_created)
+def install_query_recorder(sender, connection, **kwargs):
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+def _frame_label(code):
+    file_name = code.co_filename
+    for prefix in sorted(sys.path, key=len, reverse=True):
+        if prefix and file_name.startswith(prefix + os.sep):
+            file_name = file_name[len(prefix) + 1:]
+            break
+    return "{} ({}:{})".format(code.co_name, file_name, code.co_firstlineno)
+
+
+class SamplingProfiler(object):
+
+    def __init__(self, thread_id=None, interval_sec=0.005):
+        """
+        Samples thread_id, or every thread when None.
+        """
+        self.thread_id = thread_id
+        self.interval_sec = interval_sec
+        self.stacks = Counter()
+        self.queries = []
+        self._frame_labels = {}
+        self._stopped = threading.Event()
+        self._sampler = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+
+    def start(self):
+        self._queries_token = _profiled_queries.set(self.queries)
+        self._sampler.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._sampler.join()
+        # sync workers serve the next request in the same context
+        _profiled_queries.reset(self._queries_token)
+
+    def _run(self):
+        sampler_id = threading.get_ident()
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        while not self._stopped.wait(self.interval_sec):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == sampler_id or (self.thread_id and thread_id != self.thread_id):
+                    continue
+                stack = []
+                while frame is not None:
+                    frame_label = self._frame_labels.get(frame.f_code)
+                    if frame_label is None:
+                        frame_label = self._frame_labels[frame.f_code] = _frame_label(frame.f_code)
+                    stack.append(frame_label)
+                    frame = frame.f_back
+                if self.thread_id is None:
+                    if thread_id not in thread_names:
+                        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+                    stack.append(thread_names.get(thread_id, str(thread_id)))
+                self.stacks[';'.join(reversed(stack))] += 1
+
+
+def start_profiler(is_async=False):
+    """
+    Profile the current thread, or every thread for async requests.
+    """
+    return SamplingProfiler(
+        None if is_async else threading.get_ident(), settings.PROFILING_INTERVAL_MS / 1000
+    ).start()
+
+
+def save_profile(profiler, request, response, duration_sec):
+    """
+    Write the profile of a stopped profiler.
+    """
+    resolver_match = getattr(request, 'resolver_match', None)
+    view = resolver_match.view_name if resolver_match else 'unmatched'
+    profile_id = "{}-{}-{}".format(
+        datetime.now().strftime('%Y%m%dT%H%M%S%f'), slugify(view), int(duration_sec * 1000)
+    )
+    profile = {
+        'request': {
+            'method': request.method,
+            'path': request.path,
+            'view': view,
+            'status': response.status_code,
+            'duration_ms': round(duration_sec * 1000, 3),
+        },
+        'interval_ms': settings.PROFILING_INTERVAL_MS,
+        'sql': [{'sql': sql, 'duration_ms': round(query_sec * 1000, 3)} for sql, query_sec in profiler.queries],
+        'stacks': dict(profiler.stacks),
+    }
+    try:
+        os.makedirs(settings.PROFILES_DIR, exist_ok=True)
+        with open(os.path.join(settings.PROFILES_DIR, profile_id + '.folded'), 'w') as folded_file:
+            for stack, count in profiler.stacks.most_common():
+                folded_file.write("{} {}\n".format(stack, count))
+        with open(os.path.join(settings.PROFILES_DIR, profile_id + '.json'), 'w') as profile_file:
+            json.dump(profile, profile_file, indent=2)
+        remove_old_profiles()
+    except OSError as exc:
+        logging.log(
+            level=logging.ERROR,
+            msg=f"Could not save profile {profile_id}. error: {exc}"
+        )
+        return
+    logging.log(
+        level=logging.INFO,
+        msg=f"Profiled {request.method} {request.path} for client with IP {request.client_ip} "
+            f"as {profile_id}."
+    )
+    response[PROFILE_ID_HEADER] = profile_id
+
+
+def remove_old_profiles():
+    profile_names = sorted(
+        file_name for file_name in os.listdir(settings.PROFILES_DIR) if file_name.endswith('.json')
+    )
+    # names start with the time
+    for file_name in profile_names[:max(0, len(profile_names) - settings.PROFILES_MAX_COUNT)]:
+        profile_id = file_name[:-len('.json')]
+        for extension in ('.json', '.folded'):
+            try:
+                os.remove(os.path.join(settings.PROFILES_DIR, profile_id + extension))
+            except FileNotFoundError:
+                pass
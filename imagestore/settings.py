@@ -136,6 +136,14 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Log files are written by a listener thread per process, see imagestore/log.py.
+# Fraction of DEBUG records kept, app logs and SQL (logged when DEBUG is on).
+# 1.0 keeps them all, lower it to sample.
+LOG_DEBUG_SAMPLE_RATE = env('LOG_DEBUG_SAMPLE_RATE', cast=float, default=1.0)
+LOG_DB_SAMPLE_RATE = env('LOG_DB_SAMPLE_RATE', cast=float, default=1.0)
+# INFO and DEBUG records per second and logger, beyond are dropped, 0 for no limit
+LOG_RATE_LIMIT_PER_SEC = env.int('LOG_RATE_LIMIT_PER_SEC', default=100)
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -151,6 +159,22 @@ LOGGING = {
         'require_debug_true': {
             '()': 'django.utils.log.RequireDebugTrue',
         },
+        'sample_debug': {
+            '()': 'imagestore.log.SamplingFilter',
+            'rate': LOG_DEBUG_SAMPLE_RATE,
+            'max_level': 'DEBUG',
+        },
+        'sample_db': {
+            '()': 'imagestore.log.SamplingFilter',
+            'rate': LOG_DB_SAMPLE_RATE,
+            'max_level': 'DEBUG',
+        },
+        'rate_limit': {
+            '()': 'imagestore.log.RateLimitFilter',
+            'rate': LOG_RATE_LIMIT_PER_SEC,
+            'burst': LOG_RATE_LIMIT_PER_SEC * 2,
+            'max_level': 'INFO',
+        },
     },
     'handlers': {
         'null': {
@@ -164,7 +188,8 @@ LOGGING = {
         },
         'app': {
             'level': 'DEBUG',
-            'class': 'logging.handlers.RotatingFileHandler',
+            'class': 'imagestore.log.QueuedRotatingFileHandler',
+            'filters': ['sample_debug', 'rate_limit'],
             'filename': os.path.join(BASE_DIR, 'logs/app.log'),
             'maxBytes': 1024 * 1024 * 5,
             'backupCount': 5,
@@ -172,7 +197,8 @@ LOGGING = {
         },
         'db': {
             'level': 'DEBUG',
-            'class': 'logging.handlers.RotatingFileHandler',
+            'class': 'imagestore.log.QueuedRotatingFileHandler',
+            'filters': ['sample_db', 'rate_limit'],
             'filename': os.path.join(BASE_DIR, 'logs/db.log'),
             'maxBytes': 1024 * 1024 * 5,
             'backupCount': 5,
@@ -180,7 +206,8 @@ LOGGING = {
         },
         'django': {
             'level': 'DEBUG',
-            'class': 'logging.handlers.RotatingFileHandler',
+            'class': 'imagestore.log.QueuedRotatingFileHandler',
+            'filters': ['sample_debug', 'rate_limit'],
             'filename': os.path.join(BASE_DIR, 'logs/django.log'),
             'maxBytes': 1024 * 1024 * 5,
             'backupCount': 5,
@@ -213,6 +240,52 @@ LOGGING = {
 
 MEDIA_ROOT = os.path.join(BASE_DIR, 'uploads')
 MEDIA_URL = '/media/'
+# levels of hash-prefix directories for images and thumbnails, move the
+# existing files with "./manage.py shardmediafiles" after changing it
+MEDIA_SHARD_LEVELS = env.int('MEDIA_SHARD_LEVELS', default=2)
+# Image volumes as "name=root:weight", comma separated, weight is relative
+# capacity. e.g. "disk1=/mnt/disk1:4,disk2=/mnt/disk2:2". Defaults to MEDIA_ROOT.
+# Move files after changing it with "./manage.py rebalancemedia".
+MEDIA_VOLUMES = env.list('MEDIA_VOLUMES', default=[])
+DEFAULT_FILE_STORAGE = 'imagehostingapp.storage.MultiVolumeStorage'
+
+# How downloads are served: 'sendfile' (FileResponse, wsgi.file_wrapper),
+# 'x-accel-redirect' (nginx), 'x-sendfile' (Apache) or 'stream' (chunked)
+IMAGE_SERVING_MODE = env('IMAGE_SERVING_MODE', default='sendfile')
+# nginx internal location aliasing MEDIA_ROOT, for 'x-accel-redirect'
+IMAGE_SERVING_INTERNAL_PREFIX = env('IMAGE_SERVING_INTERNAL_PREFIX', default='/protected-media/')
+IMAGE_SERVING_CHUNK_SIZE = 64 * 1024
+
+# Route downloads and listing to async views, for the ASGI (uvicorn) deployment
+ASYNC_VIEWS = env.bool('ASYNC_VIEWS', default=False)
+
+# Resumable chunked uploads
+UPLOAD_STAGING_ROOT = os.path.join(MEDIA_ROOT, 'staging')
+UPLOAD_CHUNK_SIZE = env.int('UPLOAD_CHUNK_SIZE', default=5 * 1024 * 1024)
+UPLOAD_SESSION_MAX_SIZE = env.int('UPLOAD_SESSION_MAX_SIZE', default=512 * 1024 * 1024)
+# sessions idle for longer are swept by "./manage.py sweepuploadsessions"
+UPLOAD_SESSION_TTL_SEC = env.int('UPLOAD_SESSION_TTL_SEC', default=60 * 60 * 24)
+
+# Batch uploads, files per request to /api/image/batch/
+BATCH_UPLOAD_MAX_FILES = env.int('BATCH_UPLOAD_MAX_FILES', default=100)
+
+# Thumbnails of the uploader's tier are rendered in background after upload
+THUMBNAIL_PREGENERATE = env.bool('THUMBNAIL_PREGENERATE', default=True)
+
+# Thumbnail render process pool, per web worker process. Aim for about
+# cores / web workers render processes.
+THUMBNAIL_RENDER_WORKERS = env.int('THUMBNAIL_RENDER_WORKERS', default=2)
+# jobs queued or running beyond this are refused with 503
+THUMBNAIL_RENDER_QUEUE_LIMIT = env.int('THUMBNAIL_RENDER_QUEUE_LIMIT', default=16)
+THUMBNAIL_RENDER_TIMEOUT_SEC = env.int('THUMBNAIL_RENDER_TIMEOUT_SEC', default=30)
+THUMBNAIL_RENDER_RETRY_AFTER_SEC = env.int('THUMBNAIL_RENDER_RETRY_AFTER_SEC', default=5)
+# thumbnail encodings offered to clients accepting them, preferred first.
+# Those the Pillow build can not encode are skipped.
+THUMBNAIL_VARIANT_FORMATS = env.list('THUMBNAIL_VARIANT_FORMATS', default=['AVIF', 'WEBP'])
+
+# Thumbnail store, least recently used thumbnails are evicted beyond the budget
+THUMBNAIL_STORE_ROOT = os.path.join(MEDIA_ROOT, 'thumbnails')
+THUMBNAIL_STORE_BUDGET_BYTES = env.int('THUMBNAIL_STORE_BUDGET_BYTES', default=1024 * 1024 * 1024)
 
 ADMINS = (
     # ('Your Name', 'your_email@domain.com'),
@@ -226,3 +299,30 @@ CACHES = {
         'LOCATION': os.path.join(BASE_DIR, 'cache'),
     }
 }
+
+# Per worker metrics files, summed at /api/metrics. Empty serves the
+# metrics of the worker answering only.
+METRICS_DIR = env('METRICS_DIR', default='')
+METRICS_FLUSH_INTERVAL_SEC = env.int('METRICS_FLUSH_INTERVAL_SEC', default=5)
+# /api/metrics answers clients connecting from these addresses (not X-Forwarded-For),
+# or sending "Authorization: Bearer <METRICS_TOKEN>". Empty token disables it.
+METRICS_ALLOWED_IPS = env.list('METRICS_ALLOWED_IPS', default=['127.0.0.1', '::1'])
+METRICS_TOKEN = env('METRICS_TOKEN', default='')
+
+# Request profiles, see imagestore/profiling.py. Profile 1 in
+# PROFILING_SAMPLE_RATE requests, 0 profiles only requests asking for it.
+PROFILING_SAMPLE_RATE = env.int('PROFILING_SAMPLE_RATE', default=0)
+PROFILING_INTERVAL_MS = env.int('PROFILING_INTERVAL_MS', default=5)
+# "./manage.py profiletoken" tokens for the X-Imagestore-Profile header expire after
+PROFILING_TOKEN_MAX_AGE_SEC = env.int('PROFILING_TOKEN_MAX_AGE_SEC', default=60 * 60)
+PROFILES_DIR = os.path.join(BASE_DIR, 'profiles')
+# oldest profiles are removed beyond this many
+PROFILES_MAX_COUNT = env.int('PROFILES_MAX_COUNT', default=500)
+
+# Download views cache per user image metadata, never the image bytes
+IMAGE_METADATA_CACHE_TIMEOUT = 60 * 60 * 6
+
+# Subscription entitlements per user, invalidated on tier/subscription changes
+ENTITLEMENTS_CACHE_TIMEOUT = 60 * 60 * 24
+# in-process copy, other workers pick up changes within this many seconds
+ENTITLEMENTS_LOCAL_TIMEOUT = env.int('ENTITLEMENTS_LOCAL_TIMEOUT', default=5)
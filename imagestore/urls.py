@@ -13,6 +13,7 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.contrib.staticfiles.urls import staticfiles_urlpatterns
 from django.contrib import admin
 from django.urls import path, include
@@ -20,25 +21,44 @@ from django.views.generic.base import RedirectView
 
 from rest_framework.routers import DefaultRouter
 
+from imagehostingapp import async_views
 from imagehostingapp.views import (
-    PingImageHostingApp, ListUploadImages, DownloadImage,
+    PingImageHostingApp, MetricsImageHostingApp, ListUploadImages, UploadSessions, DownloadImage,
     DownloadImageThumbnail, DownloadTempImage
 )
 
 
 router = DefaultRouter()
 router.register('image', ListUploadImages, basename='list_upload_image')
+router.register('upload', UploadSessions, basename='upload_session')
+
+
+if settings.ASYNC_VIEWS:
+    download_image_thumbnail_view = async_views.download_image_thumbnail
+    download_image_view = async_views.download_image
+    download_temp_image_view = async_views.download_temp_image
+else:
+    download_image_thumbnail_view = DownloadImageThumbnail.as_view()
+    download_image_view = DownloadImage.as_view()
+    download_temp_image_view = DownloadTempImage.as_view()
 
 
 api_urls = [
     path('ping', PingImageHostingApp.as_view(), name='api_ping_server'),
+    path('metrics', MetricsImageHostingApp.as_view(), name='api_metrics'),
     path('image/<uuid:image_id>/size/<int:thumbnail_size_px>/',
-         DownloadImageThumbnail.as_view(), name='download_image_thumbnail'),
-    path('image/<uuid:image_id>/', DownloadImage.as_view(), name='download_image'),
-    path('image/<str:image_temp_id>/', DownloadTempImage.as_view(), name='download_temp_image'),
+         download_image_thumbnail_view, name='download_image_thumbnail'),
+    path('image/<uuid:image_id>/', download_image_view, name='download_image'),
+    # ahead of temp links, 'batch' would be taken for a temp image id
+    path('image/batch/', ListUploadImages.as_view({'post': 'batch'}), name='list_upload_image-batch'),
+    path('image/<str:image_temp_id>/', download_temp_image_view, name='download_temp_image'),
     path('', include(router.urls)),
 ]
 
+if settings.ASYNC_VIEWS:
+    # ahead of the router, uploads are handed back to the DRF view
+    api_urls.insert(0, path('image/', async_views.list_upload_images, name='list_upload_image-list'))
+
 
 urlpatterns = [
     path('', RedirectView.as_view(permanent=False, url='/api'), name="index"),